@@ -1,5 +1,6 @@
 import sys
 import requests
+from urllib.parse import quote
 import os
 import json
 import hashlib
@@ -119,6 +120,155 @@ class AuthClient:
         
         return response
 
+    # Batch requests are signed once for the whole body
+    def mget(self, keys):
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/mget",
+            json={"keys": list(keys)}
+        )
+
+    def mset(self, items):
+        # items: {key: value} or a list of {"key", "value", "type", "expiry"} dicts
+        if isinstance(items, dict):
+            items = [{"key": key, "value": value} for key, value in items.items()]
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/mset",
+            json={"items": list(items)}
+        )
+
+    def mdel(self, keys):
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/mdel",
+            json={"keys": list(keys)}
+        )
+
+    def pipeline(self, commands):
+        # commands: list of (command, args) pairs, e.g. ("get", {"key": "a"})
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/pipeline",
+            json={"commands": [{"command": command, "args": args or {}} for command, args in commands]}
+        )
+
+    def incrby(self, key, increment=1):
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/incrby",
+            params={"key": key, "increment": increment}
+        )
+
+    def incrbyfloat(self, key, increment):
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/incrbyfloat",
+            params={"key": key, "increment": increment}
+        )
+
+    def getset(self, key, value, type=None):
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/getset",
+            json={"key": key, "value": value, "type": type}
+        )
+
+    def incrby_batch(self, increments):
+        # increments: {key: amount}, signed once for the whole batch
+        return self.authenticated_request(
+            'POST',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/incrby_batch",
+            json={"items": [{"key": key, "increment": amount} for key, amount in increments.items()]}
+        )
+
+    def scan_iter(self, match=None, count=100, type=None):
+        # walks /scan lazily, one request per page
+        cursor = "0"
+        while True:
+            params = {"cursor": cursor, "count": count}
+            if match:
+                params["match"] = match
+            if type:
+                params["type"] = type
+            response = self.authenticated_request(
+                'GET',
+                f"{BASE_URL}/user/{self.credentials['public_key']}/scan",
+                params=params
+            )
+            page = response.json()
+            if response.status_code != 200:
+                raise RuntimeError(page.get("detail", page))
+            yield from page["keys"]
+            cursor = page["cursor"]
+            if cursor == "0":
+                return
+
+    def memory_usage(self, key):
+        # bytes the key holds in the server's RAM
+        return self.authenticated_request(
+            'GET',
+            f"{BASE_URL}/user/{self.credentials['public_key']}/memory",
+            params={"key": key}
+        )
+
+    # Lists, hashes, sets and sorted sets go through the pipeline route, one
+    # command per request: {"key": ..., "args": [...]} like the Redis command
+    def collection_command(self, command, key, *args):
+        response = self.pipeline([(command, {"key": key, "args": [str(arg) for arg in args]})])
+        if response.status_code != 200:
+            return response.json()
+        result = response.json()["results"][0]
+        return result["result"] if result["ok"] else {"error": result["error"]}
+
+    def lpush(self, key, *values):
+        return self.collection_command("lpush", key, *values)
+
+    def rpush(self, key, *values):
+        return self.collection_command("rpush", key, *values)
+
+    def lpop(self, key, count=None):
+        return self.collection_command("lpop", key, *([] if count is None else [count]))
+
+    def lrange(self, key, start=0, stop=-1):
+        return self.collection_command("lrange", key, start, stop)
+
+    def hset(self, key, fields):
+        return self.collection_command("hset", key, *[item for pair in fields.items() for item in pair])
+
+    def hget(self, key, field):
+        return self.collection_command("hget", key, field)
+
+    def hincrby(self, key, field, increment=1):
+        return self.collection_command("hincrby", key, field, increment)
+
+    def sadd(self, key, *members):
+        return self.collection_command("sadd", key, *members)
+
+    def sismember(self, key, member):
+        return self.collection_command("sismember", key, member)
+
+    def sinter(self, *keys):
+        response = self.pipeline([("sinter", {"keys": list(keys)})])
+        return response.json()["results"][0]
+
+    def zadd(self, key, members):
+        return self.collection_command("zadd", key, *[item for member, score in members.items() for item in (score, member)])
+
+    def zrangebyscore(self, key, min="-inf", max="+inf", withscores=False):
+        return self.collection_command("zrangebyscore", key, min, max, *(["WITHSCORES"] if withscores else []))
+
+    def zrank(self, key, member):
+        return self.collection_command("zrank", key, member)
+
+# Typed the same way as redis-cli: lpush mylist a b c, zadd board 10 alice
+COLLECTION_COMMANDS = {
+    "lpush", "rpush", "lpop", "rpop", "lrange", "llen",
+    "hset", "hget", "hgetall", "hdel", "hincrby", "hlen",
+    "sadd", "srem", "sismember", "smembers", "scard",
+    "zadd", "zrem", "zscore", "zrank", "zrangebyscore", "zcard",
+}
+
 def ping(client):
     response = client.authenticated_request(
         'POST',
@@ -159,7 +309,8 @@ def set_file(client, key, file_path, expiry=None):
         # Use the files parameter for file uploads
         response = client.authenticated_request(
             'POST', 
-            f"{BASE_URL}/user/{client.credentials['public_key']}/setfile", 
+            # the key in the URL too, so an overwrite is credited while the file uploads
+            f"{BASE_URL}/user/{client.credentials['public_key']}/setfile?key={quote(key)}", 
             files=files, 
             data=data
         )
@@ -196,6 +347,24 @@ def get_value(client, key):
     )
     print(response.json())
 
+def mget(client, keys):
+    print(client.mget(keys).json())
+
+def mset(client, pairs):
+    print(client.mset(dict(zip(pairs[::2], pairs[1::2]))).json())
+
+def mdel(client, keys):
+    print(client.mdel(keys).json())
+
+def incr(client, key, amount="1"):
+    if "." in amount:
+        print(client.incrbyfloat(key, float(amount)).json())
+    else:
+        print(client.incrby(key, int(amount)).json())
+
+def getset(client, key, value):
+    print(client.getset(key, value).json())
+
 def get_keys(client):
     response = client.authenticated_request(
         'GET', 
@@ -203,6 +372,10 @@ def get_keys(client):
     )
     print(response.json())
 
+def scan_keys(client, match=None, type=None):
+    for key in client.scan_iter(match=match, type=type):
+        print(key)
+
 def get_info(client):
     response = client.authenticated_request(
         'GET', 
@@ -284,7 +457,18 @@ def main():
     - setfile <key> <file_path> [expiry]
     - getfile <key> <save_path>
     - get <key>
+    - mget <key> [key ...]
+    - mset <key> <value> [key value ...]
+    - mdel <key> [key ...]
+    - incr <key> [amount]   # decr <key> [amount]; a decimal amount works like INCRBYFLOAT
+    - getset <key> <value>
     - keys 
+    - memory <key>   # MEMORY USAGE of a key in bytes
+    - scan [pattern] [type]   # walks keys in pages, e.g. scan user:* hash
+    - lpush|rpush <key> <value> [value ...], lpop|rpop <key> [count], lrange <key> <start> <stop>
+    - hset <key> <field> <value> [field value ...], hget <key> <field>, hgetall <key>, hincrby <key> <field> <n>
+    - sadd <key> <member> [member ...], sismember <key> <member>, smembers <key>, sinter <key> [key ...]
+    - zadd <key> <score> <member> [score member ...], zrank <key> <member>, zrangebyscore <key> <min> <max> [WITHSCORES]
     - info
     - config <command> <value>
     - psync <replica_id> <offset>
@@ -305,6 +489,10 @@ def main():
     > setfile user1 myfile /path/to/file.pdf 3600
     > getfile user1 myfile /path/to/save/downloaded.pdf
     > get user1 mykey
+    > mset a 1 b 2
+    > mget a b
+    > rpush queue job1 job2
+    > zadd board 10 alice 7 bob
     > keys user1
     """
     client = AuthClient()
@@ -340,6 +528,28 @@ def main():
                 get_file(client, command[1], command[2])
             elif cmd == "get" and len(command) == 2:
                 get_value(client, command[1])
+            elif cmd == "mget" and len(command) >= 2:
+                mget(client, command[1:])
+            elif cmd == "mset" and len(command) >= 3 and len(command) % 2 == 1:
+                mset(client, command[1:])
+            elif cmd in ("incr", "decr") and len(command) in [2, 3]:
+                amount = command[2] if len(command) == 3 else "1"
+                if cmd == "decr":
+                    # DECRBY k -5 adds 5, like Redis
+                    amount = str(-float(amount)) if "." in amount else str(-int(amount))
+                incr(client, command[1], amount)
+            elif cmd == "getset" and len(command) == 3:
+                getset(client, command[1], command[2])
+            elif cmd == "mdel" and len(command) >= 2:
+                mdel(client, command[1:])
+            elif cmd in COLLECTION_COMMANDS and len(command) >= 2:
+                print(client.collection_command(cmd, command[1], *command[2:]))
+            elif cmd == "sinter" and len(command) >= 2:
+                print(client.sinter(*command[1:]))
+            elif cmd == "scan" and len(command) <= 3:
+                scan_keys(client, command[1] if len(command) >= 2 else None, command[2] if len(command) == 3 else None)
+            elif cmd == "memory" and len(command) == 2:
+                print(client.memory_usage(command[1]).json())
             elif cmd == "keys" and len(command) == 1:
                 get_keys(client)
             elif cmd == "info":
@@ -1,42 +1,237 @@
+import json
+import zlib
 import requests
 
 class KeyValueClient:
-    def __init__(self, host="127.0.0.1", port=8000):
+    def __init__(self, host="127.0.0.1", port=8000, shard_aware=False):
         self.base_url = f"http://{host}:{port}"
+        # with a sharded server, talk to each tenant's shard directly instead
+        # of having it forwarded (see redis_vm/sharding.py)
+        self.shard_urls = []
+        if shard_aware:
+            response = requests.get(f"{self.base_url}/shards")
+            if response.status_code == 200:
+                self.shard_urls = [f"http://{host}:{shard_port}" for shard_port in response.json()["ports"]]
+
+    def url(self, user_id):
+        if not self.shard_urls:
+            return self.base_url
+        return self.shard_urls[zlib.crc32(user_id.encode()) % len(self.shard_urls)]
 
     def ping(self, user_id):
-        response = requests.post(f"{self.base_url}/user/{user_id}/ping")
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/ping")
         return response.json()
 
     def echo(self, user_id, message):
-        response = requests.post(f"{self.base_url}/user/{user_id}/echo", params={"message": message})
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/echo", params={"message": message})
         return response.json()
 
     def set_value(self, user_id, key, value, expiry=None):
         data = {"key": key, "value": value}
         if expiry:
             data["expiry"] = expiry
-        response = requests.post(f"{self.base_url}/user/{user_id}/set", json=data)
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/set", json=data)
         return response.json()
 
     def get_value(self, user_id, key):
-        response = requests.get(f"{self.base_url}/user/{user_id}/get", params={"key": key})
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/get", params={"key": key})
+        return response.json()
+
+    def mget(self, user_id, keys):
+        # values come back in the order of keys, None for missing ones
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/mget", json={"keys": list(keys)})
+        return response.json()
+
+    def mset(self, user_id, items):
+        # items: {key: value} or a list of {"key", "value", "type", "expiry"} dicts
+        if isinstance(items, dict):
+            items = [{"key": key, "value": value} for key, value in items.items()]
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/mset", json={"items": list(items)})
+        return response.json()
+
+    def mdel(self, user_id, keys):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/mdel", json={"keys": list(keys)})
+        return response.json()
+
+    def pipeline(self, user_id, commands):
+        # commands: list of (command, args) pairs, e.g. ("set", {"key": "a", "value": 1})
+        body = {"commands": [{"command": command, "args": args or {}} for command, args in commands]}
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/pipeline", json=body)
+        return response.json()
+
+    # Counters, atomic on the server
+    def incr(self, user_id, key):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/incr", params={"key": key})
+        return response.json()
+
+    def incrby(self, user_id, key, increment):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/incrby", params={"key": key, "increment": increment})
+        return response.json()
+
+    def decr(self, user_id, key):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/decr", params={"key": key})
+        return response.json()
+
+    def decrby(self, user_id, key, decrement):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/decrby", params={"key": key, "decrement": decrement})
+        return response.json()
+
+    def incrbyfloat(self, user_id, key, increment):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/incrbyfloat", params={"key": key, "increment": increment})
+        return response.json()
+
+    def getset(self, user_id, key, value, type=None):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/getset", json={"key": key, "value": value, "type": type})
+        return response.json()
+
+    def incrby_batch(self, user_id, increments):
+        # increments: {key: amount}, a float amount works like INCRBYFLOAT
+        items = [{"key": key, "increment": amount} for key, amount in increments.items()]
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/incrby_batch", json={"items": items})
+        return response.json()
+
+    def type(self, user_id, key):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/type", params={"key": key})
+        return response.json()
+
+    # Lists
+    def lpush(self, user_id, key, *values):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/lpush", json={"key": key, "values": list(values)})
+        return response.json()
+
+    def rpush(self, user_id, key, *values):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/rpush", json={"key": key, "values": list(values)})
+        return response.json()
+
+    def lpop(self, user_id, key, count=None):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/lpop", params={"key": key, "count": count})
+        return response.json()
+
+    def rpop(self, user_id, key, count=None):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/rpop", params={"key": key, "count": count})
+        return response.json()
+
+    def lrange(self, user_id, key, start=0, stop=-1):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/lrange", params={"key": key, "start": start, "stop": stop})
+        return response.json()
+
+    # Hashes
+    def hset(self, user_id, key, fields):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/hset", json={"key": key, "fields": fields})
+        return response.json()
+
+    def hget(self, user_id, key, field):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/hget", params={"key": key, "field": field})
+        return response.json()
+
+    def hgetall(self, user_id, key):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/hgetall", params={"key": key})
+        return response.json()
+
+    def hincrby(self, user_id, key, field, increment=1):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/hincrby",
+                                 params={"key": key, "field": field, "increment": increment})
+        return response.json()
+
+    # Sets
+    def sadd(self, user_id, key, *members):
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/sadd", json={"key": key, "members": list(members)})
+        return response.json()
+
+    def sismember(self, user_id, key, member):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/sismember", params={"key": key, "member": member})
+        return response.json()
+
+    def smembers(self, user_id, key):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/smembers", params={"key": key})
+        return response.json()
+
+    def sinter(self, user_id, *keys):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/sinter", params={"keys": list(keys)})
+        return response.json()
+
+    # Sorted sets
+    def zadd(self, user_id, key, members):
+        # members: {member: score}
+        response = requests.post(f"{self.url(user_id)}/user/{user_id}/zadd", json={"key": key, "members": members})
+        return response.json()
+
+    def zrangebyscore(self, user_id, key, min="-inf", max="+inf", withscores=False, offset=0, count=-1):
+        params = {"key": key, "min": min, "max": max, "withscores": withscores, "offset": offset, "count": count}
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/zrangebyscore", params=params)
+        return response.json()
+
+    def zrank(self, user_id, key, member):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/zrank", params={"key": key, "member": member})
+        return response.json()
+
+    def zscore(self, user_id, key, member):
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/zscore", params={"key": key, "member": member})
+        return response.json()
+
+    def memory_usage(self, user_id, key):
+        # bytes the key holds in RAM, what MEMORY USAGE returns
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/memory", params={"key": key})
         return response.json()
 
     def get_keys(self, user_id):
-        response = requests.get(f"{self.base_url}/user/{user_id}/keys")
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/keys")
         return response.json()
 
-    def get_all_users(self):
-        response = requests.get(f"{self.base_url}/users")
+    def scan(self, user_id, cursor="0", match=None, count=None, type=None):
+        params = {"cursor": cursor, "match": match, "count": count, "type": type}
+        response = requests.get(f"{self.url(user_id)}/user/{user_id}/scan", params=params)
+        return response.json()
+
+    def scan_iter(self, user_id, match=None, count=100, type=None):
+        # yields keys one page at a time, the next page is only fetched when needed
+        cursor = "0"
+        while True:
+            page = self.scan(user_id, cursor, match, count, type)
+            if "cursor" not in page:
+                raise RuntimeError(page.get("detail", page))
+            yield from page["keys"]
+            cursor = page["cursor"]
+            if cursor == "0":
+                return
+
+    def user_exists(self, user_id):
+        response = requests.get(f"{self.url(user_id)}/users/{user_id}/exists")
+        return response.json()["exists"]
+
+    def get_user(self, user_id):
+        # key count, bytes used and tier of one tenant
+        response = requests.get(f"{self.url(user_id)}/users/{user_id}")
+        return response.json()
+
+    def list_users(self, after=None, limit=100):
+        response = requests.get(f"{self.base_url}/users", params={"after": after, "limit": limit})
         return response.json()
 
+    def get_all_users(self):
+        # summaries of every tenant, walking the pages
+        users = []
+        after = None
+        while True:
+            page = self.list_users(after)
+            users += page["users"]
+            after = page["next"]
+            if after is None:
+                return users
+
+    def export_users(self, include_files=False):
+        # yields one dict per record of the NDJSON export
+        response = requests.get(f"{self.base_url}/users/export", params={"include_files": include_files}, stream=True)
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
     def delete_key(self, user_id: str, key: str):
-        response = requests.delete(f"{self.base_url}/user/{user_id}/key/{key}")
+        response = requests.delete(f"{self.url(user_id)}/user/{user_id}/key/{key}")
         return response.json()
 
     def delete_user(self, user_id: str):
-        response = requests.delete(f"{self.base_url}/user/{user_id}")
+        response = requests.delete(f"{self.url(user_id)}/user/{user_id}")
         return response.json()
 
     def delete_all_users(self):
@@ -52,4 +247,20 @@ class KeyValueClient:
 # # Use the client functions
 # result = client.set_value("user1", "mykey", "myvalue")
 # value = client.get_value("user1", "mykey")
-# keys = client.get_keys("user1")
\ No newline at end of file
+# keys = client.get_keys("user1")
+# for key in client.scan_iter("user1", match="session:*"):
+#     ...
+
+# # Batches, one round trip each
+# client.mset("user1", {"a": "1", "b": "2"})
+# values = client.mget("user1", ["a", "b", "missing"])
+# # Counters
+# client.incr("user1", "views")
+# client.incrby_batch("user1", {"views": 1, "clicks": 3})
+
+# # Collections
+# client.rpush("user1", "queue", "job1", "job2")
+# client.zadd("user1", "scores", {"alice": 10, "bob": 7})
+# top = client.zrangebyscore("user1", "scores", min=5, withscores=True)
+
+# results = client.pipeline("user1", [("set", {"key": "c", "value": 3, "type": "int"}), ("get", {"key": "c"})])
\ No newline at end of file
@@ -42,7 +42,7 @@ def set_file(user_id, key, file_path, expiry=None):
         if expiry:
             data["expiry"] = expiry
         
-        response = requests.post(f"{BASE_URL}/user/{user_id}/setfile", files=files, data=data)
+        response = requests.post(f"{BASE_URL}/user/{user_id}/setfile", params={"key": key}, files=files, data=data)
         if response.status_code == 200:
             print(response.json())
         else:
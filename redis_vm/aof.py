@@ -0,0 +1,553 @@
+"""Append-only file of every mutating command.
+
+Each record is framed as
+
+    payload length (u32) | crc32 of payload (u32) | payload
+
+and the payload is an opcode (u8), the user id and the opcode's fields,
+encoded with the helpers in codec.py. Expiries are logged as absolute unix
+times so a replay ends in the same state no matter when it runs.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from codec import F64, U32, Cursor, DecodeError, decode_value, encode_value, pack_float, pack_str
+from datatypes import CommandError, run as run_collection_command
+from keyspace import Entry, FileEntry, Keyspace
+
+logger = logging.getLogger(__name__)
+
+OP_CREATE = 1
+OP_META = 2
+OP_SET = 3
+OP_SETFILE = 4
+OP_DEL = 5
+OP_DELFILE = 6
+OP_EXPIREAT = 7
+OP_DELUSER = 8
+OP_FLUSHALL = 9
+OP_PING = 10  # replication heartbeat, no effect on the data
+OP_COLLECTION = 11  # a list/hash/set/zset write, replayed through datatypes.run
+
+FRAME_HEADER_SIZE = 8
+FSYNC_POLICIES = ("always", "everysec", "no")
+READ_CHUNK_SIZE = 1024 * 1024
+
+_FRAME = struct.Struct(">II")
+assert _FRAME.size == FRAME_HEADER_SIZE
+
+Record = List[bytes]
+
+
+class AOFError(Exception):
+    pass
+
+
+def _frame(*parts) -> Record:
+    length = 0
+    crc = 0
+    for part in parts:
+        length += len(part)
+        crc = zlib.crc32(part, crc)
+    return [_FRAME.pack(length, crc), *parts]
+
+
+def _head(op: int, user_id: Optional[str]) -> bytes:
+    return bytes((op,)) + pack_str(user_id)
+
+
+def cmd_create(user_id: str) -> Record:
+    return _frame(_head(OP_CREATE, user_id))
+
+
+def cmd_meta(user_id: str, fields: Dict[str, object]) -> Record:
+    return _frame(_head(OP_META, user_id), pack_str(json.dumps(fields)))
+
+
+def cmd_set(user_id: str, key: str, entry: Entry) -> Record:
+    encoding, data = encode_value(entry.value)
+    return _frame(_head(OP_SET, user_id), pack_str(key), pack_str(entry.type), pack_float(entry.expiry),
+                  bytes((encoding,)), data)
+
+
+def cmd_setfile(user_id: str, key: str, entry: FileEntry) -> Record:
+    return _frame(_head(OP_SETFILE, user_id), pack_str(key), pack_str(entry.content_type), pack_str(entry.filename),
+                  pack_float(entry.expiry), F64.pack(entry.mtime), entry.content())
+
+
+def cmd_del(user_id: str, key: str, is_file: bool = False) -> Record:
+    return _frame(_head(OP_DELFILE if is_file else OP_DEL, user_id), pack_str(key))
+
+
+def cmd_expireat(user_id: str, key: str, is_file: bool, expiry: Optional[float]) -> Record:
+    # expiry None is PERSIST
+    return _frame(_head(OP_EXPIREAT, user_id), pack_str(key), bytes((is_file,)), pack_float(expiry))
+
+
+def cmd_collection(user_id: str, key: str, name: str, args: List[str]) -> Record:
+    # logged as the command itself, an LPUSH costs its arguments and not the whole list
+    return _frame(_head(OP_COLLECTION, user_id), pack_str(key), pack_str(name), U32.pack(len(args)),
+                  *[pack_str(arg) for arg in args])
+
+
+def cmd_deluser(user_id: str) -> Record:
+    return _frame(_head(OP_DELUSER, user_id))
+
+
+def cmd_flushall() -> Record:
+    return _frame(_head(OP_FLUSHALL, None))
+
+
+def cmd_ping() -> Record:
+    return _frame(_head(OP_PING, None))
+
+
+def parse_frame(buffer, pos: int = 0) -> Optional[int]:
+    """End offset of the complete frame starting at `pos`, None if it is still partial.
+
+    Raises AOFError if the frame is complete but its checksum doesn't match.
+    """
+    if len(buffer) - pos < FRAME_HEADER_SIZE:
+        return None
+    length, crc = _FRAME.unpack_from(buffer, pos)
+    end = pos + FRAME_HEADER_SIZE + length
+    if end > len(buffer):
+        return None
+    with memoryview(buffer)[pos + FRAME_HEADER_SIZE:end] as payload:
+        if zlib.crc32(payload) != crc:
+            raise AOFError("Record checksum mismatch")
+    return end
+
+
+def keyspace_records(tenants: Iterable[Tuple[str, Keyspace]]) -> Iterator[Record]:
+    """The shortest command sequence that rebuilds the given tenants."""
+    now = time.time()
+    for user_id, keyspace in tenants:
+        yield cmd_create(user_id)
+        yield cmd_meta(user_id, {k: v for k, v in keyspace.meta.items() if k != "storage_used" and v is not None})
+        for key, entry in list(keyspace.data.items()):
+            if not entry.is_expired(now):
+                yield cmd_set(user_id, key, entry)
+        for key, entry in list(keyspace.files.items()):
+            if not entry.is_expired(now):
+                try:
+                    yield cmd_setfile(user_id, key, entry)
+                except KeyError:
+                    continue  # blob freed while we were walking the keyspace
+
+
+def _keyspace_for(user_data: Dict[str, Keyspace], user_id: str) -> Keyspace:
+    keyspace = user_data.get(user_id)
+    if keyspace is None:
+        keyspace = user_data[user_id] = Keyspace(public_key=user_id)
+    return keyspace
+
+
+def _apply_set(user_data: Dict[str, Keyspace], payload: memoryview):
+    # SET dominates a replay, so its fields are unpacked inline rather than
+    # through a Cursor
+    unpack = U32.unpack_from
+    try:
+        pos = 1
+        fields = []
+        for _ in range(3):  # user id, key, type
+            (length,) = unpack(payload, pos)
+            pos += 4
+            fields.append(str(payload[pos:pos + length], "utf-8"))
+            pos += length
+        expiry = None
+        if payload[pos]:
+            (expiry,) = F64.unpack_from(payload, pos + 1)
+            pos += 8
+        encoding = payload[pos + 1]
+        value = decode_value(encoding, payload[pos + 2:])
+    except (struct.error, IndexError, UnicodeDecodeError, ValueError) as e:
+        raise DecodeError(f"Malformed SET record: {str(e)}")
+    user_id, key, value_type = fields
+    keyspace = user_data.get(user_id)
+    if keyspace is None:
+        keyspace = _keyspace_for(user_data, user_id)
+    keyspace.set(key, value, value_type, expiry)
+    return user_id, key, False
+
+
+def apply_command(user_data: Dict[str, Keyspace], payload: memoryview,
+                  spill: Optional[Callable] = None) -> Optional[Tuple[str, str, bool]]:
+    """Apply one record payload, returns (user_id, key, is_file) if it may have set an expiry."""
+    if len(payload) and payload[0] == OP_SET:
+        return _apply_set(user_data, payload)
+    cur = Cursor(payload)
+    op = cur.u8()
+    user_id = cur.str()
+    if op == OP_DEL:
+        keyspace = user_data.get(user_id)
+        if keyspace is not None:
+            keyspace.delete(cur.str())
+    elif op == OP_SETFILE:
+        key, content_type, filename, expiry, mtime = cur.str(), cur.str(), cur.str(), cur.float(), cur.f64()
+        content = bytes(cur.rest())
+        if spill is not None:
+            content = spill(content)
+        _keyspace_for(user_data, user_id).set_file(key, content, content_type, filename, expiry, mtime)
+        return user_id, key, True
+    elif op == OP_DELFILE:
+        keyspace = user_data.get(user_id)
+        if keyspace is not None:
+            keyspace.delete_file(cur.str())
+    elif op == OP_EXPIREAT:
+        key, is_file, expiry = cur.str(), cur.u8(), cur.float()
+        keyspace = user_data.get(user_id)
+        entry = (keyspace.get_file(key) if is_file else keyspace.get(key)) if keyspace is not None else None
+        if entry is not None:
+            entry.expiry = expiry
+            return user_id, key, bool(is_file)
+    elif op == OP_COLLECTION:
+        key, name = cur.str(), cur.str()
+        args = [cur.str() for _ in range(cur.u32())]
+        try:
+            run_collection_command(_keyspace_for(user_data, user_id), key, name, args)
+        except (CommandError, KeyError) as e:
+            # it succeeded when it was logged, so the log and the data disagree
+            logger.warning(f"Skipping {name} on '{key}' during replay: {str(e)}")
+    elif op == OP_CREATE:
+        _keyspace_for(user_data, user_id)
+    elif op == OP_META:
+        fields = json.loads(cur.str())
+        fields.pop("storage_used", None)
+        _keyspace_for(user_data, user_id).meta.update(fields)
+    elif op == OP_DELUSER:
+        keyspace = user_data.pop(user_id, None)
+        if keyspace is not None:
+            keyspace.release_blobs()
+    elif op == OP_FLUSHALL:
+        for keyspace in user_data.values():
+            keyspace.release_blobs()
+        user_data.clear()
+    elif op != OP_PING:
+        raise AOFError(f"Unknown AOF opcode {op}")
+    return None
+
+
+def replay(path: str, user_data: Dict[str, Keyspace], spill: Optional[Callable] = None) -> int:
+    """Apply every record of an AOF to user_data, returns the record count.
+
+    A record cut short at the end of the file (a crash mid-write) is
+    dropped and the file truncated to the last complete record; a checksum
+    mismatch anywhere else raises AOFError.
+    """
+    count = 0
+    good_offset = 0
+    buffer = bytearray()
+    header_size = _FRAME.size
+    unpack_header = _FRAME.unpack_from
+    crc32 = zlib.crc32
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer += chunk
+            pos = 0
+            end_of_buffer = len(buffer)
+            view = memoryview(buffer)
+            payload = None
+            try:
+                while end_of_buffer - pos >= header_size:
+                    length, crc = unpack_header(buffer, pos)
+                    end = pos + header_size + length
+                    if end > end_of_buffer:
+                        break
+                    payload = view[pos + header_size:end]
+                    if crc32(payload) != crc:
+                        raise AOFError(f"AOF checksum mismatch at offset {good_offset}")
+                    try:
+                        apply_command(user_data, payload, spill)
+                    except DecodeError as e:
+                        raise AOFError(f"Bad AOF record at offset {good_offset}: {str(e)}")
+                    count += 1
+                    good_offset += end - pos
+                    pos = end
+            finally:
+                del payload
+                view.release()
+            del buffer[:pos]
+    if buffer:
+        logger.warning(f"AOF ends with a truncated record, dropping its last {len(buffer)} bytes")
+        os.truncate(path, good_offset)
+    return count
+
+
+def _write_all(fd: int, data) -> int:
+    view = memoryview(data)
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
+    view.release()
+    return written
+
+
+def _rewrite_sync(path: str, tenants) -> int:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    size = 0
+    try:
+        batch = bytearray()
+        for record in keyspace_records(tenants):
+            for part in record:
+                batch += part
+            if len(batch) >= READ_CHUNK_SIZE:
+                size += _write_all(fd, batch)
+                batch.clear()
+        size += _write_all(fd, batch)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return size
+
+
+class AOF:
+    """The live append-only file: buffering, fsync policy and background rewrite.
+
+    Records are written to the OS at the end of the loop iteration that
+    produced them, so commands from one iteration share a write(). With
+    appendfsync always, responses additionally wait in sync() for an
+    fsync that covers their records; concurrent callers share one fsync
+    (group commit). With everysec a background task fsyncs once a second.
+    """
+
+    def __init__(self, user_data: Dict[str, Keyspace], config: Dict[str, str]):
+        self.user_data = user_data
+        self.config = config
+        self.fd: Optional[int] = None
+        self.buffer = bytearray()
+        self.rewrite_buffer: Optional[bytearray] = None
+        self.size = 0
+        self.base_size = 0
+        self.appended = 0  # records handed to append()
+        self.written = 0  # records handed to the OS
+        self.synced = 0  # records known to be on disk
+        self.last_fsync = time.time()
+        self.last_rewrite_status = "ok"
+        self.last_rewrite_duration: Optional[float] = None
+        self._write_scheduled = False
+        self._fsync_future: Optional[asyncio.Future] = None
+        self._rewrite_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.config["dir"], self.config["appendfilename"])
+
+    @property
+    def policy(self) -> str:
+        policy = self.config.get("appendfsync", "everysec")
+        return policy if policy in FSYNC_POLICIES else "everysec"
+
+    @property
+    def enabled(self) -> bool:
+        return self.fd is not None
+
+    @property
+    def rewrite_in_progress(self) -> bool:
+        return self._rewrite_task is not None and not self._rewrite_task.done()
+
+    def open(self):
+        os.makedirs(self.config["dir"], exist_ok=True)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.size = self.base_size = os.fstat(self.fd).st_size
+
+    def append(self, record: Record):
+        if self.fd is None:
+            return
+        for part in record:
+            self.buffer += part
+            if self.rewrite_buffer is not None:
+                self.rewrite_buffer += part
+        self.appended += 1
+        if self.policy != "always" and not self._write_scheduled:
+            try:
+                asyncio.get_running_loop().call_soon(self.write_pending)
+                self._write_scheduled = True
+            except RuntimeError:
+                self.write_pending()
+
+    def write_pending(self):
+        self._write_scheduled = False
+        if self.fd is None or not self.buffer:
+            self.written = self.appended
+            return
+        try:
+            self.size += _write_all(self.fd, self.buffer)
+        except OSError as e:
+            # keep the buffer, the next write retries it
+            logger.error(f"Error writing to the AOF: {str(e)}")
+            return
+        self.buffer.clear()
+        self.written = self.appended
+
+    def needs_sync(self) -> bool:
+        return self.fd is not None and self.policy == "always" and self.synced < self.appended
+
+    async def sync(self):
+        """Wait until every record appended so far has been fsynced."""
+        target = self.appended
+        while self.fd is not None and self.synced < target:
+            if self._fsync_future is not None:
+                # someone else's fsync is in flight, it may not cover us
+                await asyncio.shield(self._fsync_future)
+                continue
+            self.write_pending()
+            covered = self.written
+            self._fsync_future = asyncio.get_running_loop().run_in_executor(None, os.fsync, self.fd)
+            try:
+                await self._fsync_future
+                self.synced = max(self.synced, covered)
+                self.last_fsync = time.time()
+            finally:
+                self._fsync_future = None
+
+    def rewrite_due(self) -> bool:
+        if self.fd is None or self.rewrite_in_progress:
+            return False
+        min_size = int(self.config.get("auto_aof_rewrite_min_size", 64 * 1024 * 1024))
+        percentage = int(self.config.get("auto_aof_rewrite_percentage", 100))
+        if percentage <= 0 or self.size < min_size:
+            return False
+        return self.size >= self.base_size * (100 + percentage) / 100
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(1)
+            try:
+                self.write_pending()
+                if self.policy == "everysec" and self.synced < self.written:
+                    await self.sync()
+                if self.rewrite_due():
+                    logger.info(f"Starting automatic AOF rewrite, AOF is {self.size} bytes")
+                    self.bgrewrite()
+            except Exception as e:
+                logger.error(f"Error in AOF background task: {str(e)}")
+
+    def start(self):
+        if self._task is None and self.fd is not None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        for task in (self._task, self._rewrite_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = None
+        self.rewrite_buffer = None
+        if self.fd is not None:
+            self.write_pending()
+            os.fsync(self.fd)
+            self.synced = self.written
+            os.close(self.fd)
+            self.fd = None
+
+    def bgrewrite(self) -> bool:
+        """Start compacting the AOF from a snapshot of the live data."""
+        if self.fd is None or self.rewrite_in_progress:
+            return False
+        self._rewrite_task = asyncio.get_running_loop().create_task(self._run_rewrite())
+        return True
+
+    async def _run_rewrite(self):
+        started = time.monotonic()
+        tmp_path = f"{self.path}.rewrite"
+        tenants = list(self.user_data.items())
+        # from here on every record also lands in rewrite_buffer, the
+        # rewritten file gets them appended before it replaces the old one
+        self.rewrite_buffer = bytearray()
+        try:
+            if hasattr(os, "fork"):
+                pid = os.fork()
+                if pid == 0:
+                    status = 1
+                    try:
+                        _rewrite_sync(tmp_path, tenants)
+                        status = 0
+                    finally:
+                        os._exit(status)
+                _, status = await asyncio.get_running_loop().run_in_executor(None, os.waitpid, pid, 0)
+                if os.waitstatus_to_exitcode(status) != 0:
+                    raise AOFError(f"AOF rewrite child exited with status {status}")
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, _rewrite_sync, tmp_path, tenants)
+            self._swap_in(tmp_path)
+            if self._fsync_future is not None:
+                await asyncio.shield(self._fsync_future)
+        except Exception as e:
+            logger.error(f"AOF rewrite failed: {str(e)}")
+            self.last_rewrite_status = "err"
+            self.rewrite_buffer = None
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return
+        finally:
+            self.last_rewrite_duration = time.monotonic() - started
+        self.last_rewrite_status = "ok"
+        logger.info(f"AOF rewritten, {self.size} bytes")
+
+    def _swap_in(self, tmp_path: str):
+        # runs without yielding to the loop, so no record can slip in between
+        self.write_pending()
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_APPEND)
+        try:
+            _write_all(fd, self.rewrite_buffer)
+            os.fsync(fd)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.close(fd)
+            raise
+        old_fd, self.fd = self.fd, fd
+        self.rewrite_buffer = None
+        self.size = self.base_size = os.fstat(fd).st_size
+        self.synced = self.written
+        # an fsync may still be running on the old descriptor
+        if self._fsync_future is not None:
+            self._fsync_future.add_done_callback(lambda _: os.close(old_fd))
+        else:
+            os.close(old_fd)
+
+    def info(self) -> Dict[str, object]:
+        return {
+            "aof_enabled": int(self.enabled),
+            "aof_fsync": self.policy,
+            "aof_rewrite_in_progress": int(self.rewrite_in_progress),
+            "aof_last_bgrewrite_status": self.last_rewrite_status,
+            "aof_last_rewrite_time_sec": round(self.last_rewrite_duration, 3) if self.last_rewrite_duration is not None else -1,
+            "aof_current_size": self.size,
+            "aof_base_size": self.base_size,
+            "aof_buffer_length": len(self.buffer),
+            "aof_pending_fsync_records": self.written - self.synced,
+        }
+
+
+class AOFSyncMiddleware:
+    """With appendfsync always, hold each response until its writes are fsynced."""
+
+    def __init__(self, app, aof: AOF):
+        self.app = app
+        self.aof = aof
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_after_sync(message):
+            if message["type"] == "http.response.start" and self.aof.needs_sync():
+                await self.aof.sync()
+            await send(message)
+
+        await self.app(scope, receive, send_after_sync)
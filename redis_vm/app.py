@@ -1,18 +1,46 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form,Request
+from fastapi import FastAPI, HTTPException, Query, UploadFile, Request, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from typing import Dict, Optional, Union, Set
-from fastapi.responses import JSONResponse, StreamingResponse
-from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Union, Set
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+import asyncio
 import logging
-import base64
 import mimetypes
 import os
 from fastapi.middleware.cors import CORSMiddleware
-import io
 import json
-from typing import Any, Union, Dict, Optional, Set
-import pickle
+import math
+from typing import Any, Union, Dict, Optional, Set, Tuple
+import time
 from auth import verifyRequest, ReplaceSalt, userExists
+from keyspace import Entry, Keyspace, entry_memory, expiry_from_ttl, value_size
+from expiry import Expirer
+from eviction import POLICIES as EVICTION_POLICIES, OutOfMemory, Evictor, parse_memory
+from blobstore import BlobStore
+from persistence import Persistence, parse_save_policy
+from aof import (AOF, AOFError, AOFSyncMiddleware, FRAME_HEADER_SIZE, FSYNC_POLICIES, OP_PING, apply_command,
+                 cmd_collection, cmd_create, cmd_del, cmd_deluser, cmd_expireat, cmd_flushall, cmd_meta, cmd_set, cmd_setfile,
+                 keyspace_records, replay as replay_aof)
+from datatypes import COLLECTION_TYPES, COMMANDS as COLLECTION_COMMANDS, WRONGTYPE, CommandError, HashValue, \
+    ListValue, SetValue, ZSet, check_arity, growth, is_collection, run as run_collection_command, sinter
+from replication import Replication
+from scan import DEFAULT_COUNT as SCAN_DEFAULT_COUNT, InvalidCursor, Scanner, type_name
+from sharding import ShardMap, ShardRouter
+from locks import TenantLockMiddleware, TenantLocks
+from metrics import Metrics, MetricsMiddleware, render_prometheus
+from slowlog import SlowLog
+from pubsub import PubSub
+from notify import EVICTED, EXPIRED, GENERIC, HASH, LIST, SET, STRING, ZSET, Monitor, Notifier, parse_flags
+from profiler import (MAX_PROFILE_HZ, MAX_PROFILE_SECONDS, ProfilerBusy, SamplingProfiler, collapsed_text,
+                      memory_by_tenant, top_functions, tracemalloc_report)
+import tracemalloc
+from resp import NO_REPLY, OK, RespError, RespServer, SimpleString
+import fnmatch
+import inspect
+from snapshot import (CHUNK_SIZE as SNAPSHOT_CHUNK_SIZE, SnapshotError, SnapshotLoader, is_legacy_pickle,
+                      load_legacy_pickle, stream_snapshot, write_snapshot)
+from uploads import QuotaExceeded, UploadError, UploadReservation, parse_upload_form, read_upload
+from starlette.datastructures import UploadFile as StarletteUploadFile
+from streaming import RangeNotSatisfiable, etag_for, http_date, if_range_matches, iter_chunks, parse_range
 
 app = FastAPI()
 
@@ -20,19 +48,19 @@ app = FastAPI()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 ALLOWED_EXTENSIONS: Set[str] = {'.txt', '.pdf', '.doc', '.docx', '.zip', '.png', '.jpg', '.jpeg'}
+# storage_limit caps what a tenant stores, memory_soft_limit is how much RAM
+# it may hold before its own keys are evicted first once maxmemory is hit
 USER_SUBSCRIPTIONS = {
-    'basic': {'storage_limit': 75_000_000},  # 75MB
-    'premium': {'storage_limit': 150_000_000}  # 150MB
-}
-# In-memory storage for user dictionaries
-# Add to user_data structure
-user_data: Dict[str, Dict[str, Any]] = {
-    # user_id: {
-    #    'files': {...},
-    #    'subscription': 'basic',
-    #    'storage_used': 0
-    # }
+    'basic': {'storage_limit': 75_000_000, 'memory_soft_limit': 100_000_000},  # 75MB, 100MB
+    'premium': {'storage_limit': 150_000_000, 'memory_soft_limit': 200_000_000}  # 150MB, 200MB
 }
+# In-memory storage, one Keyspace per user
+# (meta: public_key/subscription/storage_used/salt, data: key -> Entry, files: key -> FileEntry)
+user_data: Dict[str, Keyspace] = {}
+# Background reclaimer for keys with an expiry
+expirer = Expirer(user_data)
+# Open SCAN iterations
+scanner = Scanner(user_data)
 
 class AuthRequest(BaseModel):
     public_key: str
@@ -52,12 +80,187 @@ app.add_middleware(
 config = {
     "dir": "/tmp",
     "dbfilename": "dump.rdb",
+    # Replicas connect to bind:port, replicaof is "<host> <port>" on a replica
+    "bind": "127.0.0.1",
     "port": "6379",
     "replicaof": "",
+    "repl_backlog_size": "1048576",
+    # RESP clients start in this tenant, SELECT <user_id> switches
+    "resp_default_user": "default",
     "master_replid": "8371b4fb1155b71f4a04d3e1bc3e18c4a990aeeb",
     "master_repl_offset": "0",
+    # <seconds> <changes> pairs: BGSAVE once <changes> writes happened within <seconds>
+    "save": "3600 1 300 100 60 10000",
+    # Append-only file in `dir`; appendfsync is always, everysec or no
+    "appendonly": "no",
+    "appendfsync": "everysec",
+    "appendfilename": "appendonly.aof",
+    "auto_aof_rewrite_percentage": "100",
+    "auto_aof_rewrite_min_size": "67108864",
+    # Files at least this big go to the extra_storage drive newvm.sh attaches
+    "blob_dir": "/mnt/extra_storage/blobs",
+    "blob_spill_threshold": "1048576",
+    "blob_cache_bytes": "134217728",
+    # RAM limit over all tenants in bytes (0 = none) and what to do when a
+    # write would go over it, see eviction.POLICIES
+    "maxmemory": "0",
+    "maxmemory_policy": "noeviction",
+    "maxmemory_samples": "5",
+    "lfu_log_factor": "10",
+    "lfu_decay_time": "1",
+    # Commands taking at least this many microseconds go to the SLOWLOG
+    # (negative = off, 0 = every command), which keeps the newest max_len
+    "slowlog_log_slower_than": "10000",
+    "slowlog_max_len": "128",
+    # yes turns on the /debug endpoints (profiler, tracemalloc, memory report)
+    "enable_debug_command": "no",
+    # Keyspace notifications, flags as in Redis' notify-keyspace-events ("" = off,
+    # "KEA" = everything). A subscriber (or MONITOR) that falls this many
+    # messages behind loses the oldest ones
+    "notify_keyspace_events": "",
+    "notify_queue_limit": "1000",
+    # Pub/Sub clients with more than this many bytes of messages not yet sent
+    # are disconnected, like Redis' client-output-buffer-limit pubsub (0 = no limit)
+    "pubsub_buffer_limit": "33554432",
 }
 
+# Per-command counts and latencies, keyspace hits/misses, HTTP traffic
+metrics = Metrics()
+slowlog = SlowLog(config)
+# Only runs while a /debug/profile request is being answered
+profiler = SamplingProfiler()
+# Pub/Sub channels per tenant, keyspace notifications are published there
+# too; MONITOR subscribers. See /user/{user_id}/pubsub, /notifications, /monitor
+pubsub = PubSub(config)
+notifier = Notifier(config, pubsub)
+monitor = Monitor(config)
+app.add_middleware(MetricsMiddleware, metrics=metrics, slowlog=slowlog, monitor=monitor)
+# Writes of one tenant run one at a time. The lock is released before the
+# response goes out through AOFSyncMiddleware's fsync wait, so the next write
+# doesn't queue behind an fsync
+tenant_locks = TenantLocks()
+app.add_middleware(TenantLockMiddleware, locks=tenant_locks)
+
+# Set when started by sharding.py: this process only holds the tenants that
+# hash to its shard, and keeps its own files and RESP port
+shards = ShardMap.from_env()
+if shards.sharded:
+    config["dir"] = os.path.join(config["dir"], f"shard{shards.index}")
+    config["blob_dir"] = os.path.join(config["blob_dir"], f"shard{shards.index}")
+    config["port"] = str(int(config["port"]) + shards.index)
+    os.makedirs(config["dir"], exist_ok=True)
+    app.add_middleware(ShardRouter, shards=shards)
+
+# Background RDB saves, dirty counter and save policies
+persistence = Persistence(user_data, config)
+# Log of every write, replayed on startup when appendonly is on
+aof = AOF(user_data, config)
+app.add_middleware(AOFSyncMiddleware, aof=aof)
+# Replication stream to replicas, or from the primary when replicaof is set
+replication = Replication(user_data, config)
+# Native RESP listener on bind:port, also where replicas send PSYNC
+resp_server = RespServer(config["resp_default_user"])
+resp_server.write_barrier = lambda: aof.sync() if aof.needs_sync() else None
+
+def propagate(record):
+    # Every write bumps the dirty counter, is logged to the AOF and sent to replicas
+    persistence.changed()
+    aof.append(record)
+    replication.feed(record)
+
+def check_writable():
+    if replication.is_replica:
+        raise HTTPException(status_code=400, detail="READONLY You can't write against a read only replica.")
+
+def key_reclaimed(user_id: str, key: str, is_file: bool):
+    # a replica waits for the primary's DEL instead, its stream must stay
+    # byte for byte the primary's
+    if replication.is_replica:
+        persistence.changed()
+        return
+    propagate(cmd_del(user_id, key, is_file))
+
+def key_expired(user_id: str, key: str, is_file: bool):
+    notifier.notify(user_id, EXPIRED, "expired", key)
+    key_reclaimed(user_id, key, is_file)
+
+def key_evicted(user_id: str, key: str, is_file: bool):
+    notifier.notify(user_id, EVICTED, "evicted", key)
+    key_reclaimed(user_id, key, is_file)
+
+expirer.on_expire = key_expired
+
+def expire_now(user_id: str, keyspace: Keyspace, key: str, is_file: bool):
+    # a lookup got to an expired key before the expirer did
+    keyspace.reclaim(key, is_file)
+    expirer.expired_keys += 1
+    key_expired(user_id, key, is_file)
+
+# maxmemory and eviction, evicted keys go out as DELs like expired ones
+evictor = Evictor(user_data, config, lambda keyspace: USER_SUBSCRIPTIONS[keyspace.meta['subscription']]['memory_soft_limit'])
+evictor.on_evict = key_evicted
+
+# Disk tier for large files, only touches blob_dir once something spills
+blob_store = BlobStore(
+    config["blob_dir"],
+    spill_threshold=int(config["blob_spill_threshold"]),
+    cache_bytes=int(config["blob_cache_bytes"]),
+)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    # Load the AOF (or else the configured dump) before serving, like redis-server does
+    if config["appendonly"] == "yes" and os.path.exists(aof.path):
+        try:
+            started = time.monotonic()
+            records = replay_aof(aof.path, user_data, spill=blob_store.maybe_spill)
+            for user_id, keyspace in user_data.items():
+                expirer.schedule_keyspace(user_id, keyspace)
+            persistence.dirty = 0
+            logger.info(f"Replayed {records} AOF records in {time.monotonic() - started:.2f}s")
+        except (AOFError, OSError) as e:
+            # don't append behind a corrupt record, fix or remove the file first
+            logger.error(f"Error loading {aof.path}, AOF disabled: {str(e)}")
+            config["appendonly"] = "no"
+    elif os.path.exists(persistence.path):
+        try:
+            restored = await restore_rdb(rdb_source(None, persistence.path))
+            persistence.dirty = 0
+            logger.info(f"Loaded {restored} users from {persistence.path}")
+        except Exception as e:
+            logger.error(f"Error loading {persistence.path}: {str(e)}")
+    if config["appendonly"] == "yes":
+        enable_aof()
+    expirer.start()
+    persistence.start()
+    try:
+        await resp_server.start(config["bind"], int(config["port"]))
+    except OSError as e:
+        logger.error(f"Cannot listen on {config['bind']}:{config['port']}: {str(e)}")
+    if config["replicaof"]:
+        set_replicaof(config["replicaof"])
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await expirer.stop()
+    await persistence.stop()
+    await resp_server.stop()
+    await aof.stop()
+    await replication.stop()
+
+def enable_aof(rewrite: bool = False):
+    try:
+        created = not os.path.exists(aof.path)
+        aof.open()
+    except OSError as e:
+        logger.error(f"Cannot open {aof.path}, AOF disabled: {str(e)}")
+        config["appendonly"] = "no"
+        return
+    aof.start()
+    if rewrite or (created and user_data):
+        # a fresh AOF starts from the data already loaded
+        aof.bgrewrite()
+
 class SetRequest(BaseModel):
     key: str
     value: Any
@@ -73,34 +276,113 @@ class AuthRequest(BaseModel):
 class PubKey(BaseModel):
     public_key: str
 
+# Batch requests are signed once for the whole body (see AuthClient); like on
+# /ping the signature isn't checked for now and its fields are ignored
+class KeysRequest(BaseModel):
+    keys: List[str]
+
+class MSetRequest(BaseModel):
+    items: List[SetRequest]
+
+class PipelineCommand(BaseModel):
+    command: str
+    args: Dict[str, Any] = {}
+
+class PipelineRequest(BaseModel):
+    commands: List[PipelineCommand]
+
+class CounterItem(BaseModel):
+    key: str
+    increment: Union[int, float] = 1  # a float increment works like INCRBYFLOAT
+
+class CountersRequest(BaseModel):
+    items: List[CounterItem]
+
+class PushRequest(BaseModel):
+    key: str
+    values: List[str]
+
+class HashSetRequest(BaseModel):
+    key: str
+    fields: Dict[str, str]
+
+class FieldsRequest(BaseModel):
+    key: str
+    fields: List[str]
+
+class MembersRequest(BaseModel):
+    key: str
+    members: List[str]
+
+class ZAddRequest(BaseModel):
+    key: str
+    members: Dict[str, float]  # member -> score
+
+class PublishRequest(BaseModel):
+    channel: str
+    message: str
+
 def check_user_limit():
-    if len(user_data) >= MAX_USERS:
+    # shards split the VM, and the user limit with it (exactly, see ShardMap.share)
+    limit = shards.share(MAX_USERS)
+    if len(user_data) >= limit:
         raise HTTPException(
             status_code=400,
-            detail=f"Server user limit reached (max {MAX_USERS} users)"
+            detail=f"Server user limit reached (max {limit} users{f' on shard {shards.index}' if shards.sharded else ''})"
         )
 
+def new_user(user_id: str) -> Keyspace:
+    check_writable()
+    keyspace = user_data[user_id] = Keyspace(public_key=user_id)
+    record = cmd_create(user_id)
+    aof.append(record)
+    replication.feed(record)
+    return keyspace
+
+def get_or_create_user(user_id: str) -> Keyspace:
+    if user_id not in user_data:
+        check_user_limit()  # Check before creating new user
+        return new_user(user_id)
+    return user_data[user_id]
+
+def spill_files(keyspace: Keyspace):
+    for entry in keyspace.files.values():
+        entry.value = blob_store.maybe_spill(entry.value)
+
+def storage_limit_for(keyspace: Keyspace) -> int:
+    return USER_SUBSCRIPTIONS[keyspace.meta['subscription']]['storage_limit']
+
+def check_storage_limit(keyspace: Keyspace, added: int):
+    # storage_used covers values and files, bytes reserved by in-flight
+    # uploads count too; growth past the tier limit is refused
+    storage_limit = storage_limit_for(keyspace)
+    current_usage = keyspace.storage_used + keyspace.reserved
+    if added > 0 and current_usage + added > storage_limit:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Storage limit exceeded. Available: {storage_limit - current_usage} bytes"
+        )
+    check_memory(keyspace, added)
+
+def check_memory(keyspace: Keyspace, added: int):
+    # evicts per maxmemory_policy until the write fits under maxmemory
+    try:
+        evictor.make_room(keyspace, max(added, 0))
+    except OutOfMemory as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/signup")
 async def signup(public_key: PubKey):
-    
-    print(public_key.public_key)
     pub_key = public_key.public_key
     
     if pub_key in user_data:
         raise HTTPException(status_code=400, detail="User already exists")
     
-    user_data[pub_key] = {
-        "public_key": pub_key,
-        "files": {},
-        "subscription": "basic",
-        "storage_used": 0,
-        "salt": None  # Initialize salt as None
-    }
+    new_user(pub_key)  # salt starts as None
     return "User signed up successfully"
 
 @app.post("/user/{public_key}/ping")
 async def ping(public_key: str, request: Request):
-    print(await request.body())
     body = await request.json()
     auth_request = AuthRequest(**body)
     
@@ -115,262 +397,1281 @@ async def ping(public_key: str, request: Request):
 @app.post("/user/{user_id}/echo")
 async def echo(user_id: str, message: str):
     if user_id not in user_data:
-        user_data[user_id] = {}
+        new_user(user_id)
     return {"response": message}
 
+def store_value(user_id: str, key: str, value: Any, value_type: str, expiry: Optional[float],
+                check_quota: bool = True, event: str = "set") -> Entry:
+    # Shared by HTTP and RESP SET: quota, expiry scheduling and propagation
+    check_writable()
+    keyspace = get_or_create_user(user_id)
+    size = value_size(value)
+    if check_quota:
+        check_storage_limit(keyspace, keyspace.size_delta(key, size))
+    entry = keyspace.set(key, value, value_type, expiry, size)
+    evictor.touch(entry)
+    expirer.schedule(user_id, key, entry)
+    propagate(cmd_set(user_id, key, entry))
+    notifier.notify(user_id, STRING, event, key)
+    return entry
+
+def convert_value(value: Any, value_type: Optional[str]):
+    """Convert a value based on the specified type, returns (value, type)."""
+    if value_type in COLLECTION_TYPES:
+        raise HTTPException(status_code=400, detail=f"'{value_type}' keys are built with their own commands (LPUSH, HSET, SADD, ZADD)")
+    try:
+        converted_value = value
+        if value_type:
+            if value_type == "int":
+                converted_value = int(value)
+            elif value_type == "float":
+                converted_value = float(value)
+            elif value_type == "bool":
+                converted_value = bool(value)
+            elif value_type == "list":
+                converted_value = json.loads(value) if isinstance(value, str) else value
+            elif value_type == "dict":
+                converted_value = json.loads(value) if isinstance(value, str) else value
+    except (ValueError, TypeError, json.JSONDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Type conversion error: {str(e)}")
+    return converted_value, value_type or type(converted_value).__name__
+
 @app.post("/user/{user_id}/set")
 async def set_value(user_id: str, request: SetRequest):
-    if user_id not in user_data:
-        check_user_limit()  # Check before creating new user
-    
+    converted_value, value_type = convert_value(request.value, request.type)
+    store_value(user_id, request.key, converted_value, value_type, expiry_from_ttl(request.expiry))
+    return {"response": "OK", "type": value_type}
+
+@app.post("/user/{user_id}/setfile")
+async def set_file(user_id: str, request: Request):
+    # Multipart fields: key, file and an optional expiry. The body is parsed
+    # by hand so the quota is enforced while it streams in. The key may also
+    # come as ?key=, known before the body: an overwritten file gives its old
+    # bytes back, and only then can that count while the body streams
+    check_writable()
+    keyspace = get_or_create_user(user_id)
+    reservation = UploadReservation(keyspace, storage_limit_for(keyspace))
+    query_key = request.query_params.get("key")
+    old = keyspace.get_file(query_key) if query_key else None
+    form = None
     try:
-        # Convert value based on specified type
-        converted_value = request.value
-        if request.type:
-            if request.type == "int":
-                converted_value = int(request.value)
-            elif request.type == "float":
-                converted_value = float(request.value)
-            elif request.type == "bool":
-                converted_value = bool(request.value)
-            elif request.type == "list":
-                converted_value = json.loads(request.value) if isinstance(request.value, str) else request.value
-            elif request.type == "dict":
-                converted_value = json.loads(request.value) if isinstance(request.value, str) else request.value
+        form = await parse_upload_form(request, reservation, credit=old.size if old is not None else 0)
+        key = form.get("key") or query_key
+        file = form.get("file")
+        if not isinstance(key, str) or not key or not isinstance(file, StarletteUploadFile):
+            raise HTTPException(status_code=400, detail="Both 'key' and 'file' form fields are required")
+        if query_key and key != query_key:
+            raise HTTPException(status_code=400, detail="The 'key' form field and query parameter differ")
+        expiry = form.get("expiry")
+        expiry = int(expiry) if expiry else None
         
-        value_type = request.type or type(converted_value).__name__
-        expiry_time = datetime.utcnow() + timedelta(seconds=request.expiry) if request.expiry else None
+        old = keyspace.get_file(key)
+        content = await read_upload(file, reservation, credit=old.size if old is not None else 0)
         
-        user_data[user_id][request.key] = {
-            "value": converted_value,
-            "expiry": expiry_time,
-            "type": value_type
-        }
-        return {"response": "OK", "type": value_type}
-    except (ValueError, json.JSONDecodeError) as e:
-        raise HTTPException(status_code=400, detail=f"Type conversion error: {str(e)}")
-
-@app.post("/user/{user_id}/setfile")
-async def set_file(user_id: str, key: str = Form(...), file: UploadFile = File(...), expiry: Optional[int] = Form(None)):
-    if user_id not in user_data:
-        check_user_limit()  # Check before creating new user
-        user_data[user_id] = {'files': {}, 'subscription': 'basic', 'storage_used': 0}
-    elif 'files' not in user_data[user_id]:
-        user_data[user_id]['files'] = {}
-    
-    content = await file.read()
-    file_size = len(content)
-    
-    # Check storage limit
-    subscription = user_data[user_id].get('subscription', 'basic')
-    storage_limit = USER_SUBSCRIPTIONS[subscription]['storage_limit']
-    current_usage = user_data[user_id].get('storage_used', 0)
-    
-    if current_usage + file_size > storage_limit:
-        raise HTTPException(
-            status_code=400, 
-            detail=f"Storage limit exceeded. Available: {storage_limit - current_usage} bytes"
-        )
-    
-    # Store file data
-    content_b64 = base64.b64encode(content).decode()
-    user_data[user_id]['files'][key] = {
-        "value": content_b64,
-        "type": "binary",
-        "content_type": file.content_type,
-        "original_filename": file.filename,
-        "expiry": datetime.utcnow() + timedelta(seconds=expiry) if expiry else None
-    }
-    
-    user_data[user_id]['storage_used'] = current_usage + file_size
+        # The body streamed in without the tenant's lock, other writes may
+        # have changed the file, the usage or the tier meanwhile: check the
+        # quota again against what is stored now, then store under the lock
+        async with tenant_locks.hold(user_id):
+            reservation.release()
+            check_writable()
+            keyspace = get_or_create_user(user_id)
+            available = storage_limit_for(keyspace) - keyspace.storage_used - keyspace.reserved
+            if keyspace.size_delta(key, len(content), is_file=True) > available:
+                raise QuotaExceeded(max(0, available))
+            # Store file data as raw bytes (or spill it to disk)
+            check_memory(keyspace, 0 if len(content) >= blob_store.spill_threshold and not blob_store.disabled else len(content))
+            entry = keyspace.set_file(key, blob_store.maybe_spill(content), file.content_type, file.filename, expiry_from_ttl(expiry))
+            evictor.touch(entry)
+            expirer.schedule(user_id, key, entry, is_file=True)
+            propagate(cmd_setfile(user_id, key, entry))
+            notifier.notify(user_id, STRING, "set", key)
+    except (QuotaExceeded, UploadError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="expiry must be an integer number of seconds")
+    finally:
+        reservation.release()
+        if form is not None:
+            await form.close()
     return {"response": "OK"}
 
 @app.get("/user/{user_id}/get")
 async def get_value(user_id: str, key: str):
-    print(user_id, user_data, sep="\n")
     if user_id not in user_data:
         raise HTTPException(status_code=404, detail="User not found")
-    if key not in user_data[user_id]:
+    keyspace = user_data[user_id]
+    entry = keyspace.get(key)
+    if entry is None:
+        if key in keyspace.meta:
+            return {"value": keyspace.meta[key], "type": "text"}
+        metrics.lookup(False)
         raise HTTPException(status_code=404, detail="Key not found")
     
-    data = user_data[user_id][key]
-    if data["expiry"] and data["expiry"] < datetime.utcnow():
-        del user_data[user_id][key]
+    if entry.is_expired():
+        expire_now(user_id, keyspace, key, False)
+        metrics.lookup(False)
         raise HTTPException(status_code=404, detail="Key expired")
-    
-    print(data["value"])
-    return {"value": data["value"], "type": data.get("type", "text")}
+    metrics.lookup(True)
+    if is_collection(entry.value):
+        raise HTTPException(status_code=400, detail=WRONGTYPE)
+    evictor.touch(entry)
+    return {"value": entry.value, "type": entry.type}
+
+@app.post("/user/{user_id}/mget")
+async def mget_values(user_id: str, request: KeysRequest):
+    # One entry per key, null for missing/expired keys and files (same as MGET)
+    if user_id not in user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    values = []
+    for key in request.keys:
+        _, entry, is_file = lookup_key(user_id, key, read=True)
+        if entry is None or is_file or is_collection(entry.value):
+            values.append(None)
+        else:
+            values.append({"value": entry.value, "type": entry.type})
+    return {"values": values}
+
+@app.post("/user/{user_id}/mset")
+async def mset_values(user_id: str, request: MSetRequest):
+    # All or nothing: every value is converted and the quota is checked for
+    # the whole batch before the first key is written
+    check_writable()
+    items = []
+    for item in request.items:
+        value, value_type = convert_value(item.value, item.type)
+        items.append((item.key, value, value_type, expiry_from_ttl(item.expiry)))
+    keyspace = get_or_create_user(user_id)
+    sizes = {key: value_size(value) for key, value, _, _ in items}
+    check_storage_limit(keyspace, sum(keyspace.size_delta(key, size) for key, size in sizes.items()))
+    for key, value, value_type, expiry in items:
+        store_value(user_id, key, value, value_type, expiry, check_quota=False)
+    return {"response": "OK", "count": len(items)}
+
+@app.post("/user/{user_id}/mdel")
+async def mdel_keys(user_id: str, request: KeysRequest):
+    check_writable()
+    if user_id not in user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    deleted = 0
+    for key in request.keys:
+        # expired keys count as missing
+        _, entry, _ = lookup_key(user_id, key)
+        if entry is not None and remove_key(user_id, key) is not None:
+            deleted += 1
+    return {"deleted": deleted}
+
+# Counters change the entry in place (type and expiry stay) and are logged
+# as an absolute SET of the result, so replay never re-adds an increment
+NOT_INTEGER = "ERR value is not an integer or out of range"
+NOT_FLOAT = "ERR value is not a valid float"
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+def format_float(value: float) -> str:
+    # the way INCRBYFLOAT prints: 3 rather than 3.0
+    text = repr(value)
+    return text[:-2] if text.endswith(".0") else text
+
+def counter_value(entry: Optional[Entry], as_float: bool) -> Union[int, float]:
+    if entry is None:
+        return 0.0 if as_float else 0
+    if is_collection(entry.value):
+        raise HTTPException(status_code=400, detail=WRONGTYPE)
+    value = entry.value
+    if entry.type == "int" and type(value) is int:
+        return float(value) if as_float else value
+    if entry.type == "float" and type(value) is float and as_float:
+        return value
+    if isinstance(value, str):
+        try:
+            if as_float:
+                number = float(value)
+                if math.isfinite(number):
+                    return number
+            elif value == str(int(value)):
+                return int(value)
+        except ValueError:
+            pass
+    raise HTTPException(status_code=400, detail=NOT_FLOAT if as_float else NOT_INTEGER)
+
+def counter_result(entry: Optional[Entry], current: Union[int, float], increment: Union[int, float],
+                   as_float: bool) -> Tuple[Any, str]:
+    """New (value, type): str counters stay strings, INCRBYFLOAT turns an int into a float."""
+    new = current + increment
+    if as_float:
+        if not math.isfinite(new):
+            raise HTTPException(status_code=400, detail="ERR increment would produce NaN or Infinity")
+        if entry is not None and entry.type == "str":
+            return format_float(new), "str"
+        return new, "float"
+    if not INT64_MIN <= new <= INT64_MAX:
+        raise HTTPException(status_code=400, detail="ERR increment or decrement would overflow")
+    if entry is not None and entry.type == "str":
+        return str(new), "str"
+    return new, "int"
+
+def write_in_place(user_id: str, keyspace: Keyspace, key: str, entry: Optional[Entry], value: Any,
+                   value_type: str, event: str = "set") -> Entry:
+    # callers have already checked the quota; that may have evicted the key
+    if entry is None or not keyspace.is_current(key, entry):
+        return store_value(user_id, key, value, value_type, None, check_quota=False, event=event)
+    entry.value = value
+    entry.type = value_type
+    keyspace.resize(entry, value_size(value))
+    evictor.touch(entry)
+    propagate(cmd_set(user_id, key, entry))
+    notifier.notify(user_id, STRING, event, key)
+    return entry
+
+def increment(user_id: str, key: str, amount: Union[int, float], as_float: bool = False) -> Union[int, float]:
+    """INCRBY/INCRBYFLOAT on a value key, returns the new number."""
+    check_writable()
+    keyspace, entry, is_file = lookup_key(user_id, key)
+    if is_file and entry is not None:
+        raise HTTPException(status_code=400, detail=WRONGTYPE)
+    keyspace = keyspace or get_or_create_user(user_id)
+    value, value_type = counter_result(entry, counter_value(entry, as_float), amount, as_float)
+    check_storage_limit(keyspace, keyspace.size_delta(key, value_size(value)))
+    write_in_place(user_id, keyspace, key, entry, value, value_type, "incrbyfloat" if as_float else "incrby")
+    return float(value) if as_float else int(value)
+
+@app.post("/user/{user_id}/incr")
+async def incr(user_id: str, key: str):
+    return {"value": increment(user_id, key, 1)}
+
+@app.post("/user/{user_id}/incrby")
+async def incrby(user_id: str, key: str, increment_by: int = Query(1, alias="increment")):
+    return {"value": increment(user_id, key, increment_by)}
+
+@app.post("/user/{user_id}/decr")
+async def decr(user_id: str, key: str):
+    return {"value": increment(user_id, key, -1)}
+
+@app.post("/user/{user_id}/decrby")
+async def decrby(user_id: str, key: str, decrement: int = 1):
+    return {"value": increment(user_id, key, -decrement)}
+
+@app.post("/user/{user_id}/incrbyfloat")
+async def incrbyfloat(user_id: str, key: str, increment_by: float = Query(..., alias="increment")):
+    return {"value": increment(user_id, key, increment_by, as_float=True)}
+
+def replace_value(user_id: str, key: str, value: Any, value_type: str) -> Optional[Tuple[Any, str]]:
+    """GETSET: store the new value keeping the key's expiry, returns the old (value, type)."""
+    check_writable()
+    keyspace, entry, is_file = lookup_key(user_id, key)
+    if entry is not None and (is_file or is_collection(entry.value)):
+        raise HTTPException(status_code=400, detail=WRONGTYPE)
+    old = (entry.value, entry.type) if entry is not None else None
+    keyspace = keyspace or get_or_create_user(user_id)
+    check_storage_limit(keyspace, keyspace.size_delta(key, value_size(value)))
+    write_in_place(user_id, keyspace, key, entry, value, value_type)
+    return old
+
+@app.post("/user/{user_id}/getset")
+async def getset(user_id: str, request: SetRequest):
+    value, value_type = convert_value(request.value, request.type)
+    old = replace_value(user_id, request.key, value, value_type)
+    return {"old": {"value": old[0], "type": old[1]} if old is not None else None, "type": value_type}
+
+@app.post("/user/{user_id}/incrby_batch")
+async def incrby_batch(user_id: str, request: CountersRequest):
+    # All or nothing: every result is worked out before the first key changes.
+    # A key listed twice is bumped twice, in order
+    check_writable()
+    keyspace = get_or_create_user(user_id)
+    staged: Dict[str, Tuple[Optional[Entry], Any, str, str]] = {}
+    values = []
+    for item in request.items:
+        if item.key in staged:
+            entry, value, value_type, _ = staged[item.key]
+            current = Entry(value, value_type)
+        else:
+            _, entry, is_file = lookup_key(user_id, item.key)
+            if is_file and entry is not None:
+                raise HTTPException(status_code=400, detail=f"{item.key}: {WRONGTYPE}")
+            current = entry
+        as_float = isinstance(item.increment, float)
+        try:
+            value, value_type = counter_result(current, counter_value(current, as_float), item.increment, as_float)
+        except HTTPException as e:
+            raise HTTPException(status_code=e.status_code, detail=f"{item.key}: {e.detail}")
+        staged[item.key] = (entry, value, value_type, "incrbyfloat" if as_float else "incrby")
+        values.append(float(value) if as_float else int(value))
+    check_storage_limit(keyspace, sum(keyspace.size_delta(key, value_size(value)) for key, (_, value, _, _) in staged.items()))
+    for key, (entry, value, value_type, event) in staged.items():
+        write_in_place(user_id, keyspace, key, entry, value, value_type, event)
+    return {"values": values}
+
+def scan_keys(user_id: str, cursor: str, match: Optional[str], count: int, type_filter: Optional[str]):
+    try:
+        return scanner.scan(user_id, int(cursor), match, count, type_filter.lower() if type_filter else None)
+    except (InvalidCursor, ValueError):
+        raise HTTPException(status_code=400, detail="ERR invalid cursor")
+
+@app.get("/user/{user_id}/scan")
+async def scan(user_id: str, cursor: str = "0", match: Optional[str] = None, count: int = SCAN_DEFAULT_COUNT,
+               type: Optional[str] = None):
+    # Start with cursor 0 and pass back the returned cursor until it is "0"
+    # again. The cursor is a string so JSON clients don't round it
+    if user_id not in user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    next_cursor, keys = scan_keys(user_id, cursor, match, count, type)
+    return {"cursor": str(next_cursor), "keys": keys}
 
 @app.get("/user/{user_id}/keys")
 async def get_keys(user_id: str):
+    # Every key in one response, use /scan for big tenants
     if user_id not in user_data:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get keys from both regular values and files
-    regular_keys = set(user_data[user_id].keys()) - {'files', 'storage_used', 'subscription'}
-    file_keys = set(user_data[user_id].get('files', {}).keys())
-    
-    return {"keys": list(regular_keys | file_keys)}
+    # Regular values and files, metadata lives apart so nothing to filter out
+    return {"keys": list(user_data[user_id].keys())}
 
-@app.get("/info")
-async def get_info():
-    info = {
+def lookup_key(user_id: str, key: str, read: bool = False):
+    # read=True for lookups of read commands, those count as keyspace hits/misses
+    keyspace = user_data.get(user_id)
+    if keyspace is None:
+        if read:
+            metrics.lookup(False)
+        return None, None, False
+    entry, is_file = keyspace.lookup(key)
+    if entry is not None:
+        if entry.is_expired():
+            expire_now(user_id, keyspace, key, is_file)
+            entry = None
+        else:
+            evictor.touch(entry)
+    if read:
+        metrics.lookup(entry is not None)
+    return keyspace, entry, is_file
+
+def lookup_live(user_id: str, key: str):
+    if user_id not in user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    return lookup_key(user_id, key)
+
+@app.get("/user/{user_id}/ttl")
+async def get_ttl(user_id: str, key: str):
+    # -2 if the key does not exist, -1 if it has no expiry (same as Redis)
+    _, entry, _ = lookup_live(user_id, key)
+    if entry is None:
+        return {"ttl": -2}
+    if entry.expiry is None:
+        return {"ttl": -1}
+    return {"ttl": max(0, round(entry.expiry - time.time()))}
+
+@app.get("/user/{user_id}/pttl")
+async def get_pttl(user_id: str, key: str):
+    _, entry, _ = lookup_live(user_id, key)
+    if entry is None:
+        return {"pttl": -2}
+    if entry.expiry is None:
+        return {"pttl": -1}
+    return {"pttl": max(0, int((entry.expiry - time.time()) * 1000))}
+
+@app.post("/user/{user_id}/expire")
+async def expire_key(user_id: str, key: str, seconds: int):
+    check_writable()
+    keyspace, entry, is_file = lookup_live(user_id, key)
+    if entry is None:
+        return {"response": 0}
+    if seconds <= 0:
+        keyspace.reclaim(key, is_file)
+        propagate(cmd_del(user_id, key, is_file))
+        notifier.notify(user_id, GENERIC, "del", key)
+        return {"response": 1}
+    entry.expiry = time.time() + seconds
+    expirer.schedule(user_id, key, entry, is_file)
+    propagate(cmd_expireat(user_id, key, is_file, entry.expiry))
+    notifier.notify(user_id, GENERIC, "expire", key)
+    return {"response": 1}
+
+@app.post("/user/{user_id}/persist")
+async def persist_key(user_id: str, key: str):
+    check_writable()
+    _, entry, is_file = lookup_live(user_id, key)
+    if entry is None or entry.expiry is None:
+        return {"response": 0}
+    entry.expiry = None
+    propagate(cmd_expireat(user_id, key, is_file, None))
+    notifier.notify(user_id, GENERIC, "persist", key)
+    return {"response": 1}
+
+# Lists, hashes, sets and sorted sets. The commands live in datatypes.py,
+# shared with RESP and AOF replay; the routes only map their parameters
+NOTIFY_CLASSES = {ListValue: LIST, HashValue: HASH, SetValue: SET, ZSet: ZSET}
+
+def run_collection(user_id: str, name: str, key: str, args: List[str]):
+    try:
+        check_arity(name, args)
+        command = COLLECTION_COMMANDS[name]
+        if command.write:
+            check_writable()
+        keyspace, _, _ = lookup_key(user_id, key, read=not command.write)
+        if command.write:
+            keyspace = get_or_create_user(user_id)
+            check_storage_limit(keyspace, growth(name, args))
+        elif keyspace is None:
+            return command.missing
+        reply, changed = run_collection_command(keyspace, key, name, args)
+    except CommandError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if changed:
+        entry = keyspace.get(key)
+        if entry is not None:
+            evictor.touch(entry)
+        propagate(cmd_collection(user_id, key, name, args))
+        notifier.notify(user_id, NOTIFY_CLASSES[command.type], name, key)
+        if entry is None:
+            # popped or removed the last element, the key is gone like in Redis
+            notifier.notify(user_id, GENERIC, "del", key)
+    return reply
+
+def key_type(user_id: str, key: str) -> str:
+    _, entry, is_file = lookup_key(user_id, key)
+    return "none" if entry is None else type_name(entry, is_file)
+
+@app.get("/user/{user_id}/type")
+async def get_type(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"type": key_type(user_id, key)}
+
+@app.post("/user/{user_id}/lpush")
+async def lpush(user_id: str, request: PushRequest):
+    return {"length": run_collection(user_id, "lpush", request.key, request.values)}
+
+@app.post("/user/{user_id}/rpush")
+async def rpush(user_id: str, request: PushRequest):
+    return {"length": run_collection(user_id, "rpush", request.key, request.values)}
+
+@app.post("/user/{user_id}/lpop")
+async def lpop(user_id: str, key: str, count: Optional[int] = None):
+    return {"value": run_collection(user_id, "lpop", key, [] if count is None else [str(count)])}
+
+@app.post("/user/{user_id}/rpop")
+async def rpop(user_id: str, key: str, count: Optional[int] = None):
+    return {"value": run_collection(user_id, "rpop", key, [] if count is None else [str(count)])}
+
+@app.get("/user/{user_id}/lrange")
+async def lrange(user_id: str, key: str, start: int = 0, stop: int = -1):
+    lookup_live(user_id, key)
+    return {"values": run_collection(user_id, "lrange", key, [str(start), str(stop)])}
+
+@app.get("/user/{user_id}/llen")
+async def llen(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"length": run_collection(user_id, "llen", key, [])}
+
+@app.post("/user/{user_id}/hset")
+async def hset(user_id: str, request: HashSetRequest):
+    args = [item for pair in request.fields.items() for item in pair]
+    return {"added": run_collection(user_id, "hset", request.key, args)}
+
+@app.get("/user/{user_id}/hget")
+async def hget(user_id: str, key: str, field: str):
+    lookup_live(user_id, key)
+    return {"value": run_collection(user_id, "hget", key, [field])}
+
+@app.get("/user/{user_id}/hgetall")
+async def hgetall(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"fields": run_collection(user_id, "hgetall", key, [])}
+
+@app.post("/user/{user_id}/hdel")
+async def hdel(user_id: str, request: FieldsRequest):
+    return {"removed": run_collection(user_id, "hdel", request.key, request.fields)}
+
+@app.post("/user/{user_id}/hincrby")
+async def hincrby(user_id: str, key: str, field: str, increment: int = 1):
+    return {"value": run_collection(user_id, "hincrby", key, [field, str(increment)])}
+
+@app.get("/user/{user_id}/hlen")
+async def hlen(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"length": run_collection(user_id, "hlen", key, [])}
+
+@app.post("/user/{user_id}/sadd")
+async def sadd(user_id: str, request: MembersRequest):
+    return {"added": run_collection(user_id, "sadd", request.key, request.members)}
+
+@app.post("/user/{user_id}/srem")
+async def srem(user_id: str, request: MembersRequest):
+    return {"removed": run_collection(user_id, "srem", request.key, request.members)}
+
+@app.get("/user/{user_id}/sismember")
+async def sismember(user_id: str, key: str, member: str):
+    lookup_live(user_id, key)
+    return {"response": run_collection(user_id, "sismember", key, [member])}
+
+@app.get("/user/{user_id}/smembers")
+async def smembers(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"members": sorted(run_collection(user_id, "smembers", key, []))}
+
+@app.get("/user/{user_id}/scard")
+async def scard(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"count": run_collection(user_id, "scard", key, [])}
+
+def set_intersection(user_id: str, keys: List[str]) -> set:
+    sets = []
+    for key in keys:
+        _, entry, is_file = lookup_key(user_id, key)
+        if entry is not None and (is_file or not isinstance(entry.value, SetValue)):
+            raise HTTPException(status_code=400, detail=WRONGTYPE)
+        sets.append(entry.value if entry is not None else None)
+    return sinter(sets)
+
+@app.get("/user/{user_id}/sinter")
+async def sinter_route(user_id: str, keys: List[str] = Query(...)):
+    if user_id not in user_data:
+        raise HTTPException(status_code=404, detail="User not found")
+    return {"members": sorted(set_intersection(user_id, keys))}
+
+@app.post("/user/{user_id}/zadd")
+async def zadd(user_id: str, request: ZAddRequest):
+    args = [item for member, score in request.members.items() for item in (repr(float(score)), member)]
+    return {"added": run_collection(user_id, "zadd", request.key, args)}
+
+@app.post("/user/{user_id}/zrem")
+async def zrem(user_id: str, request: MembersRequest):
+    return {"removed": run_collection(user_id, "zrem", request.key, request.members)}
+
+@app.get("/user/{user_id}/zscore")
+async def zscore(user_id: str, key: str, member: str):
+    lookup_live(user_id, key)
+    return {"score": run_collection(user_id, "zscore", key, [member])}
+
+@app.get("/user/{user_id}/zrank")
+async def zrank(user_id: str, key: str, member: str):
+    lookup_live(user_id, key)
+    return {"rank": run_collection(user_id, "zrank", key, [member])}
+
+@app.get("/user/{user_id}/zrangebyscore")
+async def zrangebyscore(user_id: str, key: str, min: str = "-inf", max: str = "+inf",
+                        withscores: bool = False, offset: int = 0, count: int = -1):
+    # min/max take Redis' syntax: "(1.5" excludes the bound, -inf/+inf
+    lookup_live(user_id, key)
+    args = [min, max, "LIMIT", str(offset), str(count)] + (["WITHSCORES"] if withscores else [])
+    return {"members": run_collection(user_id, "zrangebyscore", key, args)}
+
+@app.get("/user/{user_id}/zcard")
+async def zcard(user_id: str, key: str):
+    lookup_live(user_id, key)
+    return {"count": run_collection(user_id, "zcard", key, [])}
+
+def info_sections() -> Dict[str, Any]:
+    return {
         "server": "FastAPI Server",
         "version": "1.0.0",
         "users_count": len(user_data),
+        "blob_store": blob_store.stats(),
+        "persistence": {**persistence.info(), **aof.info()},
+        "replication": replication.info(),
+        "clients": {**resp_server.info(), "notification_subscribers": len(notifier),
+                    "monitors": len(monitor.subscribers)},
+        "memory": evictor.info(),
+        "stats": {
+            "total_commands_processed": metrics.total_calls,
+            "total_net_input_bytes": metrics.net_input_bytes + resp_server.net_input_bytes,
+            "total_net_output_bytes": metrics.net_output_bytes + resp_server.net_output_bytes,
+            "keyspace_hits": metrics.keyspace_hits,
+            "keyspace_misses": metrics.keyspace_misses,
+            "expired_keys": expirer.expired_keys,
+            "evicted_keys": evictor.evicted_keys,
+            "evicted_keys_soft_limit": evictor.evicted_keys_soft_limit,
+            "tenant_lock_waits": tenant_locks.contended,
+            **pubsub.info(),
+        },
+        "commandstats": metrics.commandstats(),
+        "latencystats": metrics.latencystats(),
+        "keyspace": {user_id: keyspace_info(keyspace) for user_id, keyspace in sorted(user_data.items())},
     }
+
+def keyspace_info(keyspace: Keyspace) -> Dict[str, int]:
+    # like Redis' db0:keys=..,expires=..; counting expires walks the keys
+    expires = sum(1 for e in keyspace.data.values() if e.expiry is not None)
+    expires += sum(1 for e in keyspace.files.values() if e.expiry is not None)
+    return {"keys": len(keyspace), "expires": expires, "files": len(keyspace.files)}
+
+def metric_families():
+    families = metrics.families()
+    tenants = sorted(user_data.items())
+    families += [
+        ("vm_redis_net_input_bytes_total", "counter", "Bytes received",
+         [({"protocol": "http"}, metrics.net_input_bytes), ({"protocol": "resp"}, resp_server.net_input_bytes)]),
+        ("vm_redis_net_output_bytes_total", "counter", "Bytes sent",
+         [({"protocol": "http"}, metrics.net_output_bytes), ({"protocol": "resp"}, resp_server.net_output_bytes)]),
+        ("vm_redis_expired_keys_total", "counter", "Keys removed because their TTL ran out", [({}, expirer.expired_keys)]),
+        ("vm_redis_evicted_keys_total", "counter", "Keys evicted to stay under maxmemory", [({}, evictor.evicted_keys)]),
+        ("vm_redis_used_memory_bytes", "gauge", "RAM held by keys, what maxmemory is checked against",
+         [({}, evictor.used_memory())]),
+        ("vm_redis_maxmemory_bytes", "gauge", "maxmemory, 0 = no limit", [({}, evictor.maxmemory)]),
+        ("vm_redis_connected_clients", "gauge", "Open RESP connections", [({}, len(resp_server.clients))]),
+        ("vm_redis_tenant_lock_waits_total", "counter", "Writes that waited for another write of their tenant",
+         [({}, tenant_locks.contended)]),
+        ("vm_redis_tenants", "gauge", "Tenants", [({}, len(user_data))]),
+        ("vm_redis_tenant_keys", "gauge", "Keys per tenant, files included",
+         [({"tenant": user_id}, len(keyspace)) for user_id, keyspace in tenants]),
+        ("vm_redis_tenant_storage_used_bytes", "gauge", "Bytes counted against the tenant's quota",
+         [({"tenant": user_id}, keyspace.storage_used) for user_id, keyspace in tenants]),
+    ]
+    return families
+
+def key_memory(user_id: str, key: str) -> Optional[int]:
+    _, entry, _ = lookup_key(user_id, key)
+    return None if entry is None else entry_memory(key, entry)
+
+@app.get("/user/{user_id}/memory")
+async def memory_usage(user_id: str, key: str):
+    # MEMORY USAGE: bytes the key holds in RAM, its name and bookkeeping included
+    _, entry, _ = lookup_live(user_id, key)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="Key not found")
+    return {"key": key, "bytes": key_memory(user_id, key)}
+
+@app.get("/info")
+async def get_info(section: Optional[str] = None):
+    info = info_sections()
+    if section:
+        if section.lower() not in info:
+            raise HTTPException(status_code=400, detail=f"Unknown INFO section '{section}'")
+        return {section.lower(): info[section.lower()]}
     return info
 
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text format, scraped like any other exporter
+    return Response(render_prometheus(metric_families()), media_type="text/plain; version=0.0.4")
+
+@app.get("/slowlog")
+async def slowlog_get(count: int = 10):
+    # SLOWLOG GET: newest first, count -1 for all of them
+    return {"entries": [entry.to_dict() for entry in slowlog.get(count)]}
+
+@app.get("/slowlog/len")
+async def slowlog_len():
+    return {"len": len(slowlog)}
+
+@app.post("/slowlog/reset")
+async def slowlog_reset():
+    slowlog.reset()
+    return {"response": "OK"}
+
+# Notifications and MONITOR go out as server-sent events (one JSON object per
+# "data:" line) or as WebSocket text frames. Either way the messages wait in
+# the subscriber's bounded queue, see notify.Subscriber
+KEEPALIVE_SECONDS = 15
+
+def event_stream(subscriber, unsubscribe) -> StreamingResponse:
+    async def events():
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # keeps proxies from closing an idle stream
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {json.dumps(message)}\n\n"
+        finally:
+            unsubscribe()
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def websocket_stream(websocket: WebSocket, subscriber):
+    # clients only listen, a receive() returning is them going away
+    async def closed():
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    watcher = asyncio.ensure_future(closed())
+    try:
+        while True:
+            message = asyncio.ensure_future(subscriber.get())
+            await asyncio.wait({message, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            if watcher.done():
+                message.cancel()
+                return
+            await websocket.send_json(message.result())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        watcher.cancel()
+
+@app.get("/user/{user_id}/notifications")
+async def notifications(user_id: str, pattern: str = "*"):
+    # pattern is a glob over the channel, e.g. __keyevent@*__:expired
+    subscriber = notifier.subscribe(user_id, pattern)
+    return event_stream(subscriber, lambda: notifier.unsubscribe(user_id, subscriber))
+
+async def accept_tenant_websocket(websocket: WebSocket, user_id: str) -> bool:
+    # ShardRouter only forwards HTTP, the owning shard has to be reached directly
+    await websocket.accept()
+    if shards.is_local(user_id):
+        return True
+    await websocket.close(code=1008, reason=f"MOVED {shards.owner(user_id)} port {shards.direct_port(shards.owner(user_id))}")
+    return False
+
+@app.websocket("/user/{user_id}/notifications/ws")
+async def notifications_ws(websocket: WebSocket, user_id: str, pattern: str = "*"):
+    if not await accept_tenant_websocket(websocket, user_id):
+        return
+    subscriber = notifier.subscribe(user_id, pattern)
+    try:
+        await websocket_stream(websocket, subscriber)
+    finally:
+        notifier.unsubscribe(user_id, subscriber)
+
+@app.get("/monitor")
+async def monitor_stream():
+    subscriber = monitor.subscribe()
+    return event_stream(subscriber, lambda: monitor.unsubscribe(subscriber))
+
+@app.websocket("/monitor/ws")
+async def monitor_ws(websocket: WebSocket):
+    await websocket.accept()
+    subscriber = monitor.subscribe()
+    try:
+        await websocket_stream(websocket, subscriber)
+    finally:
+        monitor.unsubscribe(subscriber)
+
+# Pub/Sub over a WebSocket. The client sends JSON requests,
+#   {"op": "subscribe" | "unsubscribe" | "psubscribe" | "punsubscribe", "channels": [...]},
+#   {"op": "publish", "channel": ..., "message": ...} or {"op": "ping"},
+# and gets their replies and the messages in one stream, shaped like redis-py's
+# ({"type": "message", "channel": ..., "data": ...}). A client that lets
+# pubsub_buffer_limit bytes pile up is closed with code 1008
+PUBSUB_OPS = {"subscribe": pubsub.subscribe, "unsubscribe": pubsub.unsubscribe,
+              "psubscribe": pubsub.psubscribe, "punsubscribe": pubsub.punsubscribe}
+
+def pubsub_request(client, request: Any):
+    op = request.get("op") if isinstance(request, dict) else None
+    if op in PUBSUB_OPS:
+        # without channels, unsubscribe leaves them all
+        channels = request.get("channels", [])
+        if isinstance(channels, str):
+            channels = [channels]
+        if not isinstance(channels, list) or not all(isinstance(c, str) for c in channels) or \
+                (not channels and op in ("subscribe", "psubscribe")):
+            client.push({"type": "error", "error": f"ERR '{op}' needs a list of channel names"})
+        elif op in ("unsubscribe", "punsubscribe"):
+            PUBSUB_OPS[op](client, channels or None)
+        else:
+            PUBSUB_OPS[op](client, channels)
+    elif op == "publish" and isinstance(request.get("channel"), str) and isinstance(request.get("message"), str):
+        client.push({"type": "publish", "channel": request["channel"],
+                     "receivers": pubsub.publish(client.user_id, request["channel"], request["message"])})
+    elif op == "ping":
+        client.push({"type": "pong", "data": request.get("message", "")})
+    else:
+        client.push({"type": "error", "error": f"ERR unknown pubsub request {json.dumps(request)[:100]}"})
+
+@app.websocket("/user/{user_id}/pubsub")
+async def pubsub_ws(websocket: WebSocket, user_id: str):
+    if not await accept_tenant_websocket(websocket, user_id):
+        return
+    client = pubsub.connect(user_id)
+
+    async def requests():
+        while True:
+            try:
+                request = await websocket.receive_json()
+            except (ValueError, KeyError):
+                client.push({"type": "error", "error": "ERR requests are JSON text frames"})
+                continue
+            pubsub_request(client, request)
+
+    async def replies():
+        while True:
+            message = await client.get()
+            if message is None:
+                await websocket.close(code=1008, reason="pubsub output buffer limit reached")
+                return
+            await websocket.send_json(message)
+
+    tasks = [asyncio.ensure_future(requests()), asyncio.ensure_future(replies())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # the client going away ends either loop, anything else is a bug
+            if task.exception() is not None and not isinstance(task.exception(), WebSocketDisconnect):
+                logger.error(f"Pub/Sub connection of {user_id} failed: {task.exception()!r}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        pubsub.disconnect(client)
+
+@app.post("/user/{user_id}/publish")
+async def publish(user_id: str, request: PublishRequest):
+    return {"receivers": pubsub.publish(user_id, request.channel, request.message)}
+
+@app.get("/user/{user_id}/pubsub/channels")
+async def pubsub_channels(user_id: str, pattern: Optional[str] = None):
+    # PUBSUB CHANNELS, NUMSUB and NUMPAT in one
+    channels = pubsub.channels(user_id, pattern)
+    return {"channels": pubsub.numsub(user_id, channels), "numpat": pubsub.numpat(user_id)}
+
+def check_debug_enabled():
+    if config["enable_debug_command"] != "yes":
+        raise HTTPException(status_code=403, detail="Debug endpoints are disabled, set enable-debug-command to yes first")
+
+@app.post("/debug/profile")
+async def debug_profile(seconds: float = 10, hz: int = 100, format: str = "collapsed", limit: int = 50):
+    # Samples the event loop for `seconds` while it keeps serving. collapsed
+    # is one "frame;frame;frame count" line per stack for flamegraph.pl or
+    # speedscope, json the functions with the most samples
+    check_debug_enabled()
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or not 0 < hz <= MAX_PROFILE_HZ:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {MAX_PROFILE_SECONDS}], hz in (0, {MAX_PROFILE_HZ}]")
+    if format not in ("collapsed", "json"):
+        raise HTTPException(status_code=400, detail="format must be collapsed or json")
+    try:
+        stacks = await profiler.profile(seconds, hz)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "collapsed":
+        return Response(collapsed_text(stacks), media_type="text/plain")
+    return {"seconds": seconds, "hz": hz, "samples": sum(stacks.values()), "top": top_functions(stacks, limit)}
+
+@app.post("/debug/tracemalloc/start")
+async def debug_tracemalloc_start(frames: int = 1):
+    # Every allocation pays for its traceback until stopped, more frames cost more
+    check_debug_enabled()
+    if not 1 <= frames <= 64:
+        raise HTTPException(status_code=400, detail="frames must be between 1 and 64")
+    if tracemalloc.is_tracing():
+        raise HTTPException(status_code=409, detail="tracemalloc is already tracing")
+    tracemalloc.start(frames)
+    return {"response": "OK"}
+
+@app.post("/debug/tracemalloc/stop")
+async def debug_tracemalloc_stop():
+    check_debug_enabled()
+    tracemalloc.stop()
+    return {"response": "OK"}
+
+@app.get("/debug/memory")
+async def debug_memory(limit: int = 20, group: str = "lineno"):
+    # RAM per tenant and value type, plus the top allocation sites of
+    # everything still alive that was allocated while tracemalloc traced
+    check_debug_enabled()
+    if group not in ("lineno", "filename", "traceback"):
+        raise HTTPException(status_code=400, detail="group must be lineno, filename or traceback")
+    tenants, types = await memory_by_tenant(user_data)
+    report = {"tenants": tenants, "types": types, "tracemalloc": None}
+    if tracemalloc.is_tracing():
+        report["tracemalloc"] = await asyncio.get_running_loop().run_in_executor(None, tracemalloc_report, limit, group)
+    return report
+
+@app.post("/bgsave")
+async def bgsave():
+    if not persistence.bgsave():
+        raise HTTPException(status_code=400, detail="Background save already in progress")
+    return {"response": "Background saving started"}
+
+@app.post("/bgrewriteaof")
+async def bgrewriteaof():
+    if not aof.enabled:
+        raise HTTPException(status_code=400, detail="AOF is disabled, set appendonly to yes first")
+    if not aof.bgrewrite():
+        raise HTTPException(status_code=400, detail="Background append only file rewriting already in progress")
+    return {"response": "Background append only file rewriting started"}
+
+@app.get("/lastsave")
+async def lastsave():
+    return {"lastsave": int(persistence.last_save)}
+
+def remove_key(user_id: str, key: str) -> Optional[bool]:
+    """Delete a value or file key, returns whether it was a file, None if missing."""
+    keyspace = user_data[user_id]
+    if keyspace.delete(key) is not None:
+        propagate(cmd_del(user_id, key))
+        notifier.notify(user_id, GENERIC, "del", key)
+        return False
+    if keyspace.delete_file(key) is not None:
+        propagate(cmd_del(user_id, key, is_file=True))
+        notifier.notify(user_id, GENERIC, "del", key)
+        return True
+    return None
+
 @app.delete("/user/{user_id}/key/{key}")
 async def delete_key(user_id: str, key: str):
+    check_writable()
     if user_id not in user_data:
         raise HTTPException(status_code=404, detail="User not found")
     
-    if key in user_data[user_id]:
-        del user_data[user_id][key]
-        return {"response": f"Key '{key}' deleted successfully"}
-    
-    if 'files' in user_data[user_id] and key in user_data[user_id]['files']:
-        del user_data[user_id]['files'][key]
+    is_file = remove_key(user_id, key)
+    if is_file is None:
+        raise HTTPException(status_code=404, detail="Key not found")
+    if is_file:
         return {"response": f"File key '{key}' deleted successfully"}
-    
-    raise HTTPException(status_code=404, detail="Key not found")
+    return {"response": f"Key '{key}' deleted successfully"}
 @app.delete("/user/{user_id}")
 async def delete_user(user_id: str):
+    check_writable()
     if user_id not in user_data:
         raise HTTPException(status_code=404, detail="User not found")
     
-    del user_data[user_id]
+    user_data.pop(user_id).release_blobs()
+    evictor.forget(user_id)
+    propagate(cmd_deluser(user_id))
     return {"response": f"User '{user_id}' deleted successfully"}
 
 @app.delete("/users")
 async def delete_all_users():
+    check_writable()
     user_data.clear()
+    propagate(cmd_flushall())
+    blob_store.clear()
+    expirer.clear()
+    evictor.forget()
     return {"response": "All users deleted successfully"}
 
+async def set_config(parameter: str, value: str):
+    # redis.conf spells them maxmemory-policy, config keys use underscores
+    parameter = parameter.replace("-", "_")
+    if parameter == "save":
+        try:
+            parse_save_policy(value)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid save policy: {str(e)}")
+    elif parameter == "appendfsync" and value not in FSYNC_POLICIES:
+        raise HTTPException(status_code=400, detail=f"appendfsync must be one of {', '.join(FSYNC_POLICIES)}")
+    elif parameter == "replicaof":
+        set_replicaof(value)
+        return
+    elif parameter == "appendonly":
+        if value not in ("yes", "no"):
+            raise HTTPException(status_code=400, detail="appendonly must be yes or no")
+        if value == "yes" and not aof.enabled:
+            config["appendonly"] = value
+            enable_aof(rewrite=True)
+            if not aof.enabled:
+                raise HTTPException(status_code=500, detail=f"Cannot open {aof.path}")
+        elif value == "no" and aof.enabled:
+            await aof.stop()
+    elif parameter == "maxmemory":
+        try:
+            config[parameter] = str(parse_memory(value))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        # a lower limit takes effect right away, as far as the policy allows
+        try:
+            evictor.make_room()
+        except OutOfMemory:
+            pass
+        return
+    elif parameter == "maxmemory_policy" and value not in EVICTION_POLICIES:
+        raise HTTPException(status_code=400, detail=f"maxmemory-policy must be one of {', '.join(EVICTION_POLICIES)}")
+    elif parameter in ("maxmemory_samples", "lfu_log_factor", "lfu_decay_time", "slowlog_max_len") and not value.isdigit():
+        raise HTTPException(status_code=400, detail=f"{parameter} must be a non-negative integer")
+    elif parameter == "enable_debug_command" and value not in ("yes", "no"):
+        raise HTTPException(status_code=400, detail="enable-debug-command must be yes or no")
+    elif parameter == "slowlog_log_slower_than" and not value.lstrip("-").isdigit():
+        raise HTTPException(status_code=400, detail=f"{parameter} must be an integer")
+    elif parameter == "notify_keyspace_events":
+        try:
+            parse_flags(value)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    elif parameter == "notify_queue_limit" and (not value.isdigit() or int(value) < 1):
+        raise HTTPException(status_code=400, detail=f"{parameter} must be a positive integer")
+    elif parameter == "pubsub_buffer_limit":
+        # new clients get the new limit
+        try:
+            value = str(parse_memory(value))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    config[parameter] = value
+    if parameter.startswith("slowlog_"):
+        slowlog.configure()
+    elif parameter == "notify_keyspace_events":
+        notifier.configure()
+
 @app.post("/config")
-async def config_command(command: str, value: str):
+async def config_command(command: str, value: str, parameter: Optional[str] = None):
     if command.lower() == "set":
-        config[command] = value
+        await set_config(parameter or command, value)
         return {"response": "OK"}
+    elif command.lower() == "get":
+        # value is the parameter name for GET
+        return {value: config.get(value.replace("-", "_"))}
     else:
         raise HTTPException(status_code=400, detail="Invalid CONFIG command")
 
 @app.post("/psync")
 async def psync_command(replica_id: str, offset: int):
-    # Simulate PSYNC command handling
-    return {"response": f"FULLRESYNC {replica_id} {offset}"}
+    # The stream itself is served on the RESP port, this only tells
+    # what a PSYNC with these arguments would get
+    if replication.can_continue(replica_id, offset):
+        return {"response": f"CONTINUE {replication.replid}", "port": config["port"]}
+    return {"response": f"FULLRESYNC {replication.replid} {replication.offset}", "port": config["port"]}
+
+def set_replicaof(value: str):
+    parts = value.split()
+    if not parts or [p.lower() for p in parts] == ["no", "one"]:
+        if replication.is_replica:
+            replication.promote()
+            logger.info("Replication stopped, now a primary")
+        config["replicaof"] = ""
+        return
+    if len(parts) != 2 or not parts[1].isdigit():
+        raise HTTPException(status_code=400, detail="replicaof needs '<host> <port>' or 'no one'")
+    config["replicaof"] = value
+    # shard i of a replica follows shard i of the primary, on port + i
+    port = int(parts[1]) + shards.index
+    replication.replicate_from(parts[0], port)
+    logger.info(f"Replicating from {parts[0]}:{port}")
+
+@app.post("/replicaof")
+async def replicaof(host: str, port: str):
+    set_replicaof(f"{host} {port}")
+    return {"response": "OK"}
+
+def flush_for_full_sync():
+    for keyspace in user_data.values():
+        keyspace.release_blobs()
+    user_data.clear()
+    blob_store.clear()
+    expirer.clear()
+    evictor.forget()
+    persistence.changed()
+    aof.append(cmd_flushall())
+
+def apply_replicated(frame: bytes):
+    # a record from the primary, applied as is and logged to our own AOF
+    payload = memoryview(frame)[FRAME_HEADER_SIZE:]
+    if payload[0] == OP_PING:
+        return
+    touched = apply_command(user_data, payload, spill=blob_store.maybe_spill)
+    if touched is not None:
+        user_id, key, is_file = touched
+        keyspace = user_data[user_id]
+        entry = keyspace.get_file(key) if is_file else keyspace.get(key)
+        expirer.schedule(user_id, key, entry, is_file)
+    persistence.changed()
+    aof.append([frame])
+
+replication.on_flush = flush_for_full_sync
+replication.on_tenant = lambda user_id, loaded: restore_keyspace(user_id, loaded, replicate=False)
+replication.on_record = apply_replicated
+
+def tenant_summary(user_id: str, keyspace: Keyspace) -> Dict[str, Any]:
+    return {"user_id": user_id, **keyspace.summary(), "storage_limit": storage_limit_for(keyspace)}
 
 @app.get("/users")
-async def get_all_users():
-    return user_data
+async def list_users(after: Optional[str] = None, limit: int = 100):
+    # One page of tenant summaries in user id order; pass the returned
+    # "next" as `after` for the following page, it is null on the last one
+    limit = max(1, min(limit, 1000))
+    user_ids = sorted(user_id for user_id in user_data if after is None or user_id > after)
+    page = user_ids[:limit]
+    return {
+        "users": [tenant_summary(user_id, user_data[user_id]) for user_id in page],
+        "next": page[-1] if len(user_ids) > limit else None,
+        "total": len(user_data),
+    }
+
+@app.get("/users/export")
+async def export_users(include_files: bool = False):
+    # NDJSON, one line per record ({"user_id", "meta"} then one per key),
+    # yielding to the event loop between chunks
+    async def lines():
+        out = []
+        for user_id, keyspace in list(user_data.items()):
+            for record in keyspace.iter_export(include_files):
+                out.append(json.dumps({"user_id": user_id, **record}, default=str))
+                if len(out) >= 1000:
+                    yield "\n".join(out) + "\n"
+                    out.clear()
+                    await asyncio.sleep(0)
+        if out:
+            yield "\n".join(out) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/users/{user_id}/exists")
+async def user_exists(user_id: str):
+    return {"exists": user_id in user_data}
+
+@app.get("/users/{user_id}")
+async def get_user_summary(user_id: str):
+    keyspace = user_data.get(user_id)
+    if keyspace is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return tenant_summary(user_id, keyspace)
 
 @app.get("/user/{user_id}/getfile")
-async def get_file(user_id: str, key: str):
+async def get_file(user_id: str, key: str, request: Request):
     try:
         # Check if user and file exist
         if user_id not in user_data:
             raise HTTPException(status_code=404, detail="User not found")
-        if 'files' not in user_data[user_id] or key not in user_data[user_id]['files']:
+        keyspace = user_data[user_id]
+        entry = keyspace.get_file(key)
+        if entry is None:
+            metrics.lookup(False)
             raise HTTPException(status_code=404, detail="File not found")
         
-        data = user_data[user_id]['files'][key]  # Changed this line to look in 'files'
-        
         # Check expiry
-        if data["expiry"] and data["expiry"] < datetime.utcnow():
-            del user_data[user_id]['files'][key]  # Also update this line
+        if entry.is_expired():
+            expire_now(user_id, keyspace, key, True)
+            metrics.lookup(False)
             raise HTTPException(status_code=404, detail="File expired")
+        metrics.lookup(True)
+        
+        size = entry.size
+        etag = etag_for(size, entry.mtime)
+        last_modified = http_date(entry.mtime)
+        headers = {
+            "Content-Disposition": f"attachment; filename={entry.filename or key}",
+            "Accept-Ranges": "bytes",
+            "ETag": etag,
+            "Last-Modified": last_modified,
+        }
         
-        # Decode file content
         try:
-            content = base64.b64decode(data["value"])
-            return StreamingResponse(
-                io.BytesIO(content), 
-                media_type=data.get("content_type", "application/octet-stream"),
-                headers={
-                    "Content-Disposition": f"attachment; filename={data.get('original_filename', key)}"
-                }
-            )
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error retrieving file: {str(e)}")
+            byte_range = None
+            if if_range_matches(request.headers.get("if-range"), etag, last_modified):
+                byte_range = parse_range(request.headers.get("range"), size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+        
+        status_code = 200
+        start, end = 0, size - 1
+        if byte_range is not None:
+            status_code = 206
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        
+        # Stream straight out of the stored buffer, one chunk at a time
+        return StreamingResponse(
+            iter_chunks(entry.content(), start, end),
+            status_code=status_code,
+            media_type=entry.content_type or "application/octet-stream",
+            headers=headers
+        )
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in get_file: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
     
 @app.get("/user/{user_id}/download_rdb")
-async def download_user_rdb(user_id: str, path: Optional[str] = None):
+async def download_user_rdb(user_id: str):
     if user_id not in user_data:
         raise HTTPException(status_code=404, detail="User not found")
     
-    rdb_data = {user_id: user_data[user_id]}
-    rdb_bytes = pickle.dumps(rdb_data)
-    print(rdb_data)
-    # if path:
-    #     with open(path, 'wb') as f:
-    #         f.write(rdb_bytes)
-    #     return {"response": f"RDB file saved to {path}"}
-    
-    return StreamingResponse(io.BytesIO(rdb_bytes), media_type="application/octet-stream", headers={
+    return StreamingResponse(stream_snapshot([(user_id, user_data[user_id])]), media_type="application/octet-stream", headers={
         "Content-Disposition": f"attachment; filename={user_id}_dump.rdb"
     })
 
 @app.get("/download_rdb")
 async def download_all_rdb(path: Optional[str] = None):
-    rdb_bytes = pickle.dumps(user_data)
+    tenants = list(user_data.items())
     
     if path:
-        with open(path, 'wb') as f:
-            f.write(rdb_bytes)
-        return {"response": f"RDB file saved to {path}"}
+        size = await write_snapshot(path, tenants)
+        return {"response": f"RDB file saved to {path}", "bytes": size}
     
-    return StreamingResponse(io.BytesIO(rdb_bytes), media_type="application/octet-stream", headers={
+    return StreamingResponse(stream_snapshot(tenants), media_type="application/octet-stream", headers={
         "Content-Disposition": "attachment; filename=all_users_dump.rdb"
     })
 
+@app.post("/save")
+async def save_rdb():
+    path = os.path.join(config["dir"], config["dbfilename"])
+    size = await write_snapshot(path, list(user_data.items()))
+    return {"response": f"RDB file saved to {path}", "bytes": size}
+
+async def rdb_source(file: Optional[UploadFile], path: Optional[str]):
+    if file:
+        while True:
+            chunk = await file.read(SNAPSHOT_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+    elif path:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(SNAPSHOT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    else:
+        raise HTTPException(status_code=400, detail="Either file or path must be provided")
+
+def restore_keyspace(user_id: str, loaded: Keyspace, replicate: bool = True):
+    spill_files(loaded)
+    if user_id in user_data:
+        user_data[user_id].merge(loaded)
+    else:
+        user_data[user_id] = loaded
+    expirer.schedule_keyspace(user_id, loaded)
+    persistence.changed(len(loaded))
+    replicate = replicate and replication.has_backlog
+    if aof.enabled or replicate:
+        for record in keyspace_records([(user_id, loaded)]):
+            aof.append(record)
+            if replicate:
+                replication.feed(record)
+
+async def restore_rdb(source, only: Optional[str] = None) -> int:
+    """Restore tenants from a snapshot stream as each one completes, returns how many."""
+    restored = 0
+    loader = None
+    legacy = None
+    async for chunk in source:
+        if loader is None and legacy is None:
+            if is_legacy_pickle(chunk):
+                legacy = bytearray()
+            else:
+                loader = SnapshotLoader(only, spill=blob_store.maybe_spill)
+        if legacy is not None:
+            legacy += chunk
+            continue
+        for user_id, loaded in loader.feed(chunk):
+            restore_keyspace(user_id, loaded)
+            restored += 1
+    if legacy is not None:
+        # dumps from before the snapshot format, unpickled with an allowlist
+        for user_id, loaded in load_legacy_pickle(bytes(legacy)).items():
+            if only is None or user_id == only:
+                restore_keyspace(user_id, loaded)
+                restored += 1
+    elif loader is None:
+        raise SnapshotError("RDB file is empty")
+    else:
+        loader.close()
+    return restored
+
 @app.post("/upload_rdb/{user_id}")
 async def upload_user_rdb(user_id: str, file: Optional[UploadFile] = None, path: Optional[str] = None):
+    check_writable()
     try:
-        if file:
-            content = await file.read()
-        elif path:
-            with open(path, 'rb') as f:
-                content = f.read()
-        else:
-            raise HTTPException(status_code=400, detail="Either file or path must be provided")
-        
-        rdb_data = pickle.loads(content)
-        
-        if user_id in rdb_data:
-            user_data[user_id] = {**user_data.get(user_id, {}), **rdb_data[user_id]}
-        else:
+        if not await restore_rdb(rdb_source(file, path), only=user_id):
             raise HTTPException(status_code=400, detail="RDB file does not contain the specified user data")
         
         return {"response": "OK"}
+    except HTTPException:
+        raise
+    except SnapshotError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid RDB file: {str(e)}")
     except Exception as e:
         logger.error(f"Error uploading RDB file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
 
 @app.post("/upload_rdb")
 async def upload_all_rdb(file: Optional[UploadFile] = None, path: Optional[str] = None):
+    check_writable()
     try:
-        if file:
-            content = await file.read()
-        elif path:
-            with open(path, 'rb') as f:
-                content = f.read()
-        else:
-            raise HTTPException(status_code=400, detail="Either file or path must be provided")
-        
-        rdb_data = pickle.loads(content)
-        
-        for user_id, data in rdb_data.items():
-            if user_id in user_data:
-                user_data[user_id] = {**user_data[user_id], **data}
-            else:
-                user_data[user_id] = data
+        await restore_rdb(rdb_source(file, path))
         
         return {"response": "OK"}
+    except HTTPException:
+        raise
+    except SnapshotError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid RDB file: {str(e)}")
     except Exception as e:
         logger.error(f"Error uploading RDB file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {str(e)}")
@@ -379,53 +1680,530 @@ async def upload_all_rdb(file: Optional[UploadFile] = None, path: Optional[str]
 async def get_user_usage(user_id: str):
     if user_id not in user_data:
         # Initialize user with default structure
-        user_data[user_id] = {
-            'files': {},
-            'subscription': 'basic',
-            'storage_used': 0
-        }
-    
-    # Calculate storage from binary files
-    storage_used = 0
-    if 'files' in user_data[user_id]:
-        storage_used = sum(
-            len(base64.b64decode(data["value"]))
-            for data in user_data[user_id]['files'].values()
-            if data.get("type") == "binary"
-        )
+        new_user(user_id)
+    keyspace = user_data[user_id]
     
-    subscription = user_data[user_id].get('subscription', 'basic')
+    subscription = keyspace.meta['subscription']
     storage_limit = USER_SUBSCRIPTIONS[subscription]['storage_limit']
     
     return {
-        "storage_used": storage_used,
+        "storage_used": keyspace.storage_used,
         "storage_limit": storage_limit,
         "subscription": subscription
     }
 @app.post("/user/{user_id}/subscription")
 async def update_subscription(user_id: str, tier: str):
+    check_writable()
     if tier not in USER_SUBSCRIPTIONS:
         raise HTTPException(status_code=400, detail="Invalid subscription tier")
     
-    if user_id not in user_data:
-        check_user_limit()  # Check before creating new user
-        user_data[user_id] = {'files': {}, 'subscription': 'basic', 'storage_used': 0}
+    keyspace = get_or_create_user(user_id)
     
-    # Calculate current storage usage
-    current_usage = user_data[user_id].get('storage_used', 0)
+    # Calculate current storage usage, uploads still streaming in count too
+    current_usage = keyspace.storage_used + keyspace.reserved
     target_limit = USER_SUBSCRIPTIONS[tier]['storage_limit']
     
     # Check if downgrading and storage exceeds new limit
     if (tier == 'basic' and 
-        user_data[user_id].get('subscription') == 'premium' and 
+        keyspace.meta['subscription'] == 'premium' and 
         current_usage > target_limit):
         raise HTTPException(
             status_code=400,
             detail=f"Cannot downgrade: Current storage usage ({current_usage/1024/1024:.2f}MB) exceeds {tier} tier limit ({target_limit/1024/1024:.2f}MB)"
         )
     
-    user_data[user_id]['subscription'] = tier
+    keyspace.meta['subscription'] = tier
+    propagate(cmd_meta(user_id, {"subscription": tier}))
     return {"status": "OK", "subscription": tier}
+
+# Commands a pipeline can run, each maps the command's args onto a route
+PIPELINE_COMMANDS = {
+    "ping": lambda user_id, args: {"response": "PONG"},
+    "echo": lambda user_id, args: echo(user_id, args["message"]),
+    "get": lambda user_id, args: get_value(user_id, args["key"]),
+    "set": lambda user_id, args: set_value(user_id, SetRequest(**args)),
+    "mget": lambda user_id, args: mget_values(user_id, KeysRequest(**args)),
+    "mset": lambda user_id, args: mset_values(user_id, MSetRequest(**args)),
+    "mdel": lambda user_id, args: mdel_keys(user_id, KeysRequest(**args)),
+    "del": lambda user_id, args: delete_key(user_id, args["key"]),
+    "keys": lambda user_id, args: get_keys(user_id),
+    "ttl": lambda user_id, args: get_ttl(user_id, args["key"]),
+    "pttl": lambda user_id, args: get_pttl(user_id, args["key"]),
+    "expire": lambda user_id, args: expire_key(user_id, args["key"], int(args["seconds"])),
+    "persist": lambda user_id, args: persist_key(user_id, args["key"]),
+    "usage": lambda user_id, args: get_user_usage(user_id),
+    "incr": lambda user_id, args: {"value": increment(user_id, args["key"], 1)},
+    "incrby": lambda user_id, args: {"value": increment(user_id, args["key"], int(args.get("increment", 1)))},
+    "decr": lambda user_id, args: {"value": increment(user_id, args["key"], -1)},
+    "decrby": lambda user_id, args: {"value": increment(user_id, args["key"], -int(args.get("decrement", 1)))},
+    "incrbyfloat": lambda user_id, args: {"value": increment(user_id, args["key"], float(args["increment"]), as_float=True)},
+    "getset": lambda user_id, args: getset(user_id, SetRequest(**args)),
+    "incrby_batch": lambda user_id, args: incrby_batch(user_id, CountersRequest(**args)),
+    "type": lambda user_id, args: get_type(user_id, args["key"]),
+    "scan": lambda user_id, args: scan(user_id, str(args.get("cursor", "0")), args.get("match"),
+                                       int(args.get("count", SCAN_DEFAULT_COUNT)), args.get("type")),
+    "sinter": lambda user_id, args: sinter_route(user_id, args["keys"]),
+}
+# collection commands take Redis-style arguments: {"key": ..., "args": [...]}
+for _name in COLLECTION_COMMANDS:
+    PIPELINE_COMMANDS[_name] = lambda user_id, args, name=_name: run_collection(
+        user_id, name, args["key"], [str(arg) for arg in args.get("args", [])])
+
+@app.post("/user/{user_id}/pipeline")
+async def pipeline(user_id: str, request: PipelineRequest):
+    # Commands run in order; one failing does not stop the rest, its error
+    # takes its place in the results
+    results = []
+    for command in request.commands:
+        handler = PIPELINE_COMMANDS.get(command.command.lower())
+        try:
+            if handler is None:
+                raise HTTPException(status_code=400, detail=f"Unknown command '{command.command}'")
+            result = handler(user_id, command.args)
+            if inspect.isawaitable(result):
+                result = await result
+            results.append({"ok": True, "result": result})
+        except HTTPException as e:
+            results.append({"ok": False, "status": e.status_code, "error": e.detail})
+        except (KeyError, TypeError, ValueError) as e:
+            results.append({"ok": False, "status": 400, "error": f"Invalid arguments for '{command.command}': {str(e)}"})
+    return {"results": results}
+
+# RESP commands, same store and helpers as the HTTP routes. HTTPExceptions
+# raised by the shared helpers turn into error replies
+def resp_error(detail: str) -> RespError:
+    # "READONLY ..." keeps its code, anything else becomes an ERR
+    code = detail.split(" ", 1)[0]
+    return RespError(detail if code.isupper() else f"ERR {detail}")
+
+async def resp_await(result):
+    try:
+        return await result
+    except HTTPException as e:
+        raise resp_error(str(e.detail))
+
+def resp_finished(name: str, conn, args: List[bytes], started: float, failed: bool = False):
+    usec = metrics.record("resp", name, started, failed)
+    if monitor.subscribers:
+        monitor.feed([name] + args, conn.addr, conn.user_id)
+    if slowlog.slow(usec):
+        slowlog.add(usec, [name.upper()] + args, conn.addr, conn.name or "", conn.user_id,
+                    sum(len(arg) for arg in args))
+
+async def resp_timed(name: str, conn, args: List[bytes], started: float, result):
+    try:
+        value = await result
+    except Exception:
+        resp_finished(name, conn, args, started, failed=True)
+        raise
+    resp_finished(name, conn, args, started, failed=isinstance(value, RespError))
+    return value
+
+async def resp_locked(handler, conn, args):
+    async with tenant_locks.hold(conn.user_id):
+        try:
+            result = handler(conn, args)
+        except HTTPException as e:
+            raise resp_error(str(e.detail))
+        return await resp_await(result) if inspect.isawaitable(result) else result
+
+# Commands that don't touch the selected tenant's keys, fine on any shard
+SHARD_FREE_COMMANDS = {"PING", "ECHO", "SELECT", "HELLO", "QUIT", "COMMAND", "CLIENT", "INFO", "CONFIG",
+                       "PSYNC", "REPLCONF", "SLOWLOG"}
+
+def moved_error(user_id: str) -> RespError:
+    # like a Redis Cluster redirect: the owning shard's RESP port
+    owner = shards.owner(user_id)
+    return RespError(f"MOVED {owner} {config['bind']}:{int(config['port']) - shards.index + owner}")
+
+def resp_command(*names: str, arity: Optional[int] = None):
+    # arity like Redis' command table: N means exactly N args, -N at least N
+    tenant_free = names[0] in SHARD_FREE_COMMANDS
+    name = names[0].lower()
+    def register(handler):
+        def call(conn, args):
+            if arity is not None and ((arity >= 0 and len(args) != arity) or (arity < 0 and len(args) < -arity)):
+                metrics.reject("resp", name)
+                raise RespError(f"ERR wrong number of arguments for '{name}' command")
+            if not tenant_free and not shards.is_local(conn.user_id):
+                metrics.reject("resp", name)
+                raise moved_error(conn.user_id)
+            started = time.perf_counter()
+            if not tenant_free and tenant_locks.locked(conn.user_id):
+                # an HTTP write of this tenant is between two awaits, queue behind it
+                return resp_timed(name, conn, args, started, resp_locked(handler, conn, args))
+            try:
+                result = handler(conn, args)
+            except Exception as e:
+                resp_finished(name, conn, args, started, failed=True)
+                if isinstance(e, HTTPException):
+                    raise resp_error(str(e.detail))
+                raise
+            if inspect.isawaitable(result):
+                return resp_timed(name, conn, args, started, resp_await(result))
+            resp_finished(name, conn, args, started, failed=isinstance(result, RespError))
+            return result
+        resp_server.command(*names)(call)
+        return handler
+    return register
+
+def resp_value(value: Any):
+    # strings go out as they are, typed values the way JSON spells them
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return value
+    return json.dumps(value)
+
+def decode_resp_value(raw: bytes):
+    try:
+        return raw.decode(), "str"
+    except UnicodeDecodeError:
+        return raw, "bytes"
+
+replica_links: Dict[Any, Any] = {}
+
+@resp_command("PING")
+def resp_ping(conn, args):
+    if len(args) > 1:
+        raise RespError("ERR wrong number of arguments for 'ping' command")
+    return args[0] if args else SimpleString("PONG")
+
+@resp_command("ECHO", arity=1)
+def resp_echo(conn, args):
+    return args[0]
+
+@resp_command("SELECT", arity=1)
+def resp_select(conn, args):
+    conn.user_id = args[0].decode()
+    return OK
+
+@resp_command("HELLO")
+def resp_hello(conn, args):
+    if args:
+        try:
+            proto = int(args[0])
+        except ValueError:
+            raise RespError("ERR Protocol version is not an integer or out of range")
+        if proto not in (2, 3):
+            raise RespError("NOPROTO unsupported protocol version")
+        conn.proto = proto
+    return {
+        "server": "vm_redis",
+        "version": "1.0.0",
+        "proto": conn.proto,
+        "mode": "standalone",
+        "role": "replica" if replication.is_replica else "master",
+        "modules": [],
+    }
+
+@resp_command("QUIT")
+def resp_quit(conn, args):
+    conn.closing = True
+    return OK
+
+@resp_command("COMMAND", "CLIENT")
+def resp_connection_noop(conn, args):
+    # enough for redis-cli/redis-py handshakes: COMMAND DOCS, CLIENT SETINFO
+    if args and args[0].upper() == b"GETNAME":
+        return conn.name
+    if args and args[0].upper() == b"SETNAME" and len(args) == 2:
+        conn.name = args[1].decode()
+    return [] if not args or args[0].upper() in (b"DOCS", b"INFO") else OK
+
+@resp_command("GET", arity=1)
+def resp_get(conn, args):
+    _, entry, is_file = lookup_key(conn.user_id, args[0].decode(), read=True)
+    if entry is None:
+        return None
+    if is_file or is_collection(entry.value):
+        raise RespError(WRONGTYPE)
+    return resp_value(entry.value)
+
+@resp_command("SET", arity=-2)
+def resp_set(conn, args):
+    key = args[0].decode()
+    value, value_type = decode_resp_value(args[1])
+    expiry = None
+    keep_ttl = get_old = False
+    condition = None
+    i = 2
+    try:
+        while i < len(args):
+            option = args[i].upper()
+            if option in (b"EX", b"PX", b"EXAT", b"PXAT") and i + 1 < len(args) and expiry is None:
+                amount = int(args[i + 1])
+                if amount <= 0:
+                    raise RespError("ERR invalid expire time in 'set' command")
+                if option == b"EX":
+                    expiry = time.time() + amount
+                elif option == b"PX":
+                    expiry = time.time() + amount / 1000
+                elif option == b"EXAT":
+                    expiry = float(amount)
+                else:
+                    expiry = amount / 1000
+                i += 2
+                continue
+            if option == b"KEEPTTL":
+                keep_ttl = True
+            elif option in (b"NX", b"XX") and condition is None:
+                condition = option
+            elif option == b"GET":
+                get_old = True
+            else:
+                raise RespError("ERR syntax error")
+            i += 1
+    except ValueError:
+        raise RespError("ERR value is not an integer or out of range")
+    if keep_ttl and expiry is not None:
+        raise RespError("ERR syntax error")
+    _, old, is_file = lookup_key(conn.user_id, key)
+    if get_old and old is not None and (is_file or is_collection(old.value)):
+        raise RespError(WRONGTYPE)
+    if is_file and old is not None:
+        raise RespError(WRONGTYPE)
+    reply = resp_value(old.value) if get_old and old is not None else None
+    if (condition == b"NX" and old is not None) or (condition == b"XX" and old is None):
+        return reply if get_old else None
+    if keep_ttl and old is not None:
+        expiry = old.expiry
+    store_value(conn.user_id, key, value, value_type, expiry)
+    return reply if get_old else OK
+
+@resp_command("MGET", arity=-1)
+def resp_mget(conn, args):
+    values = []
+    for raw in args:
+        _, entry, is_file = lookup_key(conn.user_id, raw.decode(), read=True)
+        values.append(None if entry is None or is_file or is_collection(entry.value) else resp_value(entry.value))
+    return values
+
+@resp_command("MSET", arity=-2)
+def resp_mset(conn, args):
+    if len(args) % 2:
+        raise RespError("ERR wrong number of arguments for 'mset' command")
+    check_writable()
+    keyspace = get_or_create_user(conn.user_id)
+    items = {args[i].decode(): decode_resp_value(args[i + 1]) for i in range(0, len(args), 2)}
+    check_storage_limit(keyspace, sum(keyspace.size_delta(key, value_size(value)) for key, (value, _) in items.items()))
+    for key, (value, value_type) in items.items():
+        store_value(conn.user_id, key, value, value_type, None, check_quota=False)
+    return OK
+
+def resp_int(raw: bytes) -> int:
+    try:
+        value = int(raw)
+    except ValueError:
+        raise RespError(NOT_INTEGER)
+    if not INT64_MIN <= value <= INT64_MAX:
+        raise RespError(NOT_INTEGER)
+    return value
+
+@resp_command("INCR", arity=1)
+def resp_incr(conn, args):
+    return increment(conn.user_id, args[0].decode(), 1)
+
+@resp_command("DECR", arity=1)
+def resp_decr(conn, args):
+    return increment(conn.user_id, args[0].decode(), -1)
+
+@resp_command("INCRBY", arity=2)
+def resp_incrby(conn, args):
+    return increment(conn.user_id, args[0].decode(), resp_int(args[1]))
+
+@resp_command("DECRBY", arity=2)
+def resp_decrby(conn, args):
+    return increment(conn.user_id, args[0].decode(), -resp_int(args[1]))
+
+@resp_command("INCRBYFLOAT", arity=2)
+def resp_incrbyfloat(conn, args):
+    try:
+        amount = float(args[1])
+    except ValueError:
+        raise RespError(NOT_FLOAT)
+    if not math.isfinite(amount):
+        raise RespError(NOT_FLOAT)
+    return format_float(increment(conn.user_id, args[0].decode(), amount, as_float=True))
+
+@resp_command("GETSET", arity=2)
+def resp_getset(conn, args):
+    value, value_type = decode_resp_value(args[1])
+    old = replace_value(conn.user_id, args[0].decode(), value, value_type)
+    return resp_value(old[0]) if old is not None else None
+
+@resp_command("DEL", arity=-1)
+def resp_del(conn, args):
+    check_writable()
+    if conn.user_id not in user_data:
+        return 0
+    deleted = 0
+    for raw in args:
+        key = raw.decode()
+        _, entry, _ = lookup_key(conn.user_id, key)
+        if entry is not None and remove_key(conn.user_id, key) is not None:
+            deleted += 1
+    return deleted
+
+@resp_command("SCAN", arity=-1)
+def resp_scan(conn, args):
+    match, count, type_filter = None, SCAN_DEFAULT_COUNT, None
+    i = 1
+    while i < len(args):
+        option = args[i].upper()
+        if i + 1 >= len(args):
+            raise RespError("ERR syntax error")
+        if option == b"MATCH":
+            match = args[i + 1].decode()
+        elif option == b"COUNT":
+            try:
+                count = int(args[i + 1])
+            except ValueError:
+                raise RespError(NOT_INTEGER)
+            if count < 1:
+                raise RespError("ERR syntax error")
+        elif option == b"TYPE":
+            type_filter = args[i + 1].decode()
+        else:
+            raise RespError("ERR syntax error")
+        i += 2
+    next_cursor, keys = scan_keys(conn.user_id, args[0].decode(), match, count, type_filter)
+    return [str(next_cursor), keys]
+
+@resp_command("TYPE", arity=1)
+def resp_type(conn, args):
+    return SimpleString(key_type(conn.user_id, args[0].decode()))
+
+@resp_command("SINTER", arity=-1)
+def resp_sinter(conn, args):
+    return set_intersection(conn.user_id, [raw.decode() for raw in args])
+
+def resp_collection(name: str):
+    def handler(conn, args):
+        if not args:
+            raise RespError(f"ERR wrong number of arguments for '{name}' command")
+        reply = run_collection(conn.user_id, name, args[0].decode(), [raw.decode() for raw in args[1:]])
+        if name == "zrangebyscore" and conn.proto < 3 and reply and isinstance(reply[0], list):
+            # WITHSCORES pairs go out flat on RESP2, same as Redis
+            reply = [item for pair in reply for item in pair]
+        return reply
+    return handler
+
+for _name in COLLECTION_COMMANDS:
+    resp_command(_name.upper())(resp_collection(_name))
+
+@resp_command("KEYS", arity=1)
+def resp_keys(conn, args):
+    keyspace = user_data.get(conn.user_id)
+    if keyspace is None:
+        return []
+    pattern = args[0].decode()
+    if pattern == "*":
+        return list(keyspace.keys())
+    return [key for key in keyspace.keys() if fnmatch.fnmatchcase(key, pattern)]
+
+@resp_command("INFO")
+def resp_info(conn, args):
+    info = info_sections()
+    wanted = [a.decode().lower() for a in args] or list(info)
+    lines = []
+    for section in wanted:
+        if section not in info:
+            continue
+        lines.append(f"# {section.capitalize()}")
+        fields = info[section] if isinstance(info[section], dict) else {section: info[section]}
+        for name, value in fields.items():
+            if isinstance(value, dict) and not any(isinstance(v, (dict, list)) for v in value.values()):
+                # cmdstat_get:calls=1,usec=5,... like Redis
+                value = ",".join(f"{k}={v}" for k, v in value.items())
+            elif isinstance(value, (dict, list)):
+                value = json.dumps(value, separators=(",", ":"))
+            lines.append(f"{name}:{value}")
+        lines.append("")
+    return "\r\n".join(lines)
+
+@resp_command("MEMORY", arity=-1)
+def resp_memory(conn, args):
+    # MEMORY USAGE <key> [SAMPLES n], sizes are exact here so SAMPLES is ignored
+    if args[0].upper() == b"USAGE" and len(args) in (2, 4):
+        return key_memory(conn.user_id, args[1].decode())
+    raise RespError(f"ERR unknown subcommand or wrong number of arguments for '{args[0].decode()}'")
+
+@resp_command("SLOWLOG", arity=-1)
+def resp_slowlog(conn, args):
+    sub = args[0].upper()
+    if sub == b"GET" and len(args) <= 2:
+        try:
+            count = int(args[1]) if len(args) == 2 else 10
+        except ValueError:
+            raise RespError("ERR value is not an integer or out of range")
+        return [entry.to_resp() for entry in slowlog.get(count)]
+    if sub == b"LEN" and len(args) == 1:
+        return len(slowlog)
+    if sub == b"RESET" and len(args) == 1:
+        slowlog.reset()
+        return OK
+    raise RespError(f"ERR unknown subcommand or wrong number of arguments for '{args[0].decode()}'")
+
+@resp_command("PUBLISH", arity=2)
+def resp_publish(conn, args):
+    return pubsub.publish(conn.user_id, args[0].decode(errors="replace"), args[1].decode(errors="replace"))
+
+@resp_command("PUBSUB", arity=-1)
+def resp_pubsub(conn, args):
+    sub = args[0].upper()
+    if sub == b"CHANNELS" and len(args) <= 2:
+        return pubsub.channels(conn.user_id, args[1].decode() if len(args) == 2 else None)
+    if sub == b"NUMSUB":
+        counts = pubsub.numsub(conn.user_id, [arg.decode() for arg in args[1:]])
+        return [item for channel, count in counts.items() for item in (channel, count)]
+    if sub == b"NUMPAT" and len(args) == 1:
+        return pubsub.numpat(conn.user_id)
+    raise RespError(f"ERR unknown subcommand or wrong number of arguments for '{args[0].decode()}'")
+
+@resp_command("CONFIG", arity=-1)
+def resp_config(conn, args):
+    sub = args[0].upper()
+    if sub == b"GET" and len(args) >= 2:
+        patterns = [a.decode().replace("-", "_") for a in args[1:]]
+        return {name: value for name, value in config.items()
+                if any(fnmatch.fnmatchcase(name, p) for p in patterns)}
+    if sub == b"RESETSTAT" and len(args) == 1:
+        metrics.reset()
+        expirer.expired_keys = 0
+        evictor.evicted_keys = evictor.evicted_keys_soft_limit = evictor.oom_rejected = 0
+        tenant_locks.contended = 0
+        return OK
+    if sub == b"SET" and len(args) >= 3 and len(args) % 2 == 1:
+        async def apply():
+            for i in range(1, len(args), 2):
+                await set_config(args[i].decode(), args[i + 1].decode())
+            return OK
+        return apply()
+    raise RespError(f"ERR unknown subcommand or wrong number of arguments for '{args[0].decode()}'")
+
+@resp_command("PSYNC", arity=2)
+def resp_psync(conn, args):
+    try:
+        offset = int(args[1])
+    except ValueError:
+        raise RespError("ERR value is not an integer or out of range")
+
+    async def sync():
+        link = await replication.serve_psync(conn, args[0].decode(), offset)
+        if link is not None:
+            replica_links[conn] = link
+            conn.on_close.append(lambda: (replication.drop(link), replica_links.pop(conn, None)))
+        return NO_REPLY
+    return sync()
+
+@resp_command("REPLCONF")
+def resp_replconf(conn, args):
+    if len(args) == 2 and args[0].upper() == b"ACK":
+        link = replica_links.get(conn)
+        if link is not None:
+            replication.ack(link, int(args[1]))
+        return NO_REPLY  # acks are never answered
+    return OK
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
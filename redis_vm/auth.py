@@ -55,10 +55,7 @@ async def ReplaceSalt(publickey, data):
 
 async def userExists(publickey):
     try:
-        response = client.get_all_users()
-        if publickey in response:
-            return True        
-        return False
+        return client.user_exists(publickey)
     except Exception as e:
         print(f"Error checking user existence: {e}")
         return False
@@ -0,0 +1,55 @@
+"""Write an AOF of SET records, then time replaying it and rewriting it.
+
+Run from redis_vm/: python bench_aof.py [num_keys] [tenants]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from aof import _rewrite_sync, cmd_create, cmd_set, replay
+from keyspace import Entry
+
+
+def write_log(path, n, tenants):
+    buffer = bytearray()
+    with open(path, "wb") as f:
+        for t in range(tenants):
+            buffer += b"".join(cmd_create(f"user{t}"))
+        expiry = time.time() + 3600
+        for i in range(n):
+            entry = Entry(f"value:{i}", "str", expiry if i % 2 else None)
+            for part in cmd_set(f"user{i % tenants}", f"key:{i}", entry):
+                buffer += part
+            if len(buffer) >= 1024 * 1024:
+                f.write(buffer)
+                buffer.clear()
+        f.write(buffer)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    tenants = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "appendonly.aof")
+        started = time.perf_counter()
+        write_log(path, n, tenants)
+        written = time.perf_counter() - started
+
+        user_data = {}
+        started = time.perf_counter()
+        records = replay(path, user_data)
+        replayed = time.perf_counter() - started
+        keys = sum(len(ks) for ks in user_data.values())
+
+        rewritten_path = os.path.join(directory, "rewritten.aof")
+        started = time.perf_counter()
+        _rewrite_sync(rewritten_path, list(user_data.items()))
+        rewritten = time.perf_counter() - started
+
+        print(f"records:         {records}")
+        print(f"keys loaded:     {keys}")
+        print(f"aof size:        {os.path.getsize(path) / 1024 / 1024:.1f} MB")
+        print(f"write:           {written:.2f}s")
+        print(f"replay:          {replayed:.2f}s ({records / replayed:,.0f} records/s)")
+        print(f"rewrite:         {rewritten:.2f}s ({os.path.getsize(rewritten_path) / 1024 / 1024:.1f} MB)")
@@ -0,0 +1,126 @@
+"""Thousands of concurrent uploads, sets and counter bumps against a few tenants.
+
+Runs the app in-process over httpx's ASGI transport with small tier limits so
+uploads keep running into the quota, while other requests of the same tenant
+delete files, overwrite them and flip the tier. Request bodies arrive in
+several pieces, so a tenant's requests overlap while one of them holds the
+lock, and the run fails unless some of them had to wait for it. After every
+response and at the end it checks that no tenant is over its limit, that
+storage_used and memory match the stored entries, that no upload bytes stay
+reserved and that every acknowledged INCR is in the counter. Then the same
+load runs with the per-tenant locks switched off to compare throughput.
+
+Run from redis_vm/: python bench_concurrency.py [requests] [tenants]
+"""
+import asyncio
+import json
+import random
+import sys
+import time
+from contextlib import asynccontextmanager
+
+import httpx
+
+import app as server
+
+BASIC_LIMIT = 2_000_000
+PREMIUM_LIMIT = 4_000_000
+FILE_KEYS = 8
+BOUNDARY = "stressboundary"
+CHUNK = 64 * 1024
+
+
+@asynccontextmanager
+async def no_lock(user_id):
+    yield
+
+
+def multipart(key, size):
+    return (f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"key\"\r\n\r\n{key}\r\n"
+            f"--{BOUNDARY}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"blob.bin\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + b"x" * size + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+async def trickle(body, chunk=CHUNK):
+    # the body arrives in chunks like off a socket, other requests run in between
+    for i in range(0, len(body), chunk):
+        await asyncio.sleep(0)
+        yield body[i:i + chunk]
+
+
+def check_tenant(user_id):
+    keyspace = server.user_data.get(user_id)
+    if keyspace is None:
+        return
+    limit = server.storage_limit_for(keyspace)
+    assert keyspace.storage_used <= limit, f"{user_id} uses {keyspace.storage_used} of {limit}"
+
+
+async def one_request(client, user_id, acked):
+    op = random.random()
+    if op < 0.35:
+        body = multipart(f"f{random.randrange(FILE_KEYS)}", random.randrange(50_000, 400_000))
+        response = await client.post(f"/user/{user_id}/setfile", content=trickle(body),
+                                     headers={"content-type": f"multipart/form-data; boundary={BOUNDARY}"})
+    elif op < 0.5:
+        response = await client.delete(f"/user/{user_id}/key/f{random.randrange(FILE_KEYS)}")
+    elif op < 0.75:
+        body = json.dumps({"key": f"k{random.randrange(32)}", "value": "v" * random.randrange(1, 20_000)}).encode()
+        # in four pieces: the tenant lock is held while they come in
+        response = await client.post(f"/user/{user_id}/set", content=trickle(body, -(-len(body) // 4)),
+                                     headers={"content-type": "application/json"})
+    elif op < 0.95:
+        response = await client.post(f"/user/{user_id}/incr", params={"key": "counter"})
+        if response.status_code == 200:
+            acked[user_id] += 1
+    else:
+        tier = random.choice(("basic", "premium"))
+        response = await client.post(f"/user/{user_id}/subscription", params={"tier": tier})
+    # 400 is a refused write (over quota, can't downgrade), anything else is a bug
+    assert response.status_code in (200, 400, 404), (response.status_code, response.text)
+    check_tenant(user_id)
+
+
+async def run(requests, tenants, locked=True):
+    server.user_data.clear()
+    server.expirer.clear()
+    server.evictor.forget()
+    server.tenant_locks.contended = 0
+    if locked:
+        server.tenant_locks.__dict__.pop("hold", None)
+    else:
+        server.tenant_locks.hold = no_lock
+    users = [f"stress{i}" for i in range(tenants)]
+    acked = {user_id: 0 for user_id in users}
+    transport = httpx.ASGITransport(app=server.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=None) as client:
+        for user_id in users:
+            await client.post("/signup", json={"public_key": user_id})
+        start = time.perf_counter()
+        await asyncio.gather(*(one_request(client, random.choice(users), acked) for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    for user_id in users:
+        keyspace = server.user_data[user_id]
+        keyspace.check_consistency()
+        check_tenant(user_id)
+        assert keyspace.reserved == 0, f"{user_id} still has {keyspace.reserved} bytes reserved"
+        counter = keyspace.get("counter")
+        assert (counter.value if counter else 0) == acked[user_id], f"{user_id} lost increments"
+    assert len(server.tenant_locks) == 0, "locks left behind"
+    return requests / elapsed, server.tenant_locks.contended
+
+
+if __name__ == "__main__":
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    tenants = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    server.USER_SUBSCRIPTIONS["basic"]["storage_limit"] = BASIC_LIMIT
+    server.USER_SUBSCRIPTIONS["premium"]["storage_limit"] = PREMIUM_LIMIT
+    # keep every upload in RAM, no blob directory needed
+    server.blob_store.spill_threshold = 1 << 62
+    locked, contended = asyncio.run(run(requests, tenants))
+    assert contended > 0, "no request waited for a tenant lock, the run proves nothing"
+    print(f"{requests} requests over {tenants} tenants, invariants held under contention")
+    print(f"with tenant locks:    {locked:.0f} req/s ({contended} waits for a lock)")
+    unlocked, _ = asyncio.run(run(requests, tenants, locked=False))
+    print(f"without tenant locks: {unlocked:.0f} req/s ({locked / unlocked:.2f}x)")
@@ -0,0 +1,46 @@
+"""Bytes-per-key of the legacy nested-dict layout vs the Keyspace/Entry layout.
+
+Run from redis_vm/: python bench_memory.py [num_keys]
+"""
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from keyspace import Keyspace
+
+
+def build_legacy(n):
+    store = {"files": {}, "subscription": "basic", "storage_used": 0, "salt": None}
+    expiry = datetime.utcnow() + timedelta(seconds=60)
+    for i in range(n):
+        store[f"key:{i}"] = {"value": i, "expiry": expiry if i % 2 else None, "type": "int"}
+    return store
+
+
+def build_keyspace(n):
+    ks = Keyspace()
+    expiry = time.time() + 60
+    for i in range(n):
+        ks.set(f"key:{i}", i, "int", expiry if i % 2 else None)
+    return ks
+
+
+def measure(builder, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = builder(n)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return (after - before) / n
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    legacy = measure(build_legacy, n)
+    compact = measure(build_keyspace, n)
+    print(f"keys:            {n}")
+    print(f"legacy dict:     {legacy:.1f} bytes/key")
+    print(f"Keyspace/Entry:  {compact:.1f} bytes/key")
+    print(f"reduction:       {100 * (1 - compact / legacy):.1f}%")
@@ -0,0 +1,120 @@
+"""Pub/Sub throughput against the number of subscribers and patterns.
+
+Runs the PubSub hub in-process: each subscriber is a task taking messages
+off its PubSubClient, the way the WebSocket endpoint does before sending
+them, so the numbers are the hub's fan-out cost without the network.
+
+1. One channel with 1 to 10000 subscribers: messages published and
+   delivered per second.
+2. Up to 10000 patterns on a tenant: cost of finding the matches of one
+   publish with the glob trie, against fnmatch over every pattern.
+3. A subscriber that never reads is disconnected once its buffer is over
+   pubsub_buffer_limit, the others keep getting everything.
+
+Run from redis_vm/: python bench_pubsub.py [deliveries]
+"""
+import asyncio
+import fnmatch
+import sys
+import time
+
+from pubsub import MESSAGE_OVERHEAD, GlobTrie, PubSub
+
+SUBSCRIBERS = (1, 10, 100, 1000, 10000)
+PATTERNS = (10, 100, 1000, 10000)
+# publishes between two yields to the consumers
+BATCH = 64
+PAYLOAD = "x" * 64
+
+
+async def consume(client, counts, index):
+    while await client.get() is not None:
+        counts[index] += 1
+
+
+async def fan_out(subscribers: int, deliveries: int):
+    hub = PubSub({"pubsub_buffer_limit": "0"})
+    clients = [hub.connect("bench") for _ in range(subscribers)]
+    for client in clients:
+        hub.subscribe(client, ["events"])
+        client.queue.clear()  # the subscribe reply
+    counts = [0] * subscribers
+    consumers = [asyncio.ensure_future(consume(client, counts, i)) for i, client in enumerate(clients)]
+    messages = max(BATCH, deliveries // subscribers)
+    start = time.perf_counter()
+    for i in range(messages):
+        hub.publish("bench", "events", PAYLOAD)
+        if i % BATCH == BATCH - 1:
+            await asyncio.sleep(0)
+    while sum(counts) < messages * subscribers:
+        await asyncio.sleep(0)
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        hub.disconnect(client)
+    await asyncio.gather(*consumers)
+    return messages / elapsed, messages * subscribers / elapsed
+
+
+def pattern_match(patterns: int, publishes: int = 2000):
+    # half the patterns look like the channel, few of them match it
+    globs = [f"sensor.{i}.*" for i in range(patterns // 2)]
+    globs += [f"room.{i}.t?mp" for i in range(patterns - patterns // 2)]
+    trie = GlobTrie()
+    for glob in globs:
+        trie.add(glob)
+    channel = "sensor.7.temperature"
+    start = time.perf_counter()
+    for _ in range(publishes):
+        matched = trie.match(channel)
+    trie_usec = (time.perf_counter() - start) * 1e6 / publishes
+    start = time.perf_counter()
+    for _ in range(publishes):
+        linear = [glob for glob in globs if fnmatch.fnmatchcase(channel, glob)]
+    linear_usec = (time.perf_counter() - start) * 1e6 / publishes
+    assert sorted(matched) == sorted(linear), (matched, linear)
+    return trie_usec, linear_usec
+
+
+async def slow_consumer(subscribers: int = 10, limit: int = 1 << 20):
+    hub = PubSub({"pubsub_buffer_limit": str(limit)})
+    clients = [hub.connect("bench") for _ in range(subscribers + 1)]
+    for client in clients:
+        hub.subscribe(client, ["events"])
+    stuck, readers = clients[0], clients[1:]
+    counts = [0] * subscribers
+    consumers = [asyncio.ensure_future(consume(client, counts, i)) for i, client in enumerate(readers)]
+    payload = "x" * 1024
+    messages = 4 * limit // len(payload)
+    for i in range(messages):
+        hub.publish("bench", "events", payload)
+        if i % BATCH == BATCH - 1:
+            await asyncio.sleep(0)
+    while min(counts) < messages + 1:  # and the subscribe reply
+        await asyncio.sleep(0)
+    assert stuck.closed and not stuck.subscriptions, "the slow subscriber is still there"
+    assert stuck.buffered == 0 and not stuck.queue
+    for client in readers:
+        hub.disconnect(client)
+    await asyncio.gather(*consumers)
+    # messages it could hold before going over the limit
+    return (limit // (MESSAGE_OVERHEAD + len("events") + len(payload))), messages, hub.slow_disconnects
+
+
+async def main(deliveries: int):
+    print(f"{'subscribers':>11}  {'published/s':>12}  {'delivered/s':>12}")
+    for subscribers in SUBSCRIBERS:
+        published, delivered = await fan_out(subscribers, deliveries)
+        print(f"{subscribers:>11}  {published:>12.0f}  {delivered:>12.0f}")
+    print()
+    print(f"{'patterns':>11}  {'trie us/pub':>12}  {'fnmatch us/pub':>14}")
+    for patterns in PATTERNS:
+        trie_usec, linear_usec = pattern_match(patterns)
+        print(f"{patterns:>11}  {trie_usec:>12.2f}  {linear_usec:>14.2f}")
+    print()
+    held, sent, disconnects = await slow_consumer()
+    print(f"slow consumer closed after ~{held} of {sent} messages ({disconnects} disconnect), "
+          f"the other subscribers got all of them")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000))
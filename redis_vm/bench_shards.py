@@ -0,0 +1,96 @@
+"""Requests per second of one shard vs N shards.
+
+Starts sharding.py with 1 and then N shards and drives SET/GET requests for
+a set of tenants from `clients` load processes over keep-alive connections,
+once through the shared port (half the requests or more get forwarded) and
+once going to each tenant's shard directly like KeyValueClient(shard_aware=True).
+The load processes need cores too, so run it on a box with more cores than
+shards to see the scaling.
+
+Run from redis_vm/: python bench_shards.py [shards] [seconds] [clients]
+"""
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import zlib
+
+PORT = 18000
+TENANTS = 8
+
+
+def connect(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port)
+    conn.connect()
+    # http.client sends headers and body separately, don't let Nagle hold the body back
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return conn
+
+
+def load(ports, seconds, results):
+    # ports: one per shard when going direct, else just the shared one
+    conns = [connect(port) for port in ports]
+    body = json.dumps({"key": "k", "value": "x" * 100})
+    done = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        user = f"bench{random.randrange(TENANTS)}"
+        conn = conns[zlib.crc32(user.encode()) % len(conns)]
+        if done % 2:
+            conn.request("GET", f"/user/{user}/get?key=k")
+        else:
+            conn.request("POST", f"/user/{user}/set", body, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        done += 1
+    results.put(done)
+
+
+def wait_ready(port):
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/lastsave")
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def run(shards, seconds, clients, direct=False):
+    server = subprocess.Popen([sys.executable, "sharding.py", "--shards", str(shards), "--host", "127.0.0.1",
+                               "--port", str(PORT)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(PORT)
+        results = multiprocessing.Queue()
+        ports = [PORT + 1 + i for i in range(shards)] if direct else [PORT]
+        workers = [multiprocessing.Process(target=load, args=(ports, seconds, results)) for _ in range(clients)]
+        for worker in workers:
+            worker.start()
+        total = sum(results.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        return total / seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    shards = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 2
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 2 * shards
+    single = run(1, seconds, clients)
+    forwarded = run(shards, seconds, clients)
+    direct = run(shards, seconds, clients, direct=True)
+    print(f"clients:               {clients}, {TENANTS} tenants, {seconds:.0f}s each")
+    print(f"1 shard:               {single:.0f} req/s")
+    print(f"{shards} shards, shared port: {forwarded:.0f} req/s ({forwarded / single:.2f}x)")
+    print(f"{shards} shards, direct:      {direct:.0f} req/s ({direct / single:.2f}x)")
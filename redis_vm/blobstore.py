@@ -0,0 +1,281 @@
+import asyncio
+import logging
+import mmap
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+# Segments are preallocated at this size; a blob bigger than that gets a
+# segment of its own
+SEGMENT_SIZE = 64 * 1024 * 1024
+# A sealed segment is rewritten once at least this share of it is dead
+COMPACT_DEAD_RATIO = 0.5
+
+
+class BlobRef:
+    """Location of a spilled file blob. Compaction moves it by updating it in place."""
+
+    __slots__ = ("store", "segment", "offset", "length")
+
+    def __init__(self, store: "BlobStore", segment: int, offset: int, length: int):
+        self.store = store
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self) -> Union[bytes, memoryview]:
+        return self.store.read(self)
+
+    def free(self):
+        self.store.free(self)
+
+    def __reduce__(self):
+        # a ref only means something to the running store, pickle the content
+        return bytes, (bytes(self.read()),)
+
+
+class _Segment:
+    __slots__ = ("id", "path", "fd", "map", "size", "tail", "live", "refs", "pending", "compacting", "orphaned")
+
+    def __init__(self, segment_id: int, path: str, size: int):
+        self.id = segment_id
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.size = size
+        self.tail = 0  # append offset
+        self.live = 0  # bytes still referenced
+        self.refs: Set[BlobRef] = set()
+        self.pending = 0  # bytes a running compaction is copying in
+        self.compacting = False  # its blobs are being copied out
+        self.orphaned = False  # dropped by clear() while a copy still uses it
+
+    @property
+    def busy(self) -> bool:
+        return self.compacting or self.pending > 0
+
+    def close(self):
+        os.close(self.fd)
+        try:
+            # buffers still streaming out of the segment keep it mapped
+            self.map.close()
+        except BufferError:
+            pass
+        os.unlink(self.path)
+
+
+class BlobStore:
+    """Append-only segment files for large file blobs, read back through mmap.
+
+    Only the index (the BlobRef objects held by FileEntry) lives in memory,
+    plus an LRU cache of recently read blobs bounded by `cache_bytes`.
+    """
+
+    def __init__(self, directory: str, spill_threshold: int = 1024 * 1024,
+                 cache_bytes: int = 128 * 1024 * 1024):
+        self.directory = directory
+        self.spill_threshold = spill_threshold
+        self.cache_bytes = cache_bytes
+        self.segments: Dict[int, _Segment] = {}
+        self.active: Optional[_Segment] = None
+        self.next_segment = 0
+        self.cache: "OrderedDict[BlobRef, bytes]" = OrderedDict()
+        self.cached_bytes = 0
+        self.disabled = False
+        self.compactions = 0
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _open_dir(self) -> bool:
+        if self.disabled:
+            return False
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # segments don't survive a restart, the index was in memory
+            for name in os.listdir(self.directory):
+                if name.endswith(".seg"):
+                    os.unlink(os.path.join(self.directory, name))
+        except OSError as e:
+            logger.error(f"Blob spill directory {self.directory} unusable, keeping files in RAM: {str(e)}")
+            self.disabled = True
+            return False
+        return True
+
+    def _new_segment(self, min_size: int) -> _Segment:
+        if not self.segments and not self._open_dir():
+            raise OSError("blob store disabled")
+        segment_id = self.next_segment
+        self.next_segment += 1
+        path = os.path.join(self.directory, f"{segment_id:08d}.seg")
+        segment = _Segment(segment_id, path, max(SEGMENT_SIZE, min_size))
+        self.segments[segment_id] = segment
+        return segment
+
+    def _reserve(self, length: int) -> Tuple[_Segment, int]:
+        """Room for `length` bytes, returns the segment and offset."""
+        segment = self.active
+        if segment is None or segment.tail + length > segment.size:
+            segment = self._new_segment(length)
+            if length <= SEGMENT_SIZE or self.active is None:
+                sealed, self.active = self.active, segment
+                # nothing looks at a sealed segment again unless a free() does
+                if sealed is not None:
+                    self._check(sealed)
+        offset = segment.tail
+        segment.tail += length
+        return segment, offset
+
+    def put(self, data) -> BlobRef:
+        segment, offset = self._reserve(len(data))
+        os.pwrite(segment.fd, data, offset)
+        ref = BlobRef(self, segment.id, offset, len(data))
+        segment.live += len(data)
+        segment.refs.add(ref)
+        return ref
+
+    def maybe_spill(self, data) -> Union[bytes, bytearray, BlobRef]:
+        """Move a blob above the threshold to disk, smaller ones stay as they are."""
+        if self.disabled or isinstance(data, BlobRef) or len(data) < self.spill_threshold:
+            return data
+        try:
+            return self.put(data)
+        except OSError as e:
+            logger.error(f"Error spilling blob to disk: {str(e)}")
+            return data
+
+    def read(self, ref: BlobRef) -> Union[bytes, memoryview]:
+        cached = self.cache.get(ref)
+        if cached is not None:
+            self.cache.move_to_end(ref)
+            return cached
+        segment = self.segments[ref.segment]
+        view = memoryview(segment.map)[ref.offset:ref.offset + ref.length]
+        # Blobs that would crowd out most of the cache are served from the map
+        if ref.length > self.cache_bytes // 4:
+            return view
+        data = bytes(view)
+        view.release()
+        self.cache[ref] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.cache_bytes:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+        return data
+
+    def _uncache(self, ref: BlobRef):
+        data = self.cache.pop(ref, None)
+        if data is not None:
+            self.cached_bytes -= len(data)
+
+    def free(self, ref: BlobRef):
+        segment = self.segments.get(ref.segment)
+        if segment is None or ref not in segment.refs:
+            return
+        self._uncache(ref)
+        segment.refs.discard(ref)
+        segment.live -= ref.length
+        self._check(segment)
+
+    def _check(self, segment: _Segment):
+        # a sealed segment with nothing live goes, a mostly dead one is compacted
+        if segment is self.active or segment.busy or self.segments.get(segment.id) is not segment:
+            return
+        if segment.live == 0:
+            self._drop(segment)
+        elif segment.live <= segment.tail * (1 - COMPACT_DEAD_RATIO):
+            self.compact(segment)
+
+    def _drop(self, segment: _Segment):
+        del self.segments[segment.id]
+        segment.close()
+
+    def compact(self, segment: _Segment):
+        """Copy the live blobs of a segment to the active one and drop it.
+
+        On the event loop the copy runs in a thread. Until it is done the
+        refs keep pointing at the old copy, which stays readable; blobs freed
+        meanwhile are simply not moved.
+        """
+        segment.compacting = True
+        moves = []
+        for ref in list(segment.refs):
+            target, offset = self._reserve(ref.length)
+            target.pending += ref.length
+            moves.append((ref, target, offset))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._copy(segment, moves)
+            self._finish_compaction(segment, moves)
+            return
+        task = loop.create_task(self._compact_in_thread(segment, moves))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def _copy(segment: _Segment, moves: List[Tuple[BlobRef, _Segment, int]]):
+        for ref, target, offset in moves:
+            os.pwrite(target.fd, segment.map[ref.offset:ref.offset + ref.length], offset)
+
+    async def _compact_in_thread(self, segment: _Segment, moves: List[Tuple[BlobRef, _Segment, int]]):
+        try:
+            await asyncio.to_thread(self._copy, segment, moves)
+        except OSError as e:
+            logger.error(f"Error compacting blob segment {segment.path}: {str(e)}")
+            for ref, target, _ in moves:
+                target.pending -= ref.length
+            segment.compacting = False
+            self._close_orphans(segment, moves)
+            return
+        self._finish_compaction(segment, moves)
+
+    def _finish_compaction(self, segment: _Segment, moves: List[Tuple[BlobRef, _Segment, int]]):
+        segment.compacting = False
+        for ref, target, offset in moves:
+            target.pending -= ref.length
+            if ref in segment.refs and not segment.orphaned:
+                ref.segment, ref.offset = target.id, offset
+                target.live += ref.length
+                target.refs.add(ref)
+        if self._close_orphans(segment, moves):
+            return
+        self._drop(segment)
+        self.compactions += 1
+        for target in {target for _, target, _ in moves}:
+            self._check(target)
+
+    @staticmethod
+    def _close_orphans(segment: _Segment, moves) -> bool:
+        # clear() ran during the copy, close what it left to us
+        if not segment.orphaned:
+            return False
+        for orphan in {segment, *(target for _, target, _ in moves)}:
+            if orphan.orphaned and not orphan.busy:
+                orphan.orphaned = False
+                orphan.close()
+        return True
+
+    def clear(self):
+        for segment in list(self.segments.values()):
+            if segment.busy:
+                segment.orphaned = True
+            else:
+                segment.close()
+        self.segments.clear()
+        self.active = None
+        self.cache.clear()
+        self.cached_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "segments": len(self.segments),
+            "disk_bytes": sum(s.tail for s in self.segments.values()),
+            "live_bytes": sum(s.live for s in self.segments.values()),
+            "cached_bytes": self.cached_bytes,
+            "compactions": self.compactions,
+        }
@@ -0,0 +1,150 @@
+"""Binary field encoding shared by the snapshot and append-only file formats."""
+import json
+import struct
+from typing import Any, Optional, Tuple
+
+from datatypes import HashValue, ListValue, SetValue, ZSet
+
+U16 = struct.Struct(">H")
+U32 = struct.Struct(">I")
+U64 = struct.Struct(">Q")
+F64 = struct.Struct(">d")
+
+# How a value's bytes are encoded
+ENC_JSON = 0
+ENC_BYTES = 1
+ENC_STR = 2  # plain utf-8, skips json for the most common value type
+# collections: u32 count, then the items as strings (and f64 scores)
+ENC_LIST = 3
+ENC_HASH = 4
+ENC_SET = 5
+ENC_ZSET = 6
+
+_NONE_STR = 0xFFFFFFFF
+
+
+class DecodeError(Exception):
+    pass
+
+
+def pack_str(value: Optional[str]) -> bytes:
+    # u32 0xFFFFFFFF marks None
+    if value is None:
+        return U32.pack(_NONE_STR)
+    data = value.encode()
+    return U32.pack(len(data)) + data
+
+
+def pack_float(value: Optional[float]) -> bytes:
+    if value is None:
+        return b"\x00"
+    return b"\x01" + F64.pack(value)
+
+
+def encode_value(value: Any) -> Tuple[int, bytes]:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return ENC_BYTES, bytes(value)
+    if type(value) is str:
+        return ENC_STR, value.encode()
+    if isinstance(value, (ListValue, SetValue)):
+        return ENC_LIST if isinstance(value, ListValue) else ENC_SET, _pack_strs(len(value), value)
+    if isinstance(value, HashValue):
+        return ENC_HASH, _pack_strs(len(value), (s for item in value.items() for s in item))
+    if isinstance(value, ZSet):
+        parts = [U32.pack(len(value))]
+        for member, score in value:
+            parts.append(pack_str(member))
+            parts.append(F64.pack(score))
+        return ENC_ZSET, b"".join(parts)
+    return ENC_JSON, json.dumps(value, separators=(",", ":")).encode()
+
+
+def decode_value(encoding: int, data: memoryview) -> Any:
+    if encoding == ENC_STR:
+        return str(data, "utf-8")
+    if encoding == ENC_BYTES:
+        return bytes(data)
+    if encoding == ENC_JSON:
+        return json.loads(str(data, "utf-8"))
+    if encoding in (ENC_LIST, ENC_SET, ENC_HASH, ENC_ZSET):
+        return _decode_collection(encoding, Cursor(data))
+    raise DecodeError(f"Unknown value encoding {encoding}")
+
+
+def _pack_strs(count: int, items) -> bytes:
+    return U32.pack(count) + b"".join(pack_str(item) for item in items)
+
+
+def _decode_collection(encoding: int, cur: "Cursor") -> Any:
+    count = cur.u32()
+    if encoding == ENC_LIST:
+        return ListValue(cur.str() for _ in range(count))
+    if encoding == ENC_SET:
+        return SetValue(cur.str() for _ in range(count))
+    if encoding == ENC_HASH:
+        value = HashValue()
+        for _ in range(count):
+            field = cur.str()
+            value[field] = cur.str()
+        return value
+    return ZSet((cur.str(), cur.f64()) for _ in range(count))
+
+
+class Cursor:
+    """Reads fields back out of a record payload."""
+
+    __slots__ = ("buf", "pos")
+
+    def __init__(self, buf: memoryview):
+        self.buf = buf
+        self.pos = 0
+
+    def take(self, n: int) -> memoryview:
+        if self.pos + n > len(self.buf):
+            raise DecodeError("Truncated record payload")
+        out = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return out
+
+    def _unpack(self, fmt: struct.Struct):
+        # fixed-size fields are read in place, no slice per field
+        try:
+            (value,) = fmt.unpack_from(self.buf, self.pos)
+        except struct.error:
+            raise DecodeError("Truncated record payload")
+        self.pos += fmt.size
+        return value
+
+    def str(self) -> Optional[str]:
+        length = self._unpack(U32)
+        if length == _NONE_STR:
+            return None
+        end = self.pos + length
+        if end > len(self.buf):
+            raise DecodeError("Truncated record payload")
+        value = str(self.buf[self.pos:end], "utf-8")
+        self.pos = end
+        return value
+
+    def float(self) -> Optional[float]:
+        if self.u8() == 0:
+            return None
+        return self._unpack(F64)
+
+    def f64(self) -> float:
+        return self._unpack(F64)
+
+    def u8(self) -> int:
+        if self.pos >= len(self.buf):
+            raise DecodeError("Truncated record payload")
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    def u32(self) -> int:
+        return self._unpack(U32)
+
+    def u64(self) -> int:
+        return self._unpack(U64)
+
+    def rest(self) -> memoryview:
+        return self.take(len(self.buf) - self.pos)
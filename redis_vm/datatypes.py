@@ -0,0 +1,515 @@
+"""Collection values: lists, hashes, sets and sorted sets, and the commands on them.
+
+Every command takes the collection and its arguments as strings, the same
+way whether it came in over HTTP, RESP or out of the AOF, so a replayed
+write lands exactly like the original. Commands check all their arguments
+before touching the collection and return (reply, size delta, changed) so
+the keyspace can keep storage_used up to date without recounting, and a
+write that found nothing to do is neither logged nor notified.
+"""
+import math
+import random
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+
+class CommandError(Exception):
+    """Error reply, the message starts with its code like RespError: 'ERR ...', 'WRONGTYPE ...'."""
+
+
+WRONGTYPE = "WRONGTYPE Operation against a key holding the wrong kind of value"
+NOT_INTEGER = "ERR value is not an integer or out of range"
+NOT_FLOAT = "ERR value is not a valid float"
+SYNTAX = "ERR syntax error"
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+ZSKIPLIST_MAXLEVEL = 32
+ZSKIPLIST_P = 0.25
+
+
+def _size(s: str) -> int:
+    return len(s) if s.isascii() else len(s.encode())
+
+
+class ListValue(deque):
+    __slots__ = ()
+
+
+class HashValue(dict):
+    __slots__ = ()
+
+
+class SetValue(set):
+    __slots__ = ()
+
+
+class _Node:
+    __slots__ = ("member", "score", "forward", "span")
+
+    def __init__(self, member: Optional[str], score: float, level: int):
+        self.member = member
+        self.score = score
+        self.forward: List[Optional["_Node"]] = [None] * level
+        self.span = [0] * level
+
+
+class ZSet:
+    """Sorted set: a member -> score dict next to a skiplist ordered by (score, member).
+
+    Same layout as Redis' zset. The dict answers ZSCORE in O(1), the skiplist
+    keeps ZADD/ZREM/ZRANK and range lookups at O(log n). Each forward link
+    records how many nodes it jumps over, so a rank falls out of the search.
+    """
+
+    __slots__ = ("scores", "header", "level")
+
+    def __init__(self, items=()):
+        self.scores: Dict[str, float] = {}
+        self.header = _Node(None, 0.0, ZSKIPLIST_MAXLEVEL)
+        self.level = 1
+        for member, score in items:
+            self.add(member, score)
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def __contains__(self, member) -> bool:
+        return member in self.scores
+
+    def __iter__(self) -> Iterator[Tuple[str, float]]:
+        node = self.header.forward[0]
+        while node is not None:
+            yield node.member, node.score
+            node = node.forward[0]
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, ZSet) and self.scores == other.scores
+
+    def score(self, member: str) -> Optional[float]:
+        return self.scores.get(member)
+
+    def add(self, member: str, score: float) -> bool:
+        """Insert or rescore a member, returns whether it is new."""
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self._delete(member, old)
+        self.scores[member] = score
+        self._insert(member, score)
+        return old is None
+
+    def remove(self, member: str) -> bool:
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        self._delete(member, score)
+        return True
+
+    def rank(self, member: str) -> Optional[int]:
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        rank = 0
+        node = self.header
+        for i in range(self.level - 1, -1, -1):
+            nxt = node.forward[i]
+            while nxt is not None and (nxt.score < score or (nxt.score == score and nxt.member <= member)):
+                rank += node.span[i]
+                node = nxt
+                nxt = node.forward[i]
+            if node.member == member:
+                return rank - 1
+        return None
+
+    def range_by_score(self, low: float, high: float, low_open: bool = False,
+                       high_open: bool = False) -> Iterator[Tuple[str, float]]:
+        node = self.header
+        for i in range(self.level - 1, -1, -1):
+            while node.forward[i] is not None and (
+                    node.forward[i].score < low or (low_open and node.forward[i].score == low)):
+                node = node.forward[i]
+        node = node.forward[0]
+        while node is not None and (node.score < high or (not high_open and node.score == high)):
+            yield node.member, node.score
+            node = node.forward[0]
+
+    def _insert(self, member: str, score: float):
+        update = [self.header] * ZSKIPLIST_MAXLEVEL
+        rank = [0] * ZSKIPLIST_MAXLEVEL
+        node = self.header
+        for i in range(self.level - 1, -1, -1):
+            rank[i] = 0 if i == self.level - 1 else rank[i + 1]
+            nxt = node.forward[i]
+            while nxt is not None and (nxt.score < score or (nxt.score == score and nxt.member < member)):
+                rank[i] += node.span[i]
+                node = nxt
+                nxt = node.forward[i]
+            update[i] = node
+        level = 1
+        while level < ZSKIPLIST_MAXLEVEL and random.random() < ZSKIPLIST_P:
+            level += 1
+        if level > self.level:
+            for i in range(self.level, level):
+                rank[i] = 0
+                update[i] = self.header
+                self.header.span[i] = len(self.scores) - 1  # length before this insert
+            self.level = level
+        node = _Node(member, score, level)
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+            node.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = rank[0] - rank[i] + 1
+        for i in range(level, self.level):
+            update[i].span[i] += 1
+
+    def _delete(self, member: str, score: float):
+        update = [self.header] * ZSKIPLIST_MAXLEVEL
+        node = self.header
+        for i in range(self.level - 1, -1, -1):
+            nxt = node.forward[i]
+            while nxt is not None and (nxt.score < score or (nxt.score == score and nxt.member < member)):
+                node = nxt
+                nxt = node.forward[i]
+            update[i] = node
+        node = node.forward[0]
+        for i in range(self.level):
+            if update[i].forward[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].forward[i] = node.forward[i]
+            else:
+                update[i].span[i] -= 1
+        while self.level > 1 and self.header.forward[self.level - 1] is None:
+            self.level -= 1
+
+
+# Entry.type of each collection. Plain values keep their Python type names
+# ("str", "int", "list" for a JSON list...), so lists are called after the deque
+TYPE_NAMES = {ListValue: "deque", HashValue: "hash", SetValue: "set", ZSet: "zset"}
+COLLECTION_TYPES = frozenset(TYPE_NAMES.values())
+# what Redis' TYPE calls them
+REDIS_TYPES = {ListValue: "list", HashValue: "hash", SetValue: "set", ZSet: "zset"}
+
+
+def is_collection(value: Any) -> bool:
+    return type(value) in TYPE_NAMES
+
+
+def collection_size(value: Any) -> int:
+    """Bytes a collection counts for, O(n). Commands keep it current incrementally."""
+    if isinstance(value, HashValue):
+        return sum(_size(f) + _size(v) for f, v in value.items())
+    if isinstance(value, ZSet):
+        return sum(_size(m) + 8 for m in value.scores)
+    return sum(_size(item) for item in value)
+
+
+def to_plain(value: Any) -> Any:
+    """JSON-friendly copy of a collection."""
+    if isinstance(value, ListValue):
+        return list(value)
+    if isinstance(value, HashValue):
+        return dict(value)
+    if isinstance(value, SetValue):
+        return sorted(value)
+    if isinstance(value, ZSet):
+        return [[member, score] for member, score in value]
+    return value
+
+
+# -- argument parsing --
+
+def parse_int(arg: str, error: str = NOT_INTEGER) -> int:
+    try:
+        value = int(arg)
+    except (TypeError, ValueError):
+        raise CommandError(error)
+    if not INT64_MIN <= value <= INT64_MAX:
+        raise CommandError(error)
+    return value
+
+
+def parse_float(arg: str, error: str = NOT_FLOAT) -> float:
+    try:
+        value = float(arg)
+    except (TypeError, ValueError):
+        raise CommandError(error)
+    if math.isnan(value):
+        raise CommandError(error)
+    return value
+
+
+def parse_score_bound(arg: str) -> Tuple[float, bool]:
+    """'1.5', '(1.5', '-inf', '+inf' -> (score, exclusive)."""
+    exclusive = arg.startswith("(")
+    try:
+        value = float(arg[1:] if exclusive else arg)
+    except ValueError:
+        raise CommandError("ERR min or max is not a float")
+    if math.isnan(value):
+        raise CommandError("ERR min or max is not a float")
+    return value, exclusive
+
+
+# -- lists --
+
+def _push(left: bool):
+    def push(value: ListValue, args):
+        if left:
+            value.extendleft(args)
+        else:
+            value.extend(args)
+        return len(value), sum(_size(item) for item in args), True
+    return push
+
+
+def _pop(left: bool):
+    def pop(value: ListValue, args):
+        if len(args) > 1:
+            raise CommandError(SYNTAX)
+        count = parse_int(args[0], "ERR value is out of range, must be positive") if args else None
+        if count is not None and count < 0:
+            raise CommandError("ERR value is out of range, must be positive")
+        if not value:
+            return None, 0, False
+        take = value.popleft if left else value.pop
+        if count is None:
+            item = take()
+            return item, -_size(item), True
+        items = [take() for _ in range(min(count, len(value)))]
+        return items, -sum(_size(item) for item in items), bool(items)
+    return pop
+
+
+def _lrange(value: ListValue, args):
+    start, stop = parse_int(args[0]), parse_int(args[1])
+    n = len(value)
+    if start < 0:
+        start = max(n + start, 0)
+    if stop < 0:
+        stop += n
+    stop = min(stop, n - 1)
+    if start > stop:
+        return [], 0, False
+    if start > n // 2:
+        # closer to the tail, walk from that end
+        items = list(islice(reversed(value), n - 1 - stop, n - start))
+        items.reverse()
+        return items, 0, False
+    return list(islice(value, start, stop + 1)), 0, False
+
+
+# -- hashes --
+
+def _hset(value: HashValue, args):
+    if len(args) % 2:
+        raise CommandError("ERR wrong number of arguments for 'hset' command")
+    added = delta = 0
+    for i in range(0, len(args), 2):
+        field, item = args[i], args[i + 1]
+        old = value.get(field)
+        if old is None:
+            added += 1
+            delta += _size(field) + _size(item)
+        else:
+            delta += _size(item) - _size(old)
+        value[field] = item
+    # like Redis, an hset counts as a change even when the values were already there
+    return added, delta, True
+
+
+def _hdel(value: HashValue, args):
+    removed = delta = 0
+    for field in args:
+        old = value.pop(field, None)
+        if old is not None:
+            removed += 1
+            delta -= _size(field) + _size(old)
+    return removed, delta, removed > 0
+
+
+def _hincrby(value: HashValue, args):
+    if len(args) != 2:
+        raise CommandError("ERR wrong number of arguments for 'hincrby' command")
+    field, increment = args[0], parse_int(args[1])
+    old = value.get(field)
+    current = parse_int(old, "ERR hash value is not an integer") if old is not None else 0
+    new = current + increment
+    if not INT64_MIN <= new <= INT64_MAX:
+        raise CommandError("ERR increment or decrement would overflow")
+    item = str(new)
+    value[field] = item
+    return new, _size(item) - (_size(old) if old is not None else -_size(field)), True
+
+
+# -- sets --
+
+def _sadd(value: SetValue, args):
+    added = delta = 0
+    for member in args:
+        if member not in value:
+            value.add(member)
+            added += 1
+            delta += _size(member)
+    return added, delta, added > 0
+
+
+def _srem(value: SetValue, args):
+    removed = delta = 0
+    for member in args:
+        if member in value:
+            value.discard(member)
+            removed += 1
+            delta -= _size(member)
+    return removed, delta, removed > 0
+
+
+def sinter(sets: List[Optional[SetValue]]) -> set:
+    """Intersection, a missing key counts as an empty set. Walks the smallest set."""
+    if not sets or any(s is None for s in sets):
+        return set()
+    sets = sorted(sets, key=len)
+    return {member for member in sets[0] if all(member in other for other in sets[1:])}
+
+
+# -- sorted sets --
+
+def _zadd(value: ZSet, args):
+    if len(args) % 2:
+        raise CommandError(SYNTAX)
+    pairs = [(args[i + 1], parse_float(args[i])) for i in range(0, len(args), 2)]
+    added = delta = 0
+    changed = False
+    for member, score in pairs:
+        # a rescore changes the set without adding to the reply
+        changed = changed or value.score(member) != score
+        if value.add(member, score):
+            added += 1
+            delta += _size(member) + 8
+    return added, delta, changed
+
+
+def _zrem(value: ZSet, args):
+    removed = delta = 0
+    for member in args:
+        if value.remove(member):
+            removed += 1
+            delta -= _size(member) + 8
+    return removed, delta, removed > 0
+
+
+def _zrangebyscore(value: ZSet, args):
+    (low, low_open), (high, high_open) = parse_score_bound(args[0]), parse_score_bound(args[1])
+    with_scores = False
+    offset, count = 0, -1
+    i = 2
+    while i < len(args):
+        option = args[i].upper()
+        if option == "WITHSCORES":
+            with_scores = True
+            i += 1
+        elif option == "LIMIT" and i + 2 < len(args):
+            offset, count = parse_int(args[i + 1]), parse_int(args[i + 2])
+            i += 3
+        else:
+            raise CommandError(SYNTAX)
+    if offset < 0:
+        return [], 0, False
+    items = value.range_by_score(low, high, low_open, high_open)
+    items = islice(items, offset, None if count < 0 else offset + count)
+    if with_scores:
+        return [[member, score] for member, score in items], 0, False
+    return [member for member, _ in items], 0, False
+
+
+class Command(NamedTuple):
+    type: type
+    run: Callable[[Any, List[str]], Tuple[Any, int, bool]]
+    arity: int  # like Redis' command table, name and key included: N exactly, -N at least N
+    write: bool = False
+    creates: bool = False  # runs on a new empty collection when the key is missing
+    missing: Any = None  # reply when the key is missing otherwise
+
+
+def _read(fn: Callable[[Any], Any]):
+    return lambda value, args: (fn(value, args), 0, False)
+
+
+COMMANDS: Dict[str, Command] = {
+    "lpush": Command(ListValue, _push(True), -3, write=True, creates=True),
+    "rpush": Command(ListValue, _push(False), -3, write=True, creates=True),
+    "lpop": Command(ListValue, _pop(True), -2, write=True),
+    "rpop": Command(ListValue, _pop(False), -2, write=True),
+    "lrange": Command(ListValue, _lrange, 4, missing=[]),
+    "llen": Command(ListValue, _read(lambda v, a: len(v)), 2, missing=0),
+    "hset": Command(HashValue, _hset, -4, write=True, creates=True),
+    "hget": Command(HashValue, _read(lambda v, a: v.get(a[0])), 3),
+    "hgetall": Command(HashValue, _read(lambda v, a: dict(v)), 2, missing={}),
+    "hdel": Command(HashValue, _hdel, -3, write=True, missing=0),
+    "hincrby": Command(HashValue, _hincrby, 4, write=True, creates=True),
+    "hlen": Command(HashValue, _read(lambda v, a: len(v)), 2, missing=0),
+    "sadd": Command(SetValue, _sadd, -3, write=True, creates=True),
+    "srem": Command(SetValue, _srem, -3, write=True, missing=0),
+    "sismember": Command(SetValue, _read(lambda v, a: int(a[0] in v)), 3, missing=0),
+    "smembers": Command(SetValue, _read(lambda v, a: set(v)), 2, missing=set()),
+    "scard": Command(SetValue, _read(lambda v, a: len(v)), 2, missing=0),
+    "zadd": Command(ZSet, _zadd, -4, write=True, creates=True),
+    "zrem": Command(ZSet, _zrem, -3, write=True, missing=0),
+    "zscore": Command(ZSet, _read(lambda v, a: v.score(a[0])), 3),
+    "zrank": Command(ZSet, _read(lambda v, a: v.rank(a[0])), 3),
+    "zrangebyscore": Command(ZSet, _zrangebyscore, -4, missing=[]),
+    "zcard": Command(ZSet, _read(lambda v, a: len(v)), 2, missing=0),
+}
+
+
+def check_arity(name: str, args: List[str]):
+    arity = COMMANDS[name].arity
+    # args come without the name and the key
+    if (arity > 0 and len(args) != arity - 2) or (arity < 0 and len(args) < -arity - 2):
+        raise CommandError(f"ERR wrong number of arguments for '{name}' command")
+
+
+def growth(name: str, args: List[str]) -> int:
+    """Upper bound on the bytes a write adds, for the quota check before it runs."""
+    command = COMMANDS[name]
+    if not command.creates:
+        return 0
+    if name == "hincrby":
+        return _size(args[0]) + 20
+    if name == "zadd":
+        return sum(_size(args[i]) + 8 for i in range(1, len(args), 2))
+    return sum(_size(arg) for arg in args)
+
+
+def run(keyspace, key: str, name: str, args: List[str]) -> Tuple[Any, bool]:
+    """Run a collection command against a tenant's keyspace.
+
+    Returns (reply, changed); changed is False when a write found nothing to
+    act on, so there is nothing to log. Empty collections are removed.
+    """
+    command = COMMANDS[name]
+    check_arity(name, args)
+    entry = keyspace.get(key)
+    if entry is None and keyspace.get_file(key) is not None:
+        raise CommandError(WRONGTYPE)
+    if entry is not None and type(entry.value) is not command.type:
+        raise CommandError(WRONGTYPE)
+    if entry is None:
+        if not command.creates:
+            if command.write:
+                # still validates the arguments, like Redis
+                command.run(command.type(), args)
+            return command.missing, False
+        value = command.type()
+        reply, delta, changed = command.run(value, args)
+        if value:
+            keyspace.set(key, value, TYPE_NAMES[command.type], None, delta)
+        return reply, changed
+    reply, delta, changed = command.run(entry.value, args)
+    if delta:
+        keyspace.resize(entry, entry.size + delta)
+    if not entry.value:
+        keyspace.delete(key)
+    return reply, changed
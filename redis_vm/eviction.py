@@ -0,0 +1,291 @@
+import math
+import random
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from blobstore import BlobRef
+from keyspace import Entry, Keyspace
+
+POLICIES = ("noeviction", "allkeys-lru", "allkeys-lfu", "allkeys-random",
+            "volatile-lru", "volatile-lfu", "volatile-random", "volatile-ttl")
+# Same knobs as Redis' evict.c: the pool keeps the best candidates seen across
+# samples, new keys start with an LFU counter of LFU_INIT_VAL
+EVICTION_POOL_SIZE = 16
+LFU_INIT_VAL = 5
+OOM = "OOM command not allowed when used memory > 'maxmemory'."
+
+_UNITS = {"b": 1, "k": 1000, "kb": 1024, "m": 1000 ** 2, "mb": 1024 ** 2, "g": 1000 ** 3, "gb": 1024 ** 3}
+
+
+class OutOfMemory(Exception):
+    pass
+
+
+def parse_memory(value: str) -> int:
+    """'100mb' -> 104857600, the units redis.conf accepts (k = 1000, kb = 1024)."""
+    text = value.strip().lower()
+    digits = text.rstrip("bkmg")
+    unit = text[len(digits):] or "b"
+    if unit not in _UNITS or not digits.isdigit():
+        raise ValueError(f"invalid memory amount '{value}'")
+    return int(digits) * _UNITS[unit]
+
+
+def lru_clock() -> int:
+    # seconds, never 0 so it can't be mistaken for "not used since load"
+    return int(time.monotonic()) + 1
+
+
+def lfu_minutes() -> int:
+    # 16 bits of minutes like Redis, wraps after ~45 days
+    return int(time.monotonic() // 60) & 0xFFFF
+
+
+class _Sample:
+    # candidate key names of one tenant for one policy kind, sampled at random
+    __slots__ = ("volatile", "data", "files", "budget")
+
+    def __init__(self, keyspace: Keyspace, volatile: bool):
+        self.volatile = volatile
+        if volatile:
+            self.data = [k for k, e in keyspace.data.items() if e.expiry is not None]
+        else:
+            self.data = list(keyspace.data)
+        self.files = [k for k, e in keyspace.files.items()
+                      if not isinstance(e.value, BlobRef) and (e.expiry is not None or not volatile)]
+        # rebuilt once about as many keys were drawn as it holds, but never
+        # more often than every len/16 draws so an (almost) empty volatile
+        # list of a big tenant isn't rebuilt on every eviction
+        self.budget = max(len(self.data) + len(self.files), len(keyspace) // 16, 1)
+
+    def __len__(self) -> int:
+        return len(self.data) + len(self.files)
+
+
+class Evictor:
+    """maxmemory and the Redis eviction policies across all tenants.
+
+    Like Redis, LRU/LFU is approximate: every eviction samples
+    maxmemory_samples random keys per tenant, scores them by idle time, LFU
+    counter or TTL, and keeps the best EVICTION_POOL_SIZE of them in a pool
+    that persists between evictions. Entry.lru holds the LRU clock (seconds)
+    or, under an LFU policy, (minutes << 8) | log counter.
+
+    Tenants above the soft limit of their subscription tier give up keys
+    first (the writer before the others), only then does eviction pick the
+    best candidates among all tenants.
+    """
+
+    def __init__(self, user_data: Dict[str, Keyspace], config: Dict[str, str],
+                 soft_limit: Callable[[Keyspace], int]):
+        self.user_data = user_data
+        self.config = config
+        self.soft_limit = soft_limit
+        self._samples: Dict[str, _Sample] = {}
+        self._pools: Dict[str, List[Tuple[float, str, bool]]] = {}
+        self.evicted_keys = 0
+        self.evicted_keys_soft_limit = 0
+        self.oom_rejected = 0
+        # called as on_evict(user_id, key, is_file) after a key is evicted
+        self.on_evict: Optional[Callable[[str, str, bool], None]] = None
+
+    @property
+    def maxmemory(self) -> int:
+        return int(self.config["maxmemory"])
+
+    @property
+    def policy(self) -> str:
+        return self.config["maxmemory_policy"]
+
+    def used_memory(self) -> int:
+        return sum(keyspace.memory for keyspace in self.user_data.values())
+
+    # access tracking
+
+    def touch(self, entry: Entry):
+        """Record an access, on every read and write of a key."""
+        if self.policy.endswith("lfu"):
+            counter = LFU_INIT_VAL if entry.lru == 0 else self._lfu_counter(entry)
+            entry.lru = (lfu_minutes() << 8) | self._lfu_increment(counter)
+        else:
+            entry.lru = lru_clock()
+
+    def _lfu_counter(self, entry: Entry) -> int:
+        # the counter decays by one every lfu_decay_time minutes without access
+        counter = entry.lru & 0xFF
+        decay_time = int(self.config["lfu_decay_time"])
+        if decay_time:
+            elapsed = (lfu_minutes() - (entry.lru >> 8)) & 0xFFFF
+            counter = max(0, counter - elapsed // decay_time)
+        return counter
+
+    def _lfu_increment(self, counter: int) -> int:
+        # logarithmic: the higher the counter, the less likely it grows
+        if counter == 255:
+            return counter
+        base = max(counter - LFU_INIT_VAL, 0)
+        if random.random() < 1.0 / (base * int(self.config["lfu_log_factor"]) + 1):
+            counter += 1
+        return counter
+
+    def _score(self, entry: Entry) -> float:
+        # higher = better candidate
+        if self.policy.endswith("lfu"):
+            return 255 - self._lfu_counter(entry)
+        if self.policy == "volatile-ttl":
+            return -entry.expiry
+        if self.policy.endswith("random"):
+            return random.random()
+        return lru_clock() - entry.lru
+
+    # eviction
+
+    def make_room(self, writer: Optional[Keyspace] = None, added: int = 0):
+        """Evict until `added` more bytes fit under maxmemory, raises OutOfMemory if they can't.
+
+        Only called on the write paths of a primary, replicas get the
+        evictions as DELs in the replication stream.
+        """
+        maxmemory = self.maxmemory
+        if not maxmemory:
+            return
+        used = self.used_memory()
+        if used + added <= maxmemory:
+            return
+        if self.policy == "noeviction":
+            self.oom_rejected += 1
+            raise OutOfMemory(OOM)
+
+        for user_id in self._soft_limit_order(writer):
+            keyspace = self.user_data[user_id]
+            limit = self.soft_limit(keyspace)
+            while used + added > maxmemory and keyspace.memory > limit:
+                freed = self._evict_from(user_id)
+                if freed is None:
+                    break
+                used -= freed
+                self.evicted_keys_soft_limit += 1
+        while used + added > maxmemory:
+            freed = self._evict_best()
+            if freed is None:
+                self.oom_rejected += 1
+                raise OutOfMemory(OOM)
+            used -= freed
+
+    def _soft_limit_order(self, writer: Optional[Keyspace]) -> List[str]:
+        over = [(keyspace is writer, keyspace.memory - self.soft_limit(keyspace), user_id)
+                for user_id, keyspace in self.user_data.items()
+                if keyspace.memory > self.soft_limit(keyspace)]
+        over.sort(reverse=True)
+        return [user_id for _, _, user_id in over]
+
+    def _evict_from(self, user_id: str) -> Optional[int]:
+        candidate = self._best_candidate(user_id)
+        if candidate is None:
+            return None
+        return self._evict(user_id, candidate[1], candidate[2])
+
+    def _evict_best(self) -> Optional[int]:
+        best = None
+        for user_id in list(self.user_data):
+            candidate = self._best_candidate(user_id)
+            if candidate is not None and (best is None or candidate[0] > best[1][0]):
+                best = (user_id, candidate)
+        if best is None:
+            return None
+        user_id, (_, key, is_file) = best
+        return self._evict(user_id, key, is_file)
+
+    def _best_candidate(self, user_id: str) -> Optional[Tuple[float, str, bool]]:
+        """Refill the tenant's pool with a fresh sample, returns its best live candidate."""
+        keyspace = self.user_data[user_id]
+        pool = self._pools.setdefault(user_id, [])
+        volatile = self.policy.startswith("volatile")
+        now = time.time()
+        pool.extend(self._sample(user_id, keyspace, volatile))
+        pool.sort()
+        del pool[:-EVICTION_POOL_SIZE]
+        while pool:
+            score, key, is_file = pool[-1]
+            entry = (keyspace.files if is_file else keyspace.data).get(key)
+            if entry is None or (volatile and entry.expiry is None) or entry.is_expired(now):
+                # gone, persisted or about to be reclaimed by the expirer anyway
+                pool.pop()
+                continue
+            return pool[-1]
+        return None
+
+    def _sample(self, user_id: str, keyspace: Keyspace, volatile: bool) -> List[Tuple[float, str, bool]]:
+        sample = self._samples.get(user_id)
+        fresh = sample is None or sample.volatile != volatile or sample.budget <= 0
+        if fresh:
+            sample = self._samples[user_id] = _Sample(keyspace, volatile)
+        picked, found = self._draw(user_id, keyspace, sample)
+        if not found and not fresh and len(keyspace):
+            # every name drawn was gone, the list is stale (the tenant was flushed and refilled)
+            sample = self._samples[user_id] = _Sample(keyspace, volatile)
+            picked, found = self._draw(user_id, keyspace, sample)
+        return picked
+
+    def _draw(self, user_id: str, keyspace: Keyspace, sample: _Sample) -> Tuple[List[Tuple[float, str, bool]], int]:
+        """Score maxmemory_samples random keys of the sample, returns (candidates, keys still present)."""
+        if not len(sample):
+            sample.budget -= 1
+            return [], 0
+        picked = []
+        found = 0
+        in_pool = {(key, is_file) for _, key, is_file in self._pools.get(user_id, ())}
+        for _ in range(max(int(self.config["maxmemory_samples"]), 1)):
+            sample.budget -= 1
+            i = random.randrange(len(sample))
+            is_file = i >= len(sample.data)
+            key = sample.files[i - len(sample.data)] if is_file else sample.data[i]
+            entry = (keyspace.files if is_file else keyspace.data).get(key)
+            if entry is None:
+                continue
+            found += 1
+            if (key, is_file) in in_pool or (sample.volatile and entry.expiry is None):
+                continue
+            in_pool.add((key, is_file))
+            picked.append((self._score(entry), key, is_file))
+        return picked, found
+
+    def _evict(self, user_id: str, key: str, is_file: bool) -> int:
+        keyspace = self.user_data[user_id]
+        self._pools[user_id].pop()
+        before = keyspace.memory
+        keyspace.reclaim(key, is_file)
+        self.evicted_keys += 1
+        if self.on_evict is not None:
+            self.on_evict(user_id, key, is_file)
+        return before - keyspace.memory
+
+    def forget(self, user_id: Optional[str] = None):
+        """Drop cached samples and pools, of one tenant or all, after it is deleted."""
+        if user_id is None:
+            self._samples.clear()
+            self._pools.clear()
+        else:
+            self._samples.pop(user_id, None)
+            self._pools.pop(user_id, None)
+
+    def info(self) -> Dict[str, object]:
+        maxmemory = self.maxmemory
+        used = self.used_memory()
+        return {
+            "used_memory": used,
+            "used_memory_human": human_bytes(used),
+            "maxmemory": maxmemory,
+            "maxmemory_human": human_bytes(maxmemory),
+            "maxmemory_policy": self.policy,
+            "evicted_keys": self.evicted_keys,
+            "evicted_keys_soft_limit": self.evicted_keys_soft_limit,
+            "oom_rejected": self.oom_rejected,
+        }
+
+
+def human_bytes(n: int) -> str:
+    if n < 1024:
+        return f"{n}B"
+    exponent = min(int(math.log(n, 1024)), 4)
+    return f"{n / 1024 ** exponent:.2f}{'KMGT'[exponent - 1]}"
@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from keyspace import Entry, Keyspace
+
+logger = logging.getLogger(__name__)
+
+# Same knobs as Redis' activeExpireCycle: run `hz` times a second, pop keys in
+# batches of ACTIVE_EXPIRE_BATCH and never spend more than ~25% of a tick
+ACTIVE_EXPIRE_HZ = 10
+ACTIVE_EXPIRE_BATCH = 20
+ACTIVE_EXPIRE_BUDGET = 0.25
+# The heap is rebuilt without stale items once it has doubled since the last
+# rebuild, so re-EXPIREing one key can't grow it without bound
+COMPACT_MIN_ITEMS = 1024
+
+
+class Expirer:
+    """Min-heap of monotonic deadlines that actively reclaims expired keys.
+
+    Heap items are never removed when a key is overwritten, deleted or
+    persisted; they are checked against the live entry's expiry when they
+    come due and dropped if they no longer match. Items hold the key, not
+    the entry, so an overwritten value is freed right away.
+    """
+
+    def __init__(self, user_data: Dict[str, Keyspace], hz: int = ACTIVE_EXPIRE_HZ):
+        self.user_data = user_data
+        self.hz = hz
+        # (deadline, seq, user_id, key, is_file, the entry's expiry when scheduled)
+        self._heap: List[Tuple[float, int, str, str, bool, float]] = []
+        self._seq = itertools.count()
+        self._compact_at = COMPACT_MIN_ITEMS
+        self._task = None
+        self.expired_keys = 0
+        self.stale_skipped = 0
+        # called as on_expire(user_id, key, is_file) after a key is reclaimed
+        self.on_expire: Optional[Callable[[str, str, bool], None]] = None
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def schedule(self, user_id: str, key: str, entry: Entry, is_file: bool = False):
+        if entry.expiry is None:
+            return
+        deadline = time.monotonic() + (entry.expiry - time.time())
+        heapq.heappush(self._heap, (deadline, next(self._seq), user_id, key, is_file, entry.expiry))
+        if len(self._heap) >= self._compact_at:
+            self.compact()
+
+    def _live(self, user_id: str, key: str, is_file: bool, expiry: float) -> Optional[Entry]:
+        # the entry the item was scheduled for, None if it was deleted,
+        # overwritten, persisted or given another expiry since
+        keyspace = self.user_data.get(user_id)
+        if keyspace is None:
+            return None
+        entry = (keyspace.files if is_file else keyspace.data).get(key)
+        return entry if entry is not None and entry.expiry == expiry else None
+
+    def compact(self):
+        before = len(self._heap)
+        self._heap = [item for item in self._heap if self._live(*item[2:]) is not None]
+        heapq.heapify(self._heap)
+        self.stale_skipped += before - len(self._heap)
+        self._compact_at = max(COMPACT_MIN_ITEMS, 2 * len(self._heap))
+
+    def schedule_keyspace(self, user_id: str, keyspace: Keyspace):
+        for key, entry in keyspace.data.items():
+            self.schedule(user_id, key, entry)
+        for key, entry in keyspace.files.items():
+            self.schedule(user_id, key, entry, is_file=True)
+
+    def clear(self):
+        self._heap.clear()
+        self._compact_at = COMPACT_MIN_ITEMS
+
+    def expire_batch(self, limit: int = ACTIVE_EXPIRE_BATCH) -> int:
+        """Pop up to `limit` due heap items, returns how many keys were reclaimed."""
+        heap = self._heap
+        now = time.monotonic()
+        wall_now = time.time()
+        reclaimed = 0
+        for _ in range(limit):
+            if not heap or heap[0][0] > now:
+                break
+            _, _, user_id, key, is_file, expiry = heapq.heappop(heap)
+            entry = self._live(user_id, key, is_file, expiry)
+            if entry is None or not entry.is_expired(wall_now):
+                self.stale_skipped += 1
+                continue
+            self.user_data[user_id].reclaim(key, is_file)
+            reclaimed += 1
+            if self.on_expire is not None:
+                self.on_expire(user_id, key, is_file)
+        self.expired_keys += reclaimed
+        return reclaimed
+
+    def has_due(self) -> bool:
+        return bool(self._heap) and self._heap[0][0] <= time.monotonic()
+
+    def run_cycle(self) -> bool:
+        """One time-bounded cycle, returns True if due keys are still left over."""
+        deadline = time.monotonic() + ACTIVE_EXPIRE_BUDGET / self.hz
+        while self.has_due():
+            self.expire_batch()
+            if time.monotonic() >= deadline:
+                return self.has_due()
+        return False
+
+    async def run(self):
+        while True:
+            try:
+                backlog = self.run_cycle()
+            except Exception as e:
+                logger.error(f"Error in active expiry cycle: {str(e)}")
+                backlog = False
+            # An expiry burst yields to the event loop and comes straight back,
+            # otherwise sleep until the next tick
+            await asyncio.sleep(0 if backlog else 1 / self.hz)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
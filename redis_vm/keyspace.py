@@ -0,0 +1,367 @@
+import base64
+import json
+import time
+from datetime import timezone
+from typing import Any, Dict, Iterator, Optional, Tuple, Union
+
+from blobstore import BlobRef
+from datatypes import collection_size, is_collection, to_plain
+
+# Bookkeeping fields that used to live next to the user's keys in user_data
+META_FIELDS = ("public_key", "subscription", "storage_used", "salt")
+# RAM a key costs on top of its name and value: the Entry, the key str
+# header and its dict slot (bench_memory.py measures about this much)
+KEY_OVERHEAD = 184
+
+
+def value_size(value: Any) -> int:
+    """Bytes a value counts for against the tenant's storage."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if value is None:
+        return 0
+    if is_collection(value):
+        return collection_size(value)
+    return len(json.dumps(value, default=str))
+
+
+class Entry:
+    # __slots__ drops the per-instance __dict__, so an entry costs a fixed
+    # 72 bytes instead of a fresh {"value", "expiry", "type"} dict per key
+    __slots__ = ("value", "type", "expiry", "size", "lru")
+
+    def __init__(self, value: Any, type: str, expiry: Optional[float] = None, size: Optional[int] = None):
+        self.value = value
+        self.type = type
+        self.expiry = expiry  # absolute unix time in seconds, None = persistent
+        self.size = value_size(value) if size is None else size
+        # LRU clock or LFU counter, set by Evictor.touch; 0 = not used since load
+        self.lru = 0
+
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        if self.expiry is None:
+            return False
+        return self.expiry <= (time.time() if now is None else now)
+
+    def __getstate__(self):
+        return (self.value, self.type, self.expiry, self.size)
+
+    def __setstate__(self, state):
+        self.lru = 0
+        if len(state) == 3:
+            self.value, self.type, self.expiry = state
+            self.size = value_size(self.value)
+        else:
+            self.value, self.type, self.expiry, self.size = state
+
+
+class FileEntry(Entry):
+    # value is the raw file content, or a BlobRef once it was spilled to
+    # disk; mtime backs ETag/Last-Modified
+    __slots__ = ("content_type", "filename", "mtime")
+
+    def __init__(self, value: Union[bytes, bytearray, BlobRef], content_type: Optional[str],
+                 filename: Optional[str], expiry: Optional[float] = None, mtime: Optional[float] = None):
+        super().__init__(value, "binary", expiry, len(value))
+        self.content_type = content_type
+        self.filename = filename
+        self.mtime = time.time() if mtime is None else mtime
+
+    def content(self) -> Union[bytes, bytearray, memoryview]:
+        if isinstance(self.value, BlobRef):
+            return self.value.read()
+        return self.value
+
+    def release(self):
+        if isinstance(self.value, BlobRef):
+            self.value.free()
+
+    def __getstate__(self):
+        # a spilled blob pickles as its bytes, see BlobRef.__reduce__
+        return (self.value, self.type, self.expiry, self.content_type, self.filename, self.size, self.mtime)
+
+    def __setstate__(self, state):
+        self.mtime = time.time()
+        self.lru = 0
+        if len(state) == 5:
+            # dumped before files were stored raw: value is base64 text
+            value, self.type, self.expiry, self.content_type, self.filename = state
+            self.value = _decode_legacy_blob(value)
+            self.size = len(self.value)
+        elif len(state) == 6:
+            self.value, self.type, self.expiry, self.content_type, self.filename, self.size = state
+        else:
+            self.value, self.type, self.expiry, self.content_type, self.filename, self.size, self.mtime = state
+
+
+def entry_memory(key: str, entry: Entry) -> int:
+    """Approximate RAM a key holds, what MEMORY USAGE reports. Spilled files only count their entry."""
+    if isinstance(entry.value, BlobRef):
+        return KEY_OVERHEAD + len(key)
+    return KEY_OVERHEAD + len(key) + entry.size
+
+
+class Keyspace:
+    """All state of one tenant: metadata, plain values and uploaded files.
+
+    meta["storage_used"] is the single byte counter for the tenant. Every
+    method that adds, replaces or drops an entry adjusts it, so callers must
+    go through them rather than touching data/files directly. `memory` is
+    kept the same way and is what maxmemory is checked against.
+    """
+
+    __slots__ = ("meta", "data", "files", "reserved", "memory")
+
+    def __init__(self, public_key: Optional[str] = None, subscription: str = "basic"):
+        self.meta: Dict[str, Any] = {
+            "public_key": public_key,
+            "subscription": subscription,
+            "storage_used": 0,
+            "salt": None,
+        }
+        self.data: Dict[str, Entry] = {}
+        self.files: Dict[str, FileEntry] = {}
+        self.reserved = 0  # bytes claimed by uploads still in flight, never persisted
+        self.memory = 0  # sum of entry_memory() over all keys, never persisted
+
+    def __getstate__(self):
+        return (self.meta, self.data, self.files)
+
+    def __setstate__(self, state):
+        self.meta, self.data, self.files = state
+        self.reserved = 0
+        self.memory = 0  # load_keyspace recounts
+
+    def __len__(self) -> int:
+        return len(self.data) + len(self.files)
+
+    def keys(self) -> Iterator[str]:
+        now = time.time()
+        for key, entry in self.data.items():
+            if not entry.is_expired(now):
+                yield key
+        for key, entry in self.files.items():
+            if key not in self.data and not entry.is_expired(now):
+                yield key
+
+    def get(self, key: str) -> Optional[Entry]:
+        return self.data.get(key)
+
+    def get_file(self, key: str) -> Optional[FileEntry]:
+        return self.files.get(key)
+
+    @property
+    def storage_used(self) -> int:
+        return self.meta["storage_used"]
+
+    def _account(self, delta: int):
+        self.meta["storage_used"] += delta
+
+    def _put(self, store: Dict[str, Entry], key: str, entry: Entry) -> Entry:
+        old = store.get(key)
+        store[key] = entry
+        self._account(entry.size - (old.size if old is not None else 0))
+        self.memory += entry_memory(key, entry) - (entry_memory(key, old) if old is not None else 0)
+        if isinstance(old, FileEntry):
+            old.release()
+        return entry
+
+    def _pop(self, store: Dict[str, Entry], key: str) -> Optional[Entry]:
+        entry = store.pop(key, None)
+        if entry is not None:
+            self._account(-entry.size)
+            self.memory -= entry_memory(key, entry)
+            if isinstance(entry, FileEntry):
+                entry.release()
+        return entry
+
+    def release_blobs(self):
+        """Free spilled blobs before the whole keyspace is dropped."""
+        for entry in self.files.values():
+            entry.release()
+
+    def size_delta(self, key: str, size: int, is_file: bool = False) -> int:
+        """How much storing `size` bytes under `key` would add, net of what it replaces."""
+        old = (self.files if is_file else self.data).get(key)
+        return size - (old.size if old is not None else 0)
+
+    def set(self, key: str, value: Any, type: str, expiry: Optional[float] = None,
+            size: Optional[int] = None) -> Entry:
+        return self._put(self.data, key, Entry(value, type, expiry, size))
+
+    def set_file(self, key: str, value: bytes, content_type: Optional[str], filename: Optional[str],
+                 expiry: Optional[float] = None, mtime: Optional[float] = None) -> FileEntry:
+        return self._put(self.files, key, FileEntry(value, content_type, filename, expiry, mtime))
+
+    def resize(self, entry: Entry, size: int):
+        """Record an in-place change to an entry's value."""
+        self._account(size - entry.size)
+        if not isinstance(entry.value, BlobRef):
+            self.memory += size - entry.size
+        entry.size = size
+
+    def delete(self, key: str) -> Optional[Entry]:
+        return self._pop(self.data, key)
+
+    def delete_file(self, key: str) -> Optional[FileEntry]:
+        return self._pop(self.files, key)
+
+    def lookup(self, key: str) -> Tuple[Optional[Entry], bool]:
+        """Find a key among values then files, returns (entry, is_file)."""
+        entry = self.data.get(key)
+        if entry is not None:
+            return entry, False
+        return self.files.get(key), True
+
+    def is_current(self, key: str, entry: Entry, is_file: bool = False) -> bool:
+        store = self.files if is_file else self.data
+        return store.get(key) is entry
+
+    def reclaim(self, key: str, is_file: bool = False) -> Optional[Entry]:
+        """Drop an expired key, giving its bytes back to the quota."""
+        return self._pop(self.files if is_file else self.data, key)
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        expired = [(key, False) for key, entry in self.data.items() if entry.is_expired(now)]
+        expired += [(key, True) for key, entry in self.files.items() if entry.is_expired(now)]
+        for key, is_file in expired:
+            self.reclaim(key, is_file)
+        return len(expired)
+
+    def merge(self, other: "Keyspace"):
+        """Overlay another keyspace on this one, like {**self, **other} did for dicts."""
+        used = self.meta["storage_used"]
+        self.meta.update({k: v for k, v in other.meta.items() if v is not None})
+        self.meta["storage_used"] = used
+        for key, entry in other.data.items():
+            self._put(self.data, key, entry)
+        for key, entry in other.files.items():
+            self._put(self.files, key, entry)
+
+    def computed_usage(self) -> int:
+        """Recount storage from scratch, O(keys). Only for recounts and checks."""
+        return sum(e.size for e in self.data.values()) + sum(e.size for e in self.files.values())
+
+    def computed_memory(self) -> int:
+        return (sum(entry_memory(k, e) for k, e in self.data.items())
+                + sum(entry_memory(k, e) for k, e in self.files.items()))
+
+    def recount(self):
+        self.meta["storage_used"] = self.computed_usage()
+        self.memory = self.computed_memory()
+
+    def check_consistency(self):
+        """Raise AssertionError if the incremental counter drifted from the entries."""
+        expected = self.computed_usage()
+        actual = self.meta["storage_used"]
+        assert actual == expected, f"storage_used is {actual}, entries add up to {expected}"
+        assert self.memory == self.computed_memory(), f"memory is {self.memory}, entries add up to {self.computed_memory()}"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-friendly view of the whole tenant, the shape /users used to return."""
+        out: Dict[str, Any] = dict(self.meta)
+        now = time.time()
+        for key, entry in self.data.items():
+            if entry.is_expired(now):
+                continue
+            out[key] = {"value": to_plain(entry.value), "expiry": entry.expiry, "type": entry.type}
+        out["files"] = {
+            key: {
+                "value": base64.b64encode(entry.content()).decode(),
+                "type": entry.type,
+                "content_type": entry.content_type,
+                "original_filename": entry.filename,
+                "expiry": entry.expiry,
+            }
+            for key, entry in self.files.items()
+            if not entry.is_expired(now)
+        }
+        return out
+
+    def summary(self) -> Dict[str, Any]:
+        """Key count, bytes used and tier, O(1)."""
+        return {
+            "keys": len(self),
+            "storage_used": self.storage_used,
+            "used_memory": self.memory,
+            "subscription": self.meta["subscription"],
+        }
+
+    def iter_export(self, include_files: bool = False) -> Iterator[Dict[str, Any]]:
+        """to_dict() one key at a time: a meta record, then one record per key.
+
+        File content is only base64'd when include_files is set, otherwise a
+        file record carries its metadata and size.
+        """
+        yield {"meta": {k: v for k, v in self.meta.items() if k != "salt"}}
+        now = time.time()
+        for key, entry in list(self.data.items()):
+            if not entry.is_expired(now):
+                yield {"key": key, "value": to_plain(entry.value), "expiry": entry.expiry, "type": entry.type}
+        for key, entry in list(self.files.items()):
+            if entry.is_expired(now):
+                continue
+            record = {
+                "key": key, "type": entry.type, "content_type": entry.content_type,
+                "original_filename": entry.filename, "expiry": entry.expiry, "size": entry.size,
+            }
+            if include_files:
+                try:
+                    record["value"] = base64.b64encode(entry.content()).decode()
+                except KeyError:
+                    continue  # blob freed while the export was running
+            yield record
+
+    @classmethod
+    def from_legacy(cls, raw: Dict[str, Any]) -> "Keyspace":
+        """Convert a pre-Keyspace user_data dict (old pickled RDB dumps)."""
+        ks = cls()
+        for name in META_FIELDS:
+            if name in raw and not isinstance(raw[name], dict):
+                ks.meta[name] = raw[name]
+        for key, item in raw.items():
+            if key == "files" or (key in META_FIELDS and not isinstance(item, dict)):
+                continue
+            if isinstance(item, dict) and "value" in item:
+                ks.data[key] = Entry(item["value"], item.get("type") or type(item["value"]).__name__,
+                                     _legacy_expiry(item.get("expiry")))
+        for key, item in (raw.get("files") or {}).items():
+            ks.files[key] = FileEntry(_decode_legacy_blob(item["value"]), item.get("content_type"),
+                                      item.get("original_filename"), _legacy_expiry(item.get("expiry")))
+        ks.recount()
+        return ks
+
+
+def _legacy_expiry(expiry) -> Optional[float]:
+    # old dumps stored naive utc datetimes
+    if expiry is None:
+        return None
+    if isinstance(expiry, (int, float)):
+        return float(expiry)
+    return expiry.replace(tzinfo=timezone.utc).timestamp()
+
+
+def _decode_legacy_blob(value) -> bytes:
+    # old dumps kept file content as a base64 string
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return bytes(value)
+
+
+def load_keyspace(raw: Any) -> Keyspace:
+    if isinstance(raw, Keyspace):
+        # counters from older dumps only covered files, never trust them
+        raw.recount()
+        return raw
+    return Keyspace.from_legacy(raw)
+
+
+def expiry_from_ttl(seconds: Optional[int]) -> Optional[float]:
+    return time.time() + seconds if seconds else None
@@ -0,0 +1,86 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict
+
+from sharding import path_tenant
+
+# Routes that stream a big body take the lock themselves once it is in, so a
+# tenant's other writes don't queue behind the upload
+SELF_LOCKING_ROUTES = ("setfile",)
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class TenantLocks:
+    """One asyncio.Lock per tenant: writes of one tenant run one at a time,
+    different tenants still interleave freely on the event loop.
+
+    Only handlers that await between reading a tenant's state and writing it
+    need this, code without an await in between can't be interleaved anyway.
+    A lock only exists while someone holds or waits for it.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._users: Dict[str, int] = {}
+        # acquisitions that had to wait for another request of the same tenant
+        self.contended = 0
+
+    def locked(self, user_id: str) -> bool:
+        lock = self._locks.get(user_id)
+        return lock is not None and lock.locked()
+
+    @asynccontextmanager
+    async def hold(self, user_id: str) -> AsyncIterator[None]:
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        elif lock.locked():
+            self.contended += 1
+        self._users[user_id] = self._users.get(user_id, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[user_id] -= 1
+            if not self._users[user_id]:
+                del self._users[user_id]
+                del self._locks[user_id]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+class TenantLockMiddleware:
+    """Runs every writing request of a tenant route under that tenant's lock.
+
+    The response is held back until the lock is released: AOFSyncMiddleware
+    waits for the fsync when the response starts, and the tenant's next
+    write shouldn't queue behind that wait (with appendfsync always it then
+    shares the fsync instead). Write responses are small, so they are kept
+    whole.
+    """
+
+    def __init__(self, app, locks: TenantLocks):
+        self.app = app
+        self.locks = locks
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in READ_METHODS:
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        user_id = path_tenant(path)
+        if user_id is None or path.rsplit("/", 1)[-1] in SELF_LOCKING_ROUTES:
+            await self.app(scope, receive, send)
+            return
+        messages = []
+
+        async def held_send(message):
+            messages.append(message)
+
+        try:
+            async with self.locks.hold(user_id):
+                await self.app(scope, receive, held_send)
+        finally:
+            for message in messages:
+                await send(message)
@@ -0,0 +1,300 @@
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from notify import Monitor
+from slowlog import SlowLog
+
+# Log-linear latency buckets over microseconds, HdrHistogram-style with 2
+# bits of precision: 4 buckets per power of two, so a bucket is at most 25%
+# wide. 128 buckets go up to 2^32 us (71 minutes), slower lands in the last
+SUB_BUCKETS = 4
+BUCKETS = 128
+PERCENTILES = (50.0, 99.0, 99.9)
+# /metrics only exports every other power of two as `le`, those are bucket
+# edges so the cumulative counts are exact: 8us, 32us, ... 8.4s
+PROMETHEUS_EDGES = [1 << k for k in range(3, 25, 2)]
+
+# Family = (name, type, help, samples), a sample = (labels, value). In a
+# histogram, le= labels are its buckets and __suffix picks _sum or _count
+Sample = Tuple[Dict[str, str], float]
+Family = Tuple[str, str, str, List[Sample]]
+
+
+def bucket_index(usec: int) -> int:
+    if usec < SUB_BUCKETS:
+        return usec
+    shift = usec.bit_length() - 3
+    return min((shift + 1) * SUB_BUCKETS + (usec >> shift) - SUB_BUCKETS, BUCKETS - 1)
+
+
+def bucket_upper(index: int) -> int:
+    """Exclusive upper edge of a bucket in microseconds."""
+    if index < SUB_BUCKETS:
+        return index + 1
+    shift = index // SUB_BUCKETS - 1
+    return (SUB_BUCKETS + index % SUB_BUCKETS + 1) << shift
+
+
+class LatencyHistogram:
+    __slots__ = ("counts", "count", "usec")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.usec = 0
+
+    def record(self, usec: int):
+        self.counts[bucket_index(usec)] += 1
+        self.count += 1
+        self.usec += usec
+
+    def percentile(self, p: float) -> int:
+        """Upper edge of the bucket the p-th percentile falls in, in microseconds."""
+        if not self.count:
+            return 0
+        rank = max(1, -(-self.count * p // 100))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return bucket_upper(index)
+        return bucket_upper(BUCKETS - 1)
+
+    def cumulative(self, edges: Iterable[int]) -> List[int]:
+        """Observations below each edge (edges must be bucket edges, ascending)."""
+        out = []
+        seen = 0
+        index = 0
+        for edge in edges:
+            while index < BUCKETS and bucket_upper(index) <= edge:
+                seen += self.counts[index]
+                index += 1
+            out.append(seen)
+        return out
+
+
+class CommandStats:
+    __slots__ = ("calls", "failed", "rejected", "latency")
+
+    def __init__(self):
+        self.calls = 0
+        self.failed = 0
+        self.rejected = 0
+        self.latency = LatencyHistogram()
+
+
+class Metrics:
+    """Per-command counters and latency histograms, keyspace hits/misses and
+    HTTP traffic. RESP traffic is counted by the RespServer itself.
+
+    Commands are keyed by (protocol, name): RESP commands by their lowercase
+    name, HTTP requests by the name of the route's handler.
+    """
+
+    def __init__(self):
+        self.commands: Dict[Tuple[str, str], CommandStats] = {}
+        self.keyspace_hits = 0
+        self.keyspace_misses = 0
+        self.net_input_bytes = 0
+        self.net_output_bytes = 0
+
+    def _stats(self, protocol: str, name: str) -> CommandStats:
+        stats = self.commands.get((protocol, name))
+        if stats is None:
+            stats = self.commands[(protocol, name)] = CommandStats()
+        return stats
+
+    def record(self, protocol: str, name: str, started: float, failed: bool = False) -> int:
+        """A command finished, `started` is its time.perf_counter() at the start. Returns its usec."""
+        usec = int((time.perf_counter() - started) * 1_000_000)
+        stats = self._stats(protocol, name)
+        stats.calls += 1
+        if failed:
+            stats.failed += 1
+        stats.latency.record(usec)
+        return usec
+
+    def reject(self, protocol: str, name: str):
+        # refused before it ran (arity, wrong shard), like Redis' rejected_calls
+        self._stats(protocol, name).rejected += 1
+
+    def lookup(self, found: bool):
+        if found:
+            self.keyspace_hits += 1
+        else:
+            self.keyspace_misses += 1
+
+    def reset(self):
+        self.__init__()
+
+    @property
+    def total_calls(self) -> int:
+        return sum(stats.calls for stats in self.commands.values())
+
+    @staticmethod
+    def _info_name(protocol: str, name: str) -> str:
+        return name if protocol == "resp" else f"{protocol}_{name}"
+
+    def commandstats(self) -> Dict[str, Dict[str, float]]:
+        out = {}
+        for (protocol, name), stats in sorted(self.commands.items()):
+            usec = stats.latency.usec
+            out[f"cmdstat_{self._info_name(protocol, name)}"] = {
+                "calls": stats.calls,
+                "usec": usec,
+                "usec_per_call": round(usec / stats.calls, 2) if stats.calls else 0,
+                "rejected_calls": stats.rejected,
+                "failed_calls": stats.failed,
+            }
+        return out
+
+    def latencystats(self) -> Dict[str, Dict[str, int]]:
+        out = {}
+        for (protocol, name), stats in sorted(self.commands.items()):
+            if stats.calls:
+                out[f"latency_percentiles_usec_{self._info_name(protocol, name)}"] = {
+                    f"p{p:g}": stats.latency.percentile(p) for p in PERCENTILES}
+        return out
+
+    def families(self) -> List[Family]:
+        calls, failed, rejected, buckets = [], [], [], []
+        for (protocol, name), stats in sorted(self.commands.items()):
+            labels = {"protocol": protocol, "cmd": name}
+            calls.append((labels, stats.calls))
+            failed.append((labels, stats.failed))
+            rejected.append((labels, stats.rejected))
+            histogram = stats.latency
+            for edge, seen in zip(PROMETHEUS_EDGES, histogram.cumulative(PROMETHEUS_EDGES)):
+                buckets.append(({**labels, "le": _number(edge / 1_000_000)}, seen))
+            buckets.append(({**labels, "le": "+Inf"}, histogram.count))
+            buckets.append(({**labels, "__suffix": "_sum"}, histogram.usec / 1_000_000))
+            buckets.append(({**labels, "__suffix": "_count"}, histogram.count))
+        return [
+            ("vm_redis_commands_total", "counter", "Commands run", calls),
+            ("vm_redis_commands_failed_total", "counter", "Commands that returned an error", failed),
+            ("vm_redis_commands_rejected_total", "counter", "Commands refused before they ran", rejected),
+            ("vm_redis_command_duration_seconds", "histogram", "Command latency", buckets),
+            ("vm_redis_keyspace_hits_total", "counter", "Key lookups that found the key", [({}, self.keyspace_hits)]),
+            ("vm_redis_keyspace_misses_total", "counter", "Key lookups that did not", [({}, self.keyspace_misses)]),
+        ]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def render_prometheus(families: Iterable[Family]) -> str:
+    """The Prometheus text exposition format (version 0.0.4)."""
+    lines = []
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            labels = dict(labels)
+            suffix = labels.pop("__suffix", "_bucket" if "le" in labels else "")
+            label_text = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items())
+            value = _number(value)
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and counts the bytes of its body and response,
+    requests over the slowlog threshold go to the slowlog, all of them to
+    MONITOR while someone watches."""
+
+    def __init__(self, app, metrics: Metrics, slowlog: Optional[SlowLog] = None, monitor: Optional[Monitor] = None):
+        self.app = app
+        self.metrics = metrics
+        self.slowlog = slowlog
+        self.monitor = monitor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        metrics = self.metrics
+        started = time.perf_counter()
+        status = 500
+        received = sent = 0
+
+        async def counted_receive():
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def counted_send(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counted_receive, counted_send)
+        finally:
+            metrics.net_input_bytes += received
+            metrics.net_output_bytes += sent
+            route = scope.get("route")
+            name = getattr(route, "name", None) or "unknown"
+            usec = metrics.record("http", name, started, failed=status >= 400)
+            if self.slowlog is not None and self.slowlog.slow(usec):
+                self.slowlog.add(usec, command_args(scope, name), client=client_addr(scope),
+                                 tenant=scope_tenant(scope), payload=received + sent)
+            if self.monitor is not None and self.monitor.subscribers:
+                self.monitor.feed(command_args(scope, name), client_addr(scope), scope_tenant(scope))
+
+
+def command_args(scope, name: str) -> List[str]:
+    # an HTTP request like a command line: the handler, then path and query parameters
+    args = [name] + [f"{k}={v}" for k, v in scope.get("path_params", {}).items()]
+    return args + [f"{k}={v}" for k, v in parse_qsl(scope.get("query_string", b"").decode(errors="replace"))]
+
+
+def client_addr(scope) -> str:
+    client = scope.get("client")
+    return f"{client[0]}:{client[1]}" if client else ""
+
+
+def scope_tenant(scope) -> Optional[str]:
+    path_params = scope.get("path_params", {})
+    return path_params.get("user_id") or path_params.get("public_key")
+
+
+def merge_prometheus(texts: List[str], label: str) -> str:
+    """Merge the /metrics of several processes, each sample gets label="<index>".
+
+    Samples of one metric have to stay together, so this regroups them by
+    the # HELP/# TYPE header they came under.
+    """
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for index, text in enumerate(texts):
+        current: Optional[List[str]] = None
+        for line in text.splitlines():
+            if line.startswith("# HELP "):
+                name = line.split(" ", 3)[2]
+                if name not in families:
+                    families[name] = ([line], [])
+                current = families[name][1]
+            elif line.startswith("# TYPE "):
+                header = families[line.split(" ", 3)[2]][0]
+                if len(header) == 1:
+                    header.append(line)
+            elif line and current is not None:
+                metric, _, value = line.rpartition(" ")
+                if metric.endswith("}"):
+                    metric = f'{metric[:-1]},{label}="{index}"}}'
+                else:
+                    metric = f'{metric}{{{label}="{index}"}}'
+                current.append(f"{metric} {value}")
+    lines = []
+    for header, samples in families.values():
+        lines += header + samples
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,158 @@
+import asyncio
+import fnmatch
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Sequence, Set, Union
+
+# notify-keyspace-events flags as in Redis. K and E pick the channel kind,
+# the rest the classes of events. A = g$lshzxetd; t, d, m and n are accepted
+# for compatibility but nothing here fires them
+ALL_CLASSES = "g$lshzxetd"
+VALID_FLAGS = set("KE" + ALL_CLASSES + "mnA")
+KEYSPACE = "K"
+KEYEVENT = "E"
+GENERIC = "g"
+STRING = "$"
+LIST = "l"
+SET = "s"
+HASH = "h"
+ZSET = "z"
+EXPIRED = "x"
+EVICTED = "e"
+
+
+def parse_flags(value: str) -> str:
+    """Validate a notify-keyspace-events string, returns it with A expanded."""
+    unknown = set(value) - VALID_FLAGS
+    if unknown:
+        raise ValueError(f"invalid notify-keyspace-events flag(s) '{''.join(sorted(unknown))}'")
+    return value.replace("A", ALL_CLASSES)
+
+
+class Subscriber:
+    """A consumer's bounded queue. When it is full the oldest message goes,
+    the consumer then gets {"type": "dropped", "count": n} before the next
+    one, so a slow client costs at most `limit` messages of memory.
+    """
+
+    __slots__ = ("queue", "dropped", "pattern", "_wakeup")
+
+    def __init__(self, limit: int, pattern: str = "*"):
+        self.queue: Deque[Dict[str, Any]] = deque(maxlen=max(limit, 1))
+        self.dropped = 0
+        self.pattern = pattern
+        self._wakeup = asyncio.Event()
+
+    def push(self, message: Dict[str, Any]):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(message)
+        self._wakeup.set()
+
+    def wants(self, channel: str) -> bool:
+        return self.pattern == "*" or fnmatch.fnmatchcase(channel, self.pattern)
+
+    async def get(self) -> Dict[str, Any]:
+        while not self.queue:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        if self.dropped:
+            dropped, self.dropped = self.dropped, 0
+            return {"type": "dropped", "count": dropped}
+        return self.queue.popleft()
+
+
+class Notifier:
+    """Keyspace and keyevent notifications, per tenant.
+
+    Like Redis with the tenant in place of the db number: a "set" of key
+    "k" in tenant "t" goes out on __keyspace@t__:k (data "set") and on
+    __keyevent@t__:set (data "k"), depending on notify_keyspace_events.
+    Only subscribers of that tenant get them, and when `pubsub` is set they
+    are also published there, so SUBSCRIBE/PSUBSCRIBE receive them as in
+    Redis. With the flags empty or no subscriber for the tenant, notify()
+    returns after a few lookups.
+    """
+
+    def __init__(self, config: Dict[str, str], pubsub=None):
+        self.config = config
+        self.pubsub = pubsub
+        self.subscribers: Dict[str, Set[Subscriber]] = {}
+        self.classes = ""
+        self.keyspace = self.keyevent = False
+        self.configure()
+
+    def configure(self):
+        flags = parse_flags(self.config["notify_keyspace_events"])
+        self.keyspace = KEYSPACE in flags
+        self.keyevent = KEYEVENT in flags
+        # no channel kind, no notifications (same as Redis)
+        self.classes = flags.replace(KEYSPACE, "").replace(KEYEVENT, "") if self.keyspace or self.keyevent else ""
+
+    def subscribe(self, user_id: str, pattern: str = "*") -> Subscriber:
+        subscriber = Subscriber(int(self.config["notify_queue_limit"]), pattern)
+        self.subscribers.setdefault(user_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, user_id: str, subscriber: Subscriber):
+        subscribers = self.subscribers.get(user_id)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[user_id]
+
+    def notify(self, user_id: str, cls: str, event: str, key: str):
+        if cls not in self.classes:
+            return
+        subscribers = self.subscribers.get(user_id)
+        pubsub = self.pubsub if self.pubsub is not None and self.pubsub.has_subscribers(user_id) else None
+        if not subscribers and pubsub is None:
+            return
+        messages = []
+        if self.keyspace:
+            messages.append({"type": "message", "channel": f"__keyspace@{user_id}__:{key}", "data": event})
+        if self.keyevent:
+            messages.append({"type": "message", "channel": f"__keyevent@{user_id}__:{event}", "data": key})
+        if pubsub is not None:
+            for message in messages:
+                pubsub.publish(user_id, message["channel"], message["data"])
+        for subscriber in subscribers or ():
+            for message in messages:
+                if subscriber.wants(message["channel"]):
+                    subscriber.push(message)
+
+    def __len__(self) -> int:
+        return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+
+class Monitor:
+    """MONITOR: every command any client runs, to every monitoring subscriber.
+
+    Lines look like Redis': 1339518083.107412 [tenant 127.0.0.1:60866] "set" "k" "v".
+    Commands are only formatted while someone monitors.
+    """
+
+    def __init__(self, config: Dict[str, str]):
+        self.config = config
+        self.subscribers: Set[Subscriber] = set()
+
+    def subscribe(self) -> Subscriber:
+        subscriber = Subscriber(int(self.config["notify_queue_limit"]))
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        self.subscribers.discard(subscriber)
+
+    def feed(self, args: Sequence[Union[str, bytes]], client: str, tenant: Optional[str]):
+        quoted = " ".join(_quote(arg) for arg in args)
+        message = {"type": "monitor", "line": f"{time.time():.6f} [{tenant or '-'} {client}] {quoted}"}
+        for subscriber in self.subscribers:
+            subscriber.push(message)
+
+
+def _quote(arg: Union[str, bytes]) -> str:
+    # like Redis' sdscatrepr: printable as is, the rest escaped
+    if isinstance(arg, (bytes, bytearray, memoryview)):
+        arg = bytes(arg).decode("latin-1")
+    return '"' + arg.encode("unicode_escape").decode("ascii").replace('"', '\\"') + '"'
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from keyspace import Keyspace
+from snapshot import iter_snapshot, write_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Wait this long before retrying after a failed background save (Redis uses 5s too)
+BGSAVE_RETRY_DELAY = 5
+
+
+def parse_save_policy(policy: str) -> List[Tuple[int, int]]:
+    """'3600 1 300 100' -> [(3600, 1), (300, 100)], an empty string disables saving."""
+    parts = policy.split()
+    if len(parts) % 2:
+        raise ValueError("save policy needs <seconds> <changes> pairs")
+    return [(int(parts[i]), int(parts[i + 1])) for i in range(0, len(parts), 2)]
+
+
+def _write_snapshot_sync(path: str, tenants) -> int:
+    tmp_path = f"{path}.tmp"
+    size = 0
+    with open(tmp_path, "wb") as f:
+        for chunk in iter_snapshot(tenants):
+            f.write(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return size
+
+
+async def fork_snapshot(path: str, tenants) -> int:
+    """Write a snapshot of `tenants` from a forked child, returns its size.
+
+    The fork happens before this coroutine first yields, so the snapshot is
+    exactly the state at the moment it was awaited.
+    """
+    pid = os.fork()
+    if pid == 0:
+        # child: only touch the inherited snapshot, then leave without
+        # running any of the parent's atexit/cleanup code
+        status = 1
+        try:
+            _write_snapshot_sync(path, tenants)
+            status = 0
+        finally:
+            os._exit(status)
+    _, status = await asyncio.get_running_loop().run_in_executor(None, os.waitpid, pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"snapshot child exited with status {status}")
+    return os.path.getsize(path)
+
+
+class Persistence:
+    """Background RDB saves and the `save <seconds> <changes>` policies.
+
+    BGSAVE forks: the child inherits a copy-on-write image of user_data,
+    writes it out and exits, while the parent keeps serving. Where fork()
+    is missing the snapshot is streamed from a task in this process instead.
+    """
+
+    def __init__(self, user_data: Dict[str, Keyspace], config: Dict[str, str]):
+        self.user_data = user_data
+        self.config = config
+        self.dirty = 0  # changes since the last successful save
+        self.last_save = time.time()
+        self.last_status = "ok"
+        self.last_duration: Optional[float] = None
+        self.last_size: Optional[int] = None
+        self.last_attempt = 0.0
+        self.saves = 0
+        self._bgsave_started: Optional[float] = None
+        self._bgsave_task: Optional[asyncio.Task] = None
+        self._policy_task: Optional[asyncio.Task] = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.config["dir"], self.config["dbfilename"])
+
+    @property
+    def in_progress(self) -> bool:
+        return self._bgsave_task is not None and not self._bgsave_task.done()
+
+    def changed(self, count: int = 1):
+        self.dirty += count
+
+    def bgsave(self) -> bool:
+        """Start a background save, False if one is already running."""
+        if self.in_progress:
+            return False
+        self._bgsave_started = time.time()
+        self.last_attempt = self._bgsave_started
+        self._bgsave_task = asyncio.get_running_loop().create_task(self._run_bgsave(self.dirty))
+        return True
+
+    async def _run_bgsave(self, dirty_at_start: int):
+        started = time.monotonic()
+        try:
+            if hasattr(os, "fork"):
+                size = await self._fork_save()
+            else:
+                size = await write_snapshot(self.path, list(self.user_data.items()))
+        except Exception as e:
+            logger.error(f"Background saving error: {str(e)}")
+            self.last_status = "err"
+            return
+        finally:
+            self.last_duration = time.monotonic() - started
+            self._bgsave_started = None
+        self.dirty -= dirty_at_start
+        self.last_save = time.time()
+        self.last_status = "ok"
+        self.last_size = size
+        self.saves += 1
+        logger.info(f"Background saving terminated with success ({size} bytes)")
+
+    async def _fork_save(self) -> int:
+        return await fork_snapshot(self.path, list(self.user_data.items()))
+
+    def save_due(self, now: float) -> bool:
+        if self.in_progress or not self.dirty:
+            return False
+        if self.last_status != "ok" and now - self.last_attempt < BGSAVE_RETRY_DELAY:
+            return False
+        for seconds, changes in parse_save_policy(self.config.get("save", "")):
+            if self.dirty >= changes and now - self.last_save >= seconds:
+                return True
+        return False
+
+    async def run_policies(self):
+        while True:
+            await asyncio.sleep(1)
+            try:
+                if self.save_due(time.time()):
+                    logger.info(f"{self.dirty} changes since last save, saving in background")
+                    self.bgsave()
+            except ValueError as e:
+                logger.error(f"Invalid save policy: {str(e)}")
+
+    def start(self):
+        if self._policy_task is None:
+            self._policy_task = asyncio.get_running_loop().create_task(self.run_policies())
+
+    async def stop(self):
+        for task in (self._policy_task, self._bgsave_task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._policy_task = None
+
+    def info(self) -> Dict[str, object]:
+        return {
+            "rdb_changes_since_last_save": self.dirty,
+            "rdb_bgsave_in_progress": int(self.in_progress),
+            "rdb_last_save_time": int(self.last_save),
+            "rdb_last_bgsave_status": self.last_status,
+            "rdb_last_bgsave_time_sec": round(self.last_duration, 3) if self.last_duration is not None else -1,
+            "rdb_current_bgsave_time_sec": round(time.time() - self._bgsave_started, 3) if self._bgsave_started else -1,
+            "rdb_last_snapshot_bytes": self.last_size if self.last_size is not None else -1,
+            "rdb_saves": self.saves,
+        }
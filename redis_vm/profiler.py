@@ -0,0 +1,153 @@
+import asyncio
+import gc
+import os
+import sys
+import threading
+import tracemalloc
+from collections import Counter
+from types import FunctionType, ModuleType
+from typing import Any, Dict, List, Tuple
+
+from blobstore import BlobRef
+from keyspace import Keyspace
+from scan import type_name
+
+MAX_PROFILE_SECONDS = 60
+MAX_PROFILE_HZ = 1000
+# keys sized between two yields to the event loop in memory_by_tenant()
+SIZE_BATCH = 1000
+# not counted, shared by everything
+_SHARED = (type, ModuleType, FunctionType)
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class SamplingProfiler:
+    """Statistical profiler for the event loop thread.
+
+    While a profile runs, a helper thread wakes up `hz` times a second and
+    records the loop thread's current stack (sys._current_frames()), so
+    the loop itself runs unmodified. When no profile runs there is no
+    thread and nothing to pay. Time the loop spends waiting for I/O shows
+    up under selectors.py:select.
+    """
+
+    def __init__(self):
+        self.running = False
+
+    async def profile(self, seconds: float, hz: int) -> Counter:
+        """Sample for `seconds`, returns {collapsed stack: samples}."""
+        if self.running:
+            raise ProfilerBusy("A profile is already being taken")
+        self.running = True
+        target = threading.get_ident()
+        stacks: Counter = Counter()
+        stop = threading.Event()
+
+        def sample():
+            interval = 1.0 / hz
+            while not stop.wait(interval):
+                frame = sys._current_frames().get(target)
+                if frame is not None:
+                    stacks[collapse(frame)] += 1
+
+        thread = threading.Thread(target=sample, name="vm-redis-profiler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            thread.join()
+            self.running = False
+        return stacks
+
+
+def collapse(frame) -> str:
+    # root first, "file.py:function" per frame, the format flamegraph.pl and speedscope read
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def collapsed_text(stacks: Counter) -> str:
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def top_functions(stacks: Counter, limit: int) -> List[Dict[str, Any]]:
+    # self = samples with the function on top of the stack, total = anywhere on it
+    own: Counter = Counter()
+    total: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for name in set(frames):
+            total[name] += count
+    samples = sum(stacks.values()) or 1
+    return [{"function": name, "self": n, "self_pct": round(100 * n / samples, 2),
+             "total": total[name], "total_pct": round(100 * total[name] / samples, 2)}
+            for name, n in own.most_common(limit)]
+
+
+def deep_size(obj: Any, seen: set) -> int:
+    """Bytes of `obj` and everything only it references, objects in `seen` excluded."""
+    size = 0
+    pending = [obj]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        # a BlobRef's blob is on disk, walking it would reach the whole store
+        if not isinstance(obj, BlobRef):
+            pending.extend(gc.get_referents(obj))
+    return size
+
+
+async def memory_by_tenant(user_data: Dict[str, Keyspace]) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """RAM of every tenant's keys split by value type, measured object by object.
+
+    tracemalloc's traces carry no object identity, so the split walks the
+    keyspaces instead. It yields to the event loop every SIZE_BATCH keys.
+    """
+    tenants: Dict[str, Any] = {}
+    types: Counter = Counter()
+    for user_id, keyspace in list(user_data.items()):
+        seen: set = set()
+        by_type: Counter = Counter()
+        items = [(key, entry, False) for key, entry in keyspace.data.items()]
+        items += [(key, entry, True) for key, entry in keyspace.files.items()]
+        for i, (key, entry, is_file) in enumerate(items):
+            by_type[type_name(entry, is_file)] += deep_size(key, seen) + deep_size(entry, seen)
+            if i % SIZE_BATCH == SIZE_BATCH - 1:
+                await asyncio.sleep(0)
+        tenants[user_id] = {
+            "bytes": sum(by_type.values()),
+            "accounted": keyspace.memory,  # what maxmemory sees
+            "keys": len(items),
+            "by_type": dict(by_type),
+        }
+        types.update(by_type)
+    return tenants, dict(types)
+
+
+def tracemalloc_report(limit: int, group: str) -> Dict[str, Any]:
+    """Live allocations since tracing started, by source line or file. Slow, run it in a thread."""
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ))
+    stats = snapshot.statistics(group)
+    return {
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "frames": tracemalloc.get_traceback_limit(),
+        "top": [{"site": [str(frame) for frame in stat.traceback] if group == "traceback" else str(stat.traceback),
+                 "bytes": stat.size, "count": stat.count} for stat in stats[:limit]],
+    }
@@ -0,0 +1,382 @@
+import asyncio
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+
+# Bytes a message costs besides its channel, pattern and data, roughly what
+# it takes as JSON on the wire
+MESSAGE_OVERHEAD = 48
+
+
+def _tokens(pattern: str) -> List[Tuple[str, Any]]:
+    """A glob as Redis' stringmatch reads it: ('c', char), ('?', None), ('*', None)
+    or ('[', (text, negate, chars, ranges)). Backslash escapes the next char."""
+    tokens: List[Tuple[str, Any]] = []
+    i, n = 0, len(pattern)
+    while i < n:
+        ch = pattern[i]
+        if ch == "*":
+            # ** is *
+            if not tokens or tokens[-1][0] != "*":
+                tokens.append(("*", None))
+        elif ch == "?":
+            tokens.append(("?", None))
+        elif ch == "[":
+            start = i
+            i += 1
+            negate = i < n and pattern[i] == "^"
+            if negate:
+                i += 1
+            chars, ranges = set(), []
+            # like Redis an unclosed class runs to the end of the pattern
+            while i < n and pattern[i] != "]":
+                if pattern[i] == "\\" and i + 1 < n:
+                    i += 1
+                    chars.add(pattern[i])
+                elif i + 2 < n and pattern[i + 1] == "-" and pattern[i + 2] != "]":
+                    low, high = sorted((pattern[i], pattern[i + 2]))
+                    ranges.append((low, high))
+                    i += 2
+                else:
+                    chars.add(pattern[i])
+                i += 1
+            tokens.append(("[", (pattern[start:i + 1], negate, frozenset(chars), tuple(ranges))))
+        elif ch == "\\" and i + 1 < n:
+            i += 1
+            tokens.append(("c", pattern[i]))
+        else:
+            tokens.append(("c", ch))
+        i += 1
+    return tokens
+
+
+def _in_class(char_class, ch: str) -> bool:
+    _, negate, chars, ranges = char_class
+    found = ch in chars or any(low <= ch <= high for low, high in ranges)
+    return found != negate
+
+
+class _Node:
+    __slots__ = ("chars", "any", "classes", "star", "loops", "patterns")
+
+    def __init__(self, loops: bool = False):
+        self.chars: Dict[str, "_Node"] = {}
+        self.any: Optional[_Node] = None  # ?
+        self.classes: Dict[str, Tuple[Any, _Node]] = {}  # [...] by its text
+        self.star: Optional[_Node] = None  # *, a node that loops on every char
+        self.loops = loops
+        self.patterns: Set[str] = set()  # the ones ending here, "a*" and "a**" both end on one node
+
+    def empty(self) -> bool:
+        return not (self.chars or self.any or self.classes or self.star or self.patterns)
+
+
+class GlobTrie:
+    """Glob patterns compiled into one trie, matched all at once.
+
+    Patterns share their common prefixes, so match() walks the channel once
+    with the set of trie nodes it could be at (an NFA); what a publish costs
+    depends on the channel and the patterns that are still alive along it,
+    not on how many patterns there are in all.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+        self.count = 0
+
+    def add(self, pattern: str):
+        node = self.root
+        for kind, value in _tokens(pattern):
+            if kind == "c":
+                node = node.chars.setdefault(value, _Node())
+            elif kind == "?":
+                node.any = node.any or _Node()
+                node = node.any
+            elif kind == "[":
+                if value[0] not in node.classes:
+                    node.classes[value[0]] = (value, _Node())
+                node = node.classes[value[0]][1]
+            else:
+                node.star = node.star or _Node(loops=True)
+                node = node.star
+        if pattern not in node.patterns:
+            node.patterns.add(pattern)
+            self.count += 1
+
+    def remove(self, pattern: str):
+        node = self.root
+        path = []
+        for kind, value in _tokens(pattern):
+            path.append((node, kind, value))
+            if kind == "c":
+                node = node.chars.get(value)
+            elif kind == "?":
+                node = node.any
+            elif kind == "[":
+                node = node.classes.get(value[0], (None, None))[1]
+            else:
+                node = node.star
+            if node is None:
+                return
+        if pattern not in node.patterns:
+            return
+        node.patterns.remove(pattern)
+        self.count -= 1
+        # prune what only this pattern used
+        for parent, kind, value in reversed(path):
+            if not node.empty():
+                break
+            if kind == "c":
+                del parent.chars[value]
+            elif kind == "?":
+                parent.any = None
+            elif kind == "[":
+                del parent.classes[value[0]]
+            else:
+                parent.star = None
+            node = parent
+
+    @staticmethod
+    def _closure(nodes: Iterable[_Node]) -> Set[_Node]:
+        # a * also matches nothing; ** never happens, so one step is enough
+        states = set(nodes)
+        for node in list(states):
+            if node.star is not None:
+                states.add(node.star)
+        return states
+
+    def match(self, channel: str) -> List[str]:
+        """Every pattern that matches the channel."""
+        states = self._closure((self.root,))
+        for ch in channel:
+            following = []
+            for node in states:
+                if node.loops:
+                    following.append(node)
+                child = node.chars.get(ch)
+                if child is not None:
+                    following.append(child)
+                if node.any is not None:
+                    following.append(node.any)
+                for char_class, child in node.classes.values():
+                    if _in_class(char_class, ch):
+                        following.append(child)
+            if not following:
+                return []
+            states = self._closure(following)
+        return [pattern for node in states for pattern in node.patterns]
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class PubSubClient:
+    """One subscribed connection: what it subscribed to and the messages it
+    has not taken yet. Going over `limit` bytes of those closes it, like
+    Redis' client-output-buffer-limit pubsub.
+    """
+
+    __slots__ = ("user_id", "channels", "patterns", "queue", "buffered", "limit", "closed", "connected", "_wakeup")
+
+    def __init__(self, user_id: str, limit: int):
+        self.user_id = user_id
+        self.channels: Set[str] = set()
+        self.patterns: Set[str] = set()
+        self.queue: Deque[Tuple[Dict[str, Any], int]] = deque()
+        self.buffered = 0
+        self.limit = limit
+        self.closed = False
+        self.connected = True
+        self._wakeup = asyncio.Event()
+
+    @property
+    def subscriptions(self) -> int:
+        return len(self.channels) + len(self.patterns)
+
+    def push(self, message: Dict[str, Any], size: int = MESSAGE_OVERHEAD) -> bool:
+        """Queue a message, False once the client is over its limit (it is closed then)."""
+        if self.closed:
+            return False
+        self.buffered += size
+        if self.limit and self.buffered > self.limit:
+            self.closed = True
+            self.queue.clear()
+            self.buffered = 0
+        else:
+            self.queue.append((message, size))
+        self._wakeup.set()
+        return not self.closed
+
+    async def get(self) -> Optional[Dict[str, Any]]:
+        """The next message, None when the client was closed."""
+        while not self.queue and not self.closed:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        if self.closed:
+            return None
+        message, size = self.queue.popleft()
+        self.buffered -= size
+        return message
+
+
+class _Tenant:
+    __slots__ = ("channels", "patterns", "trie")
+
+    def __init__(self):
+        self.channels: Dict[str, Set[PubSubClient]] = {}
+        self.patterns: Dict[str, Set[PubSubClient]] = {}
+        self.trie = GlobTrie()
+
+
+class PubSub:
+    """PUBLISH/SUBSCRIBE/PSUBSCRIBE, each tenant with its own channel namespace.
+
+    Messages and replies are dicts shaped like redis-py's: {"type": "message",
+    "channel", "data"}, {"type": "pmessage", "pattern", ...} and
+    {"type": "subscribe", "channel", "count"}. A published message is one
+    dict shared by all its receivers.
+    """
+
+    def __init__(self, config: Dict[str, str]):
+        self.config = config
+        self.tenants: Dict[str, _Tenant] = {}
+        self.clients = 0
+        self.published = 0
+        self.slow_disconnects = 0
+
+    def connect(self, user_id: str) -> PubSubClient:
+        self.clients += 1
+        return PubSubClient(user_id, int(self.config["pubsub_buffer_limit"]))
+
+    def disconnect(self, client: PubSubClient):
+        if not client.connected:
+            return
+        self.unsubscribe(client, reply=False)
+        self.punsubscribe(client, reply=False)
+        self.clients -= 1
+        client.connected = False
+        client.closed = True
+        client._wakeup.set()
+
+    @staticmethod
+    def _reply(client: PubSubClient, kind: str, channel: Optional[str]):
+        client.push({"type": kind, "channel": channel, "count": client.subscriptions})
+
+    def subscribe(self, client: PubSubClient, channels: Iterable[str]):
+        tenant = self.tenants.get(client.user_id) or self.tenants.setdefault(client.user_id, _Tenant())
+        for channel in channels:
+            tenant.channels.setdefault(channel, set()).add(client)
+            client.channels.add(channel)
+            self._reply(client, "subscribe", channel)
+
+    def psubscribe(self, client: PubSubClient, patterns: Iterable[str]):
+        tenant = self.tenants.get(client.user_id) or self.tenants.setdefault(client.user_id, _Tenant())
+        for pattern in patterns:
+            if pattern not in tenant.patterns:
+                tenant.patterns[pattern] = set()
+                tenant.trie.add(pattern)
+            tenant.patterns[pattern].add(client)
+            client.patterns.add(pattern)
+            self._reply(client, "psubscribe", pattern)
+
+    def unsubscribe(self, client: PubSubClient, channels: Optional[Iterable[str]] = None, reply: bool = True):
+        """Leave the channels, all of them if None."""
+        tenant = self.tenants.get(client.user_id)
+        channels = list(client.channels if channels is None else channels)
+        if not channels and reply:
+            self._reply(client, "unsubscribe", None)
+        for channel in channels:
+            client.channels.discard(channel)
+            clients = tenant.channels.get(channel) if tenant is not None else None
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del tenant.channels[channel]
+            if reply:
+                self._reply(client, "unsubscribe", channel)
+        self._forget_empty(client.user_id)
+
+    def punsubscribe(self, client: PubSubClient, patterns: Optional[Iterable[str]] = None, reply: bool = True):
+        tenant = self.tenants.get(client.user_id)
+        patterns = list(client.patterns if patterns is None else patterns)
+        if not patterns and reply:
+            self._reply(client, "punsubscribe", None)
+        for pattern in patterns:
+            client.patterns.discard(pattern)
+            clients = tenant.patterns.get(pattern) if tenant is not None else None
+            if clients is not None:
+                clients.discard(client)
+                if not clients:
+                    del tenant.patterns[pattern]
+                    tenant.trie.remove(pattern)
+            if reply:
+                self._reply(client, "punsubscribe", pattern)
+        self._forget_empty(client.user_id)
+
+    def _forget_empty(self, user_id: str):
+        tenant = self.tenants.get(user_id)
+        if tenant is not None and not tenant.channels and not tenant.patterns:
+            del self.tenants[user_id]
+
+    def has_subscribers(self, user_id: str) -> bool:
+        return user_id in self.tenants
+
+    def publish(self, user_id: str, channel: str, data: str) -> int:
+        """Deliver to the channel's and matching patterns' subscribers, returns how many got it."""
+        self.published += 1
+        tenant = self.tenants.get(user_id)
+        if tenant is None:
+            return 0
+        receivers = 0
+        slow = []
+        size = MESSAGE_OVERHEAD + len(channel) + len(data)
+        clients = tenant.channels.get(channel)
+        if clients:
+            message = {"type": "message", "channel": channel, "data": data}
+            for client in clients:
+                if client.push(message, size):
+                    receivers += 1
+                else:
+                    slow.append(client)
+        if tenant.patterns:
+            for pattern in tenant.trie.match(channel):
+                message = {"type": "pmessage", "pattern": pattern, "channel": channel, "data": data}
+                for client in tenant.patterns[pattern]:
+                    if client.push(message, size + len(pattern)):
+                        receivers += 1
+                    else:
+                        slow.append(client)
+        # dropped after the loops, they change the sets being walked
+        for client in slow:
+            if client.subscriptions:
+                self.slow_disconnects += 1
+                self.unsubscribe(client, reply=False)
+                self.punsubscribe(client, reply=False)
+        return receivers
+
+    def channels(self, user_id: str, pattern: Optional[str] = None) -> List[str]:
+        """PUBSUB CHANNELS: channels with at least one subscriber."""
+        tenant = self.tenants.get(user_id)
+        if tenant is None:
+            return []
+        if pattern is None:
+            return sorted(tenant.channels)
+        trie = GlobTrie()
+        trie.add(pattern)
+        return sorted(channel for channel in tenant.channels if trie.match(channel))
+
+    def numsub(self, user_id: str, channels: Iterable[str]) -> Dict[str, int]:
+        tenant = self.tenants.get(user_id)
+        return {channel: len(tenant.channels.get(channel, ())) if tenant is not None else 0 for channel in channels}
+
+    def numpat(self, user_id: str) -> int:
+        tenant = self.tenants.get(user_id)
+        return len(tenant.patterns) if tenant is not None else 0
+
+    def info(self) -> Dict[str, int]:
+        return {
+            "pubsub_channels": sum(len(tenant.channels) for tenant in self.tenants.values()),
+            "pubsub_patterns": sum(len(tenant.patterns) for tenant in self.tenants.values()),
+            "pubsub_clients": self.clients,
+            "pubsub_published_messages": self.published,
+            "client_output_buffer_limit_disconnections": self.slow_disconnects,
+        }
@@ -1,3 +1,4 @@
+import json
 import requests
 
 class KeyValueClient:
@@ -31,10 +32,37 @@ class KeyValueClient:
         response = requests.get(f"{self.base_url}/user/{user_id}/keys")
         return response.json()
 
-    def get_all_users(self):
-        response = requests.get(f"{self.base_url}/users")
+    def user_exists(self, user_id):
+        response = requests.get(f"{self.base_url}/users/{user_id}/exists")
+        return response.json()["exists"]
+
+    def get_user(self, user_id):
+        # key count, bytes used and tier of one tenant
+        response = requests.get(f"{self.base_url}/users/{user_id}")
+        return response.json()
+
+    def list_users(self, after=None, limit=100):
+        response = requests.get(f"{self.base_url}/users", params={"after": after, "limit": limit})
         return response.json()
 
+    def get_all_users(self):
+        # summaries of every tenant, walking the pages
+        users = []
+        after = None
+        while True:
+            page = self.list_users(after)
+            users += page["users"]
+            after = page["next"]
+            if after is None:
+                return users
+
+    def export_users(self, include_files=False):
+        # yields one dict per record of the NDJSON export
+        response = requests.get(f"{self.base_url}/users/export", params={"include_files": include_files}, stream=True)
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
     def delete_key(self, user_id: str, key: str):
         response = requests.delete(f"{self.base_url}/user/{user_id}/key/{key}")
         return response.json()
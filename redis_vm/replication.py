@@ -0,0 +1,407 @@
+"""Primary/replica replication over the AOF record stream.
+
+The replication stream is the sequence of AOF records (aof.py) the primary
+applies, and the replication offset counts its bytes. Replicas connect to
+the RESP port (resp.py) and send inline commands, like redis-cli does:
+
+    replica: PSYNC <replid> <offset>
+    primary: +CONTINUE <replid>              then the stream from <offset>
+         or: +FULLRESYNC <replid> <offset>   then a snapshot (snapshot.py, it
+                                             ends itself) and the stream from <offset>
+    replica: REPLCONF ACK <offset>           once a second
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from aof import AOFError, Record, cmd_ping, parse_frame
+from keyspace import Keyspace
+from persistence import fork_snapshot
+from snapshot import CHUNK_SIZE, SnapshotLoader, stream_snapshot
+
+logger = logging.getLogger(__name__)
+
+# Same defaults as Redis: 1MB backlog, PING every 10s, drop a replica whose
+# output buffer passes 256MB
+REPL_BACKLOG_SIZE = 1024 * 1024
+REPL_PING_PERIOD = 10
+REPL_OUTPUT_LIMIT = 256 * 1024 * 1024
+REPL_ACK_PERIOD = 1
+REPL_RECONNECT_DELAY = 1
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def new_replid() -> str:
+    return os.urandom(20).hex()
+
+
+class Backlog:
+    """Ring buffer holding the last `size` bytes of the stream."""
+
+    def __init__(self, size: int, offset: int):
+        self.buf = bytearray(size)
+        self.size = size
+        self.idx = 0  # where the next byte goes
+        self.histlen = 0
+        self.end_offset = offset  # stream offset right after the newest byte
+
+    @property
+    def first_offset(self) -> int:
+        return self.end_offset - self.histlen
+
+    def append(self, data):
+        n = len(data)
+        self.end_offset += n
+        if n >= self.size:
+            self.buf[:] = data[n - self.size:]
+            self.idx = 0
+            self.histlen = self.size
+            return
+        first = min(n, self.size - self.idx)
+        self.buf[self.idx:self.idx + first] = data[:first]
+        if first < n:
+            self.buf[:n - first] = data[first:]
+        self.idx = (self.idx + n) % self.size
+        self.histlen = min(self.size, self.histlen + n)
+
+    def read_from(self, offset: int) -> Optional[bytes]:
+        """Everything from `offset` to the end, None if it's no longer (or not yet) held."""
+        count = self.end_offset - offset
+        if count < 0 or count > self.histlen:
+            return None
+        start = (self.idx - count) % self.size
+        if start + count <= self.size:
+            return bytes(self.buf[start:start + count])
+        return bytes(self.buf[start:]) + bytes(self.buf[:count - (self.size - start)])
+
+
+class ReplicaLink:
+    """A connected replica as seen from the primary."""
+
+    __slots__ = ("sink", "addr", "state", "ack_offset", "last_ack", "pending")
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.addr = sink.addr
+        self.state = "wait_bgsave"
+        self.ack_offset = 0
+        self.last_ack = time.time()
+        # stream bytes produced while the snapshot is still on its way
+        self.pending: Optional[bytearray] = bytearray()
+
+
+class Replication:
+    """Replication state for either role.
+
+    As a primary every record goes through feed(), which advances the
+    offset, fills the backlog and writes to online replicas. As a replica
+    the same happens with the records received from the primary, so a
+    replica keeps the primary's replid/offset and can serve replicas itself.
+    Applying received data is left to the callbacks set by the app.
+    """
+
+    def __init__(self, user_data: Dict[str, Keyspace], config: Dict[str, str]):
+        self.user_data = user_data
+        self.config = config
+        self.replid = new_replid()
+        self.replid2 = "0" * 40
+        self.second_offset = -1
+        self.offset = 0
+        self.backlog: Optional[Backlog] = None
+        self.replicas: List[ReplicaLink] = []
+        self.sync_full = 0
+        self.sync_partial_ok = 0
+        self.sync_partial_err = 0
+        self.master: Optional[tuple] = None
+        self.link_status = "down"
+        self.sync_in_progress = False
+        self.last_io = 0.0
+        # replica side: on_flush() before a full sync, on_tenant(user_id,
+        # keyspace) for each loaded tenant, on_record(frame) per record
+        self.on_flush: Optional[Callable[[], None]] = None
+        self.on_tenant: Optional[Callable[[str, Keyspace], None]] = None
+        self.on_record: Optional[Callable[[bytes], None]] = None
+        self._replica_task: Optional[asyncio.Task] = None
+        self._ping_task: Optional[asyncio.Task] = None
+        self._sync_config()
+
+    @property
+    def is_replica(self) -> bool:
+        return self.master is not None
+
+    def _sync_config(self):
+        self.config["master_replid"] = self.replid
+        self.config["master_repl_offset"] = str(self.offset)
+
+    def feed(self, record: Record):
+        for part in record:
+            self.offset += len(part)
+            if self.backlog is not None:
+                self.backlog.append(part)
+            for link in self.replicas:
+                self._send(link, part)
+        self.config["master_repl_offset"] = str(self.offset)
+
+    @property
+    def has_backlog(self) -> bool:
+        # until a replica shows up nobody can ask for the stream
+        return self.backlog is not None
+
+    def _send(self, link: ReplicaLink, data):
+        if link.pending is not None:
+            link.pending += data
+            buffered = len(link.pending)
+        else:
+            link.sink.write(data)
+            buffered = link.sink.buffer_size()
+        if buffered > int(self.config.get("repl_output_limit", REPL_OUTPUT_LIMIT)):
+            logger.warning(f"Replica {link.addr} output buffer over the limit, disconnecting it")
+            self.drop(link)
+
+    def drop(self, link: ReplicaLink):
+        if link in self.replicas:
+            self.replicas.remove(link)
+            link.sink.close()
+
+    def _create_backlog(self):
+        if self.backlog is None:
+            size = int(self.config.get("repl_backlog_size", REPL_BACKLOG_SIZE))
+            self.backlog = Backlog(size, self.offset)
+
+    def can_continue(self, replid: str, offset: int) -> bool:
+        if replid != self.replid and not (replid == self.replid2 and offset <= self.second_offset):
+            return False
+        return self.backlog is not None and self.backlog.first_offset <= offset <= self.offset
+
+    # -- primary side --
+
+    async def serve_psync(self, sink, replid: str, offset: int) -> Optional[ReplicaLink]:
+        """Answer a PSYNC on `sink` and turn it into a replica link.
+
+        `sink` is the client connection: write(), buffer_size(), async
+        drain(), close() and addr. Returns None if the replica went away
+        during a full sync.
+        """
+        self._create_backlog()
+        link = ReplicaLink(sink)
+        if self.can_continue(replid, offset):
+            self.sync_partial_ok += 1
+            sink.write(f"+CONTINUE {self.replid}\r\n".encode())
+            sink.write(self.backlog.read_from(offset))
+            link.pending = None
+            link.state = "online"
+            link.ack_offset = offset
+            self.replicas.append(link)
+            self._start_ping()
+            logger.info(f"Partial resync with replica {link.addr} from offset {offset}")
+            return link
+        if replid != "?":
+            self.sync_partial_err += 1
+        self.sync_full += 1
+        # the snapshot has to match this offset exactly, so nothing may run
+        # between registering the link and taking the snapshot
+        self.replicas.append(link)
+        sink.write(f"+FULLRESYNC {self.replid} {self.offset}\r\n".encode())
+        link.ack_offset = self.offset
+        tenants = list(self.user_data.items())
+        tmp_path = None
+        try:
+            if hasattr(os, "fork"):
+                tmp_path = os.path.join(self.config["dir"], f"repl-{os.getpid()}-{id(link)}.rdb")
+                await fork_snapshot(tmp_path, tenants)
+                with open(tmp_path, "rb") as f:
+                    while link in self.replicas:
+                        chunk = f.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sink.write(chunk)
+                        await sink.drain()
+            else:
+                # without fork the snapshot is taken while writes go on;
+                # replaying the pending stream on top converges to the same data
+                async for chunk in stream_snapshot(tenants):
+                    sink.write(chunk)
+                    await sink.drain()
+        except (OSError, RuntimeError) as e:
+            logger.warning(f"Full resync with replica {link.addr} failed: {str(e)}")
+            self.drop(link)
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        if link not in self.replicas:
+            return None
+        sink.write(link.pending)
+        link.pending = None
+        link.state = "online"
+        self._start_ping()
+        logger.info(f"Full resync with replica {link.addr} done")
+        return link
+
+    def ack(self, link: ReplicaLink, offset: int):
+        link.ack_offset = offset
+        link.last_ack = time.time()
+
+    def _start_ping(self):
+        if self._ping_task is None or self._ping_task.done():
+            self._ping_task = asyncio.get_running_loop().create_task(self._ping_replicas())
+
+    async def _ping_replicas(self):
+        # keeps replicas' last_io fresh; a replica forwards its primary's pings instead
+        while self.replicas:
+            await asyncio.sleep(int(self.config.get("repl_ping_period", REPL_PING_PERIOD)))
+            if not self.is_replica and self.replicas:
+                self.feed(cmd_ping())
+
+    # -- replica side --
+
+    def replicate_from(self, host: str, port: int):
+        self.stop_replica()
+        self.master = (host, port)
+        self._replica_task = asyncio.get_running_loop().create_task(self._run_replica(host, port))
+
+    def promote(self):
+        """Stop replicating and become a primary, keeping the data and the offset.
+
+        The old replid stays valid up to the current offset, so the other
+        replicas of the old primary can partially resync with us.
+        """
+        self.stop_replica()
+        self.replid2 = self.replid
+        self.second_offset = self.offset
+        self.replid = new_replid()
+        self._sync_config()
+
+    def stop_replica(self):
+        if self._replica_task is not None:
+            self._replica_task.cancel()
+            self._replica_task = None
+        self.master = None
+        self.link_status = "down"
+        self.sync_in_progress = False
+
+    async def _run_replica(self, host: str, port: int):
+        while True:
+            writer = None
+            try:
+                self.link_status = "connecting"
+                reader, writer = await asyncio.open_connection(host, port)
+                await self._sync_with_master(reader, writer)
+            except (OSError, ReplicationError, AOFError, asyncio.IncompleteReadError) as e:
+                logger.warning(f"Replication link to {host}:{port} broken: {str(e)}")
+            finally:
+                self.link_status = "down"
+                self.sync_in_progress = False
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(REPL_RECONNECT_DELAY)
+
+    async def _sync_with_master(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        writer.write(f"PSYNC {self.replid} {self.offset}\r\n".encode())
+        reply = (await reader.readline()).decode(errors="replace").split()
+        self.last_io = time.time()
+        if reply[:1] == ["+FULLRESYNC"] and len(reply) == 3:
+            self.sync_in_progress = True
+            self.on_flush()
+            loader = SnapshotLoader()
+            while not loader.done:
+                chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    raise ReplicationError("Primary closed the connection during the full sync")
+                self.last_io = time.time()
+                for user_id, keyspace in loader.feed(chunk):
+                    self.on_tenant(user_id, keyspace)
+            buffer = bytearray(loader.buffer)
+            self.replid = reply[1]
+            self.replid2, self.second_offset = "0" * 40, -1
+            self.offset = int(reply[2])
+            # the old history doesn't lead up to the new offset
+            self.backlog = None
+            self._create_backlog()
+            self.sync_in_progress = False
+            logger.info(f"Full resync from primary done, offset {self.offset}")
+        elif reply[:1] == ["+CONTINUE"]:
+            if len(reply) == 2 and reply[1] != self.replid:
+                self.replid2, self.second_offset = self.replid, self.offset
+                self.replid = reply[1]
+            buffer = bytearray()
+            logger.info(f"Partial resync from primary at offset {self.offset}")
+        else:
+            raise ReplicationError(f"PSYNC refused: {' '.join(reply)}")
+        self._sync_config()
+        self.link_status = "up"
+        ack_task = asyncio.get_running_loop().create_task(self._send_acks(writer))
+        try:
+            while True:
+                pos = 0
+                while True:
+                    end = parse_frame(buffer, pos)
+                    if end is None:
+                        break
+                    frame = bytes(buffer[pos:end])
+                    self.on_record(frame)
+                    self.feed((frame,))
+                    pos = end
+                del buffer[:pos]
+                chunk = await reader.read(CHUNK_SIZE)
+                if not chunk:
+                    raise ReplicationError("Primary closed the connection")
+                self.last_io = time.time()
+                buffer += chunk
+        finally:
+            ack_task.cancel()
+
+    async def _send_acks(self, writer: asyncio.StreamWriter):
+        while True:
+            writer.write(f"REPLCONF ACK {self.offset}\r\n".encode())
+            await asyncio.sleep(REPL_ACK_PERIOD)
+
+    async def stop(self):
+        self.stop_replica()
+        if self._ping_task is not None:
+            self._ping_task.cancel()
+        for link in list(self.replicas):
+            self.drop(link)
+
+    def info(self) -> Dict[str, object]:
+        now = time.time()
+        info: Dict[str, object] = {"role": "slave" if self.is_replica else "master"}
+        if self.is_replica:
+            info.update({
+                "master_host": self.master[0],
+                "master_port": self.master[1],
+                "master_link_status": self.link_status,
+                "master_last_io_seconds_ago": int(now - self.last_io) if self.last_io else -1,
+                "master_sync_in_progress": int(self.sync_in_progress),
+                "slave_repl_offset": self.offset,
+                "slave_read_only": 1,
+            })
+        info["connected_slaves"] = len(self.replicas)
+        info["slaves"] = [
+            {
+                "addr": link.addr,
+                "state": link.state,
+                "offset": link.ack_offset,
+                "lag": int(now - link.last_ack),
+                "lag_bytes": self.offset - link.ack_offset,
+            }
+            for link in self.replicas
+        ]
+        info.update({
+            "master_replid": self.replid,
+            "master_replid2": self.replid2,
+            "master_repl_offset": self.offset,
+            "second_repl_offset": self.second_offset,
+            "repl_backlog_active": int(self.backlog is not None),
+            "repl_backlog_size": self.backlog.size if self.backlog is not None else 0,
+            "repl_backlog_first_byte_offset": self.backlog.first_offset if self.backlog is not None else 0,
+            "repl_backlog_histlen": self.backlog.histlen if self.backlog is not None else 0,
+            "sync_full": self.sync_full,
+            "sync_partial_ok": self.sync_partial_ok,
+            "sync_partial_err": self.sync_partial_err,
+        })
+        return info
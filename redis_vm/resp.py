@@ -0,0 +1,356 @@
+"""RESP2/RESP3 server on asyncio.Protocol, sharing the store with the FastAPI app.
+
+Commands are registered by the app with @server.command(...). A handler
+gets the connection and the arguments as bytes and returns a Python value,
+which is encoded for the connection's protocol version. Handlers may be
+coroutines; the connection then stops reading until the reply is out, so
+pipelined commands keep their order.
+"""
+import asyncio
+import inspect
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Same limits as Redis' proto-max-bulk-len and proto-inline-max-size
+MAX_BULK_LEN = 512 * 1024 * 1024
+MAX_MULTIBULK_LEN = 1024 * 1024
+MAX_INLINE_LEN = 64 * 1024
+
+
+class RespError(Exception):
+    """An error reply, the message starts with its code: 'ERR ...', 'WRONGTYPE ...'."""
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class SimpleString(str):
+    pass
+
+
+OK = SimpleString("OK")
+# returned by handlers that write their own reply (PSYNC)
+NO_REPLY = object()
+
+
+class RequestParser:
+    """Incremental parser for multibulk and inline requests.
+
+    Frames are located with find() on the receive buffer and only copied out
+    once a whole command has arrived, so a large value trickling in is not
+    sliced again on every read. The consumed prefix is dropped once per feed().
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data: bytes) -> List[List[bytes]]:
+        buf = self.buf
+        buf += data
+        commands = []
+        pos = 0
+        n = len(buf)
+        while pos < n:
+            if buf[pos] == 42:  # '*'
+                end = self._parse_multibulk(buf, pos, n, commands)
+            else:
+                end = self._parse_inline(buf, pos, n, commands)
+            if end is None:
+                break
+            pos = end
+        if pos:
+            del buf[:pos]
+        return commands
+
+    def _parse_multibulk(self, buf, pos, n, commands) -> Optional[int]:
+        nl = buf.find(b"\r\n", pos)
+        if nl < 0:
+            if n - pos > MAX_INLINE_LEN:
+                raise ProtocolError("too big mbulk count string")
+            return None
+        try:
+            count = int(buf[pos + 1:nl])
+        except ValueError:
+            raise ProtocolError("invalid multibulk length")
+        if count > MAX_MULTIBULK_LEN:
+            raise ProtocolError("invalid multibulk length")
+        p = nl + 2
+        spans = []
+        for _ in range(count):
+            if p >= n:
+                return None
+            if buf[p] != 36:  # '$'
+                raise ProtocolError(f"expected '$', got '{chr(buf[p])}'")
+            nl = buf.find(b"\r\n", p)
+            if nl < 0:
+                return None
+            try:
+                length = int(buf[p + 1:nl])
+            except ValueError:
+                raise ProtocolError("invalid bulk length")
+            if length < 0 or length > MAX_BULK_LEN:
+                raise ProtocolError("invalid bulk length")
+            start = nl + 2
+            p = start + length + 2
+            if p > n:
+                return None
+            spans.append((start, start + length))
+        if count > 0:
+            commands.append([bytes(buf[start:end]) for start, end in spans])
+        return p
+
+    def _parse_inline(self, buf, pos, n, commands) -> Optional[int]:
+        nl = buf.find(b"\n", pos)
+        if nl < 0:
+            if n - pos > MAX_INLINE_LEN:
+                raise ProtocolError("too big inline request")
+            return None
+        args = bytes(buf[pos:nl]).split()
+        if args:
+            commands.append(args)
+        return nl + 1
+
+
+def encode(value: Any, proto: int, out: bytearray):
+    if value is None:
+        out += b"_\r\n" if proto >= 3 else b"$-1\r\n"
+    elif isinstance(value, SimpleString):
+        out += b"+" + value.encode() + b"\r\n"
+    elif isinstance(value, RespError):
+        out += b"-" + str(value).replace("\r\n", " ").encode() + b"\r\n"
+    elif isinstance(value, bool):
+        if proto >= 3:
+            out += b"#t\r\n" if value else b"#f\r\n"
+        else:
+            out += b":1\r\n" if value else b":0\r\n"
+    elif isinstance(value, int):
+        out += b":%d\r\n" % value
+    elif isinstance(value, float):
+        if proto >= 3:
+            out += b",%r\r\n" % value
+        else:
+            encode(repr(value), proto, out)
+    elif isinstance(value, str):
+        data = value.encode()
+        out += b"$%d\r\n" % len(data)
+        out += data
+        out += b"\r\n"
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += b"$%d\r\n" % len(value)
+        out += value
+        out += b"\r\n"
+    elif isinstance(value, dict):
+        if proto >= 3:
+            out += b"%%%d\r\n" % len(value)
+        else:
+            out += b"*%d\r\n" % (2 * len(value))
+        for k, v in value.items():
+            encode(k, proto, out)
+            encode(v, proto, out)
+    elif isinstance(value, (set, frozenset)):
+        out += (b"~%d\r\n" if proto >= 3 else b"*%d\r\n") % len(value)
+        for item in value:
+            encode(item, proto, out)
+    elif isinstance(value, (list, tuple)):
+        out += b"*%d\r\n" % len(value)
+        for item in value:
+            encode(item, proto, out)
+    else:
+        encode(str(value), proto, out)
+
+
+class Connection(asyncio.Protocol):
+    def __init__(self, server: "RespServer"):
+        self.server = server
+        self.parser = RequestParser()
+        self.queue: Deque[List[bytes]] = deque()
+        self.transport: Optional[asyncio.Transport] = None
+        self.addr = "?"
+        self.proto = 2
+        self.user_id = server.default_user
+        self.name: Optional[str] = None
+        self.closing = False
+        self.on_close: List[Callable[[], None]] = []
+        self._task: Optional[asyncio.Task] = None
+        self._drain_waiter: Optional[asyncio.Future] = None
+
+    # -- asyncio.Protocol --
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peer = transport.get_extra_info("peername")
+        if peer:
+            self.addr = f"{peer[0]}:{peer[1]}"
+        self.server.clients.add(self)
+        self.server.connections_received += 1
+
+    def connection_lost(self, exc):
+        self.server.clients.discard(self)
+        if self._task is not None:
+            self._task.cancel()
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.cancel()
+        for callback in self.on_close:
+            callback()
+
+    def data_received(self, data: bytes):
+        self.server.net_input_bytes += len(data)
+        try:
+            self.queue.extend(self.parser.feed(data))
+        except ProtocolError as e:
+            out = bytearray()
+            encode(RespError(f"ERR Protocol error: {str(e)}"), self.proto, out)
+            self.write(out)
+            self.transport.close()
+            return
+        if self._task is None:
+            self._process()
+
+    def pause_writing(self):
+        if self._drain_waiter is None or self._drain_waiter.done():
+            self._drain_waiter = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self._drain_waiter is not None and not self._drain_waiter.done():
+            self._drain_waiter.set_result(None)
+
+    # -- used by handlers taking over the connection (replication) --
+
+    def write(self, data):
+        self.server.net_output_bytes += len(data)
+        self.transport.write(data)
+
+    def buffer_size(self) -> int:
+        return self.transport.get_write_buffer_size()
+
+    async def drain(self):
+        if self._drain_waiter is not None:
+            await self._drain_waiter
+
+    def close(self):
+        self.transport.close()
+
+    # -- command processing --
+
+    def _process(self, out: Optional[bytearray] = None):
+        """Run queued commands, the replies of one batch go out in one write."""
+        out = bytearray() if out is None else out
+        while self.queue and not self.closing:
+            result = self._call(self.queue.popleft())
+            if inspect.isawaitable(result):
+                self.transport.pause_reading()
+                self._task = asyncio.get_running_loop().create_task(self._await_reply(out, result))
+                return
+            if result is not NO_REPLY:
+                encode(result, self.proto, out)
+        barrier = self._barrier()
+        if barrier is not None:
+            self.transport.pause_reading()
+            self._task = asyncio.get_running_loop().create_task(self._await_barrier(out, barrier))
+            return
+        if out:
+            self.write(out)
+        if self.closing:
+            self.transport.close()
+
+    def _barrier(self) -> Optional[Awaitable]:
+        return self.server.write_barrier() if self.server.write_barrier is not None else None
+
+    async def _await_reply(self, out: bytearray, result: Awaitable):
+        try:
+            # replies queued before this command go out first
+            barrier = self._barrier()
+            if barrier is not None:
+                await barrier
+            if out:
+                self.write(out)
+                out = bytearray()
+            try:
+                value = await result
+            except RespError as e:
+                value = e
+            except Exception as e:
+                logger.error(f"Error running command: {str(e)}")
+                value = RespError(f"ERR {str(e)}")
+            if value is not NO_REPLY:
+                encode(value, self.proto, out)
+        finally:
+            self._task = None
+        if self.transport.is_closing():
+            return
+        self.transport.resume_reading()
+        self._process(out)
+
+    async def _await_barrier(self, out: bytearray, barrier: Awaitable):
+        try:
+            await barrier
+        finally:
+            self._task = None
+        if self.transport.is_closing():
+            return
+        self.write(out)
+        if self.closing:
+            self.transport.close()
+            return
+        self.transport.resume_reading()
+        if self.queue:
+            self._process()
+
+    def _call(self, args: List[bytes]):
+        self.server.commands_processed += 1
+        name = args[0].upper()
+        handler = self.server.commands.get(name)
+        if handler is None:
+            return RespError(f"ERR unknown command '{args[0].decode(errors='replace')}'")
+        try:
+            return handler(self, args[1:])
+        except RespError as e:
+            return e
+        except Exception as e:
+            logger.error(f"Error running {name.decode(errors='replace')}: {str(e)}")
+            return RespError(f"ERR {str(e)}")
+
+
+class RespServer:
+    def __init__(self, default_user: str = "default"):
+        self.default_user = default_user
+        self.commands: Dict[bytes, Callable] = {}
+        self.clients: Set[Connection] = set()
+        self.connections_received = 0
+        self.commands_processed = 0
+        self.net_input_bytes = 0
+        self.net_output_bytes = 0
+        # returns an awaitable replies must wait for (appendfsync always), or None
+        self.write_barrier: Optional[Callable[[], Optional[Awaitable]]] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    def command(self, *names: str):
+        def register(handler):
+            for name in names:
+                self.commands[name.upper().encode()] = handler
+            return handler
+        return register
+
+    async def start(self, host: str, port: int):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: Connection(self), host, port)
+        logger.info(f"RESP listening on {host}:{port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for client in list(self.clients):
+                client.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def info(self) -> Dict[str, int]:
+        return {
+            "connected_clients": len(self.clients),
+            "total_connections_received": self.connections_received,
+            "total_commands_processed": self.commands_processed,
+        }
@@ -0,0 +1,117 @@
+import fnmatch
+import random
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from datatypes import REDIS_TYPES
+from keyspace import Keyspace
+
+# A scan nobody has continued for this long is dropped, and at most
+# MAX_OPEN_SCANS are kept (the least recently used goes first)
+SCAN_IDLE_TIMEOUT = 600
+MAX_OPEN_SCANS = 1024
+DEFAULT_COUNT = 10
+POSITION_BITS = 32
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class _Scan:
+    __slots__ = ("user_id", "keys", "last_used")
+
+    def __init__(self, user_id: str, keys: List[str]):
+        self.user_id = user_id
+        self.keys = keys
+        self.last_used = time.monotonic()
+
+
+def type_name(entry, is_file: bool) -> str:
+    # what TYPE and SCAN ... TYPE call a key
+    if is_file:
+        return "file"
+    return REDIS_TYPES.get(type(entry.value), "string")
+
+
+class Scanner:
+    """Cursor-based SCAN over a tenant's keys.
+
+    A Python dict has no stable bucket order to walk with a stateless
+    cursor like Redis does, so the first call takes a copy of the key names
+    (references only, a C-speed list copy) and later calls walk that copy,
+    skipping keys deleted in between. Every key present for the whole scan
+    is returned exactly once; keys added meanwhile may or may not be.
+
+    The cursor packs the scan id and the position in the copy, so retrying
+    a call with the same cursor returns the same page again (until the scan
+    has finished, its copy is dropped with the last page).
+    """
+
+    def __init__(self, user_data: Dict[str, Keyspace]):
+        self.user_data = user_data
+        self._scans: "OrderedDict[int, _Scan]" = OrderedDict()
+        self._next_id = random.randrange(1, 1 << 20)  # old cursors don't match after a restart
+
+    def __len__(self) -> int:
+        return len(self._scans)
+
+    def _start(self, user_id: str, keyspace: Keyspace) -> int:
+        self._expire()
+        keys = list(keyspace.data)
+        keys += [key for key in keyspace.files if key not in keyspace.data]
+        scan_id = self._next_id
+        self._next_id += 1
+        self._scans[scan_id] = _Scan(user_id, keys)
+        while len(self._scans) > MAX_OPEN_SCANS:
+            self._scans.popitem(last=False)
+        return scan_id
+
+    def _expire(self):
+        deadline = time.monotonic() - SCAN_IDLE_TIMEOUT
+        while self._scans:
+            scan_id, scan = next(iter(self._scans.items()))
+            if scan.last_used > deadline:
+                break
+            del self._scans[scan_id]
+
+    def scan(self, user_id: str, cursor: int, match: Optional[str] = None, count: int = DEFAULT_COUNT,
+             type: Optional[str] = None) -> Tuple[int, List[str]]:
+        """One SCAN step, returns (next cursor, keys); a next cursor of 0 means done.
+
+        COUNT is the number of key slots looked at, like in Redis, so a
+        MATCH that rarely hits can return fewer keys (or none) before the end.
+        """
+        keyspace = self.user_data.get(user_id)
+        if cursor == 0:
+            if keyspace is None:
+                return 0, []
+            scan_id, pos = self._start(user_id, keyspace), 0
+        else:
+            scan_id, pos = cursor >> POSITION_BITS, cursor & ((1 << POSITION_BITS) - 1)
+        scan = self._scans.get(scan_id)
+        if scan is None or scan.user_id != user_id or pos > len(scan.keys):
+            raise InvalidCursor("ERR invalid cursor")
+        scan.last_used = time.monotonic()
+        self._scans.move_to_end(scan_id)
+
+        count = max(count, 1)
+        end = min(pos + count, len(scan.keys))
+        out = []
+        if keyspace is not None:
+            now = time.time()
+            for key in scan.keys[pos:end]:
+                entry, is_file = keyspace.lookup(key)
+                if entry is None or entry.is_expired(now):
+                    continue
+                if match is not None and not fnmatch.fnmatchcase(key, match):
+                    continue
+                if type is not None and type_name(entry, is_file) != type:
+                    continue
+                out.append(key)
+        if end >= len(scan.keys):
+            # done, the next SCAN 0 starts over
+            del self._scans[scan_id]
+            return 0, out
+        return (scan_id << POSITION_BITS) | end, out
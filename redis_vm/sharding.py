@@ -0,0 +1,557 @@
+"""Shared-nothing sharding of tenants over several worker processes.
+
+Each worker runs the whole app for the tenants that hash to it
+(crc32(user_id) % shards) with its own dump, AOF, blob dir and RESP port.
+All workers accept on the same HTTP port (SO_REUSEPORT, the kernel spreads
+connections between them) and each also listens on a unix socket of its
+own. A request for a tenant of another shard is forwarded over that
+shard's socket; routes that cover every tenant go to all shards and the
+replies are merged.
+
+Per-VM limits are split between the shards: shard i gets share(total), so
+with MAX_USERS = 10 and 4 shards the shards take 3, 3, 2 and 2 tenants.
+Tenants are placed by hash, so a full shard refuses a signup even while
+another still has room.
+
+Forwarding costs about as much as serving the request, so clients that
+know the map (GET /shards, see KeyValueClient(shard_aware=True)) go straight
+to shard i on port + 1 + i instead.
+
+Run from redis_vm/: python sharding.py --shards 2 --port 8000
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import zlib
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+
+from metrics import merge_prometheus
+from snapshot import (CHUNK_SIZE, REC_EOF, REC_TENANT, RecordReader, SnapshotError, eof_record, is_legacy_pickle,
+                      iter_snapshot, load_legacy_pickle, merge_snapshots, record_tenant, snapshot_header)
+
+logger = logging.getLogger(__name__)
+# one line per forwarded request otherwise
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# "<index>/<count>" in a worker, unset when running unsharded
+SHARD_ENV = "VM_REDIS_SHARD"
+SOCKET_DIR_ENV = "VM_REDIS_SHARD_SOCKETS"
+PORT_ENV = "VM_REDIS_SHARD_PORT"
+# sent on every request one shard makes to another, those are always served locally
+FORWARDED_HEADER = "x-vm-redis-shard"
+# per connection, not passed on when forwarding
+HOP_HEADERS = {b"connection", b"keep-alive", b"transfer-encoding", b"host"}
+
+
+class ShardMap:
+    def __init__(self, index: int = 0, count: int = 1, socket_dir: Optional[str] = None, port: int = 8000):
+        self.index = index
+        self.count = count
+        self.socket_dir = socket_dir or tempfile.gettempdir()
+        self.port = port  # the shared HTTP port
+
+    @classmethod
+    def from_env(cls) -> "ShardMap":
+        value = os.environ.get(SHARD_ENV)
+        if not value:
+            return cls()
+        index, count = (int(part) for part in value.split("/"))
+        return cls(index, count, os.environ.get(SOCKET_DIR_ENV), int(os.environ.get(PORT_ENV, 8000)))
+
+    @property
+    def sharded(self) -> bool:
+        return self.count > 1
+
+    def owner(self, user_id: str) -> int:
+        # crc32 rather than hash(), which differs between processes
+        return zlib.crc32(user_id.encode()) % self.count
+
+    def is_local(self, user_id: str) -> bool:
+        return self.count == 1 or self.owner(user_id) == self.index
+
+    def share(self, total: int) -> int:
+        """This shard's part of a per-VM limit, the remainder goes to the first shards."""
+        return total // self.count + (1 if self.index < total % self.count else 0)
+
+    def socket_path(self, index: int) -> str:
+        return os.path.join(self.socket_dir, f"vm_redis_shard{index}.sock")
+
+    def direct_port(self, index: int) -> int:
+        return self.port + 1 + index
+
+    def describe(self) -> Dict[str, Any]:
+        return {"shards": self.count, "hash": "crc32", "ports": [self.direct_port(i) for i in range(self.count)]}
+
+
+def path_tenant(path: str) -> Optional[str]:
+    """The tenant a route belongs to: /user/{id}/..., /users/{id}[/exists], /upload_rdb/{id}."""
+    parts = path.split("/")
+    if len(parts) >= 3 and parts[1] == "user":
+        return parts[2]
+    if len(parts) in (3, 4) and parts[1] == "users" and parts[2] != "export":
+        return parts[2]
+    if len(parts) == 3 and parts[1] == "upload_rdb":
+        return parts[2]
+    return None
+
+
+async def read_body(receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return bytes(body)
+
+
+def replay_body(body: bytes):
+    # a receive() handing out a body that was already read
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            return {"type": "http.disconnect"}
+        sent = True
+        return {"type": "http.request", "body": body, "more_body": False}
+    return receive
+
+
+async def body_chunks(receive) -> AsyncIterator[bytes]:
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        if message.get("body"):
+            yield message["body"]
+        if not message.get("more_body"):
+            return
+
+
+async def wait_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+class ShardRouter:
+    """ASGI middleware in every worker: serve local tenants, forward or fan out the rest."""
+
+    def __init__(self, app, shards: ShardMap):
+        self.app = app
+        self.shards = shards
+        self._clients: Dict[int, httpx.AsyncClient] = {}
+        self.forwarded = 0
+        self.fan_out = {
+            ("GET", "/users"): self.list_users,
+            ("GET", "/users/export"): self.export_users,
+            ("DELETE", "/users"): self.all_shards,
+            ("GET", "/info"): self.info,
+            ("GET", "/metrics"): self.metrics,
+            ("GET", "/slowlog"): self.slowlog,
+            ("GET", "/slowlog/len"): self.slowlog_len,
+            ("GET", "/monitor"): self.monitor,
+            ("POST", "/slowlog/reset"): self.all_shards,
+            ("GET", "/download_rdb"): self.download_rdb,
+            ("POST", "/upload_rdb"): self.upload_rdb,
+            ("POST", "/save"): self.all_shards,
+            ("POST", "/bgsave"): self.all_shards,
+            ("POST", "/bgrewriteaof"): self.all_shards,
+            ("GET", "/lastsave"): self.lastsave,
+            ("POST", "/config"): self.config,
+            ("POST", "/replicaof"): self.all_shards,
+        }
+
+    def client(self, index: int) -> httpx.AsyncClient:
+        client = self._clients.get(index)
+        if client is None:
+            client = self._clients[index] = httpx.AsyncClient(
+                transport=httpx.AsyncHTTPTransport(uds=self.shards.socket_path(index)),
+                base_url="http://shard", headers={FORWARDED_HEADER: str(self.shards.index)}, timeout=None)
+        return client
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.shards.sharded:
+            return await self.app(scope, receive, send)
+        if scope["path"] == "/shards":
+            return await JSONResponse(self.shards.describe())(scope, receive, send)
+        if any(name == FORWARDED_HEADER.encode() for name, _ in scope["headers"]):
+            return await self.app(scope, receive, send)
+        handler = self.fan_out.get((scope["method"], scope["path"]))
+        if handler is not None:
+            response = await handler(Request(scope, receive))
+            return await response(scope, receive, send)
+        user_id = path_tenant(scope["path"])
+        if user_id is None and scope["path"] == "/signup":
+            body = await read_body(receive)
+            receive = replay_body(body)
+            try:
+                user_id = json.loads(body).get("public_key")
+            except (ValueError, AttributeError):
+                user_id = None
+        if not isinstance(user_id, str) or self.shards.is_local(user_id):
+            return await self.app(scope, receive, send)
+        await self.forward(self.shards.owner(user_id), scope, receive, send)
+
+    async def forward(self, index: int, scope, receive, send):
+        """Proxy one request to another shard, streaming both bodies."""
+        self.forwarded += 1
+        url = scope.get("raw_path", scope["path"].encode()).decode("latin-1")
+        if scope["query_string"]:
+            url += "?" + scope["query_string"].decode("latin-1")
+        headers = [(name, value) for name, value in scope["headers"] if name not in HOP_HEADERS]
+        client = self.client(index)
+        request = client.build_request(scope["method"], url, headers=headers, content=body_chunks(receive))
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.HTTPError as e:
+            return await JSONResponse({"detail": f"Shard {index} unavailable: {e}"}, status_code=502)(scope, receive, send)
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [(name.lower(), value) for name, value in response.headers.raw if name.lower() not in HOP_HEADERS],
+            })
+            relay = self.relay(response, send)
+            if response.headers.get("content-type", "").startswith("text/event-stream"):
+                # never ends on its own, stop when the client goes away
+                await self.until_disconnect(relay, receive)
+            else:
+                await relay
+        finally:
+            await response.aclose()
+
+    @staticmethod
+    async def relay(response: httpx.Response, send):
+        async for chunk in response.aiter_raw():
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    @staticmethod
+    async def until_disconnect(coro, receive):
+        task = asyncio.ensure_future(coro)
+        watcher = asyncio.ensure_future(wait_disconnect(receive))
+        try:
+            await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            task.cancel()
+            watcher.cancel()
+        if task.done() and not task.cancelled():
+            task.result()
+
+    async def call_all(self, method: str, path: str, **kwargs) -> List[httpx.Response]:
+        return list(await asyncio.gather(*(self.client(i).request(method, path, **kwargs)
+                                           for i in range(self.shards.count))))
+
+    @staticmethod
+    def first_error(replies: List[httpx.Response]) -> Optional[Response]:
+        for reply in replies:
+            if reply.status_code != 200:
+                return Response(reply.content, status_code=reply.status_code,
+                                media_type=reply.headers.get("content-type"))
+        return None
+
+    # fan-out routes
+
+    async def all_shards(self, request: Request) -> Response:
+        # same request on every shard, the first failure or else the first reply
+        replies = await self.call_all(request.method, request.url.path, params=request.query_params)
+        error = self.first_error(replies)
+        return error or JSONResponse(replies[0].json())
+
+    async def list_users(self, request: Request) -> Response:
+        # every shard returns its first `limit` tenants after `after`, so the
+        # first `limit` of all of them merged are the global first page
+        replies = await self.call_all("GET", "/users", params=request.query_params)
+        error = self.first_error(replies)
+        if error:
+            return error
+        pages = [reply.json() for reply in replies]
+        limit = max(1, min(int(request.query_params.get("limit", 100)), 1000))
+        users = sorted((user for page in pages for user in page["users"]), key=lambda user: user["user_id"])
+        more = len(users) > limit or any(page["next"] is not None for page in pages)
+        users = users[:limit]
+        return JSONResponse({
+            "users": users,
+            "next": users[-1]["user_id"] if more and users else None,
+            "total": sum(page["total"] for page in pages),
+        })
+
+    async def export_users(self, request: Request) -> Response:
+        async def lines():
+            for i in range(self.shards.count):
+                async with self.client(i).stream("GET", "/users/export", params=request.query_params) as reply:
+                    async for chunk in reply.aiter_raw():
+                        yield chunk
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    async def info(self, request: Request) -> Response:
+        # {"users_count", "shards": [INFO of each shard]}, or {section: [...]}
+        replies = await self.call_all("GET", "/info", params=request.query_params)
+        error = self.first_error(replies)
+        if error:
+            return error
+        infos = [reply.json() for reply in replies]
+        section = request.query_params.get("section")
+        if section:
+            return JSONResponse({section.lower(): [info[section.lower()] for info in infos]})
+        return JSONResponse({"users_count": sum(info.get("users_count", 0) for info in infos), "shards": infos})
+
+    async def metrics(self, request: Request) -> Response:
+        # every shard's samples, told apart by a shard="<index>" label
+        replies = await self.call_all("GET", "/metrics")
+        error = self.first_error(replies)
+        if error:
+            return error
+        return PlainTextResponse(merge_prometheus([reply.text for reply in replies], "shard"),
+                                 media_type="text/plain; version=0.0.4")
+
+    async def slowlog(self, request: Request) -> Response:
+        # the newest `count` over all shards, each entry tagged with its shard
+        replies = await self.call_all("GET", "/slowlog", params=request.query_params)
+        error = self.first_error(replies)
+        if error:
+            return error
+        entries = [{**entry, "shard": index} for index, reply in enumerate(replies) for entry in reply.json()["entries"]]
+        entries.sort(key=lambda entry: entry["timestamp"], reverse=True)
+        count = int(request.query_params.get("count", 10))
+        return JSONResponse({"entries": entries if count < 0 else entries[:count]})
+
+    async def slowlog_len(self, request: Request) -> Response:
+        replies = await self.call_all("GET", "/slowlog/len")
+        return self.first_error(replies) or JSONResponse({"len": sum(reply.json()["len"] for reply in replies)})
+
+    async def monitor(self, request: Request) -> Response:
+        # every shard's MONITOR stream, interleaved event by event. The queue
+        # is small so a slow client stops the reads and the shards drop
+        events: asyncio.Queue = asyncio.Queue(maxsize=self.shards.count)
+
+        async def pull(index: int):
+            async with self.client(index).stream("GET", "/monitor") as reply:
+                async for line in reply.aiter_lines():
+                    if line:
+                        await events.put(line + "\n\n")
+
+        async def merged():
+            pulls = [asyncio.ensure_future(pull(i)) for i in range(self.shards.count)]
+            try:
+                while True:
+                    yield await events.get()
+            finally:
+                for task in pulls:
+                    task.cancel()
+        return StreamingResponse(merged(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    async def lastsave(self, request: Request) -> Response:
+        # the oldest of the shards' saves, everything is on disk since then
+        replies = await self.call_all("GET", "/lastsave")
+        return self.first_error(replies) or JSONResponse({"lastsave": min(reply.json()["lastsave"] for reply in replies)})
+
+    async def config(self, request: Request) -> Response:
+        if request.query_params.get("command", "").lower() == "set":
+            return await self.all_shards(request)
+        reply = await self.client(self.shards.index).post("/config", params=request.query_params)
+        return Response(reply.content, status_code=reply.status_code, media_type=reply.headers.get("content-type"))
+
+    async def shard_dump(self, index: int) -> AsyncIterator[bytes]:
+        async with self.client(index).stream("GET", "/download_rdb") as reply:
+            if reply.status_code != 200:
+                raise SnapshotError(f"Shard {index} answered {reply.status_code}")
+            async for chunk in reply.aiter_raw():
+                yield chunk
+
+    async def download_rdb(self, request: Request) -> Response:
+        merged = merge_snapshots(self.shard_dump(i) for i in range(self.shards.count))
+        path = request.query_params.get("path")
+        if not path:
+            return StreamingResponse(merged, media_type="application/octet-stream", headers={
+                "Content-Disposition": "attachment; filename=all_users_dump.rdb"
+            })
+        size = 0
+        try:
+            with open(f"{path}.tmp", "wb") as f:
+                async for chunk in merged:
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(f"{path}.tmp", path)
+        except (OSError, SnapshotError) as e:
+            return JSONResponse({"detail": f"Could not write {path}: {e}"}, status_code=500)
+        return JSONResponse({"response": f"RDB file saved to {path}", "bytes": size})
+
+    async def upload_rdb(self, request: Request) -> Response:
+        # split into one snapshot file per shard, then each shard loads its own by path
+        path = request.query_params.get("path")
+        form = None
+        if path:
+            source = file_chunks(path)
+        else:
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                return JSONResponse({"detail": "Either file or path must be provided"}, status_code=400)
+            source = upload_chunks(upload)
+        parts: Dict[int, str] = {}
+        try:
+            parts = await self.split_snapshot(source)
+            replies = await asyncio.gather(*(self.client(i).post("/upload_rdb", params={"path": part})
+                                             for i, part in parts.items()))
+            return self.first_error(list(replies)) or JSONResponse({"response": "OK"})
+        except SnapshotError as e:
+            return JSONResponse({"detail": f"Invalid RDB file: {str(e)}"}, status_code=400)
+        except OSError as e:
+            return JSONResponse({"detail": f"Cannot read RDB file: {str(e)}"}, status_code=400)
+        finally:
+            for part in parts.values():
+                os.unlink(part)
+            if form is not None:
+                await form.close()
+
+    async def split_snapshot(self, source: AsyncIterator[bytes]) -> Dict[int, str]:
+        """Write the tenants of a dump to one temp snapshot per shard, returns {shard: path}."""
+        outputs: Dict[int, Tuple[Any, Optional[int]]] = {}
+
+        def output(index: int):
+            if index not in outputs:
+                f = tempfile.NamedTemporaryFile(prefix=f"shard{index}_", suffix=".rdb", delete=False)
+                f.write(snapshot_header())
+                outputs[index] = (f, 0)
+            return outputs[index][0]
+
+        reader = None
+        legacy = None
+        current = None
+        try:
+            async for chunk in source:
+                if reader is None and legacy is None:
+                    if is_legacy_pickle(chunk):
+                        legacy = bytearray()
+                    else:
+                        reader = RecordReader()
+                if legacy is not None:
+                    legacy += chunk
+                    continue
+                for rec_type, record in reader.feed(chunk):
+                    if rec_type == REC_TENANT:
+                        index = self.shards.owner(record_tenant(record))
+                        current = output(index)
+                        outputs[index] = (current, outputs[index][1] + 1)
+                    if rec_type == REC_EOF:
+                        break
+                    if current is None:
+                        raise SnapshotError("Record before the first tenant")
+                    current.write(record)
+            if legacy is not None:
+                tenants = load_legacy_pickle(bytes(legacy))
+                for index in range(self.shards.count):
+                    own = [(user_id, ks) for user_id, ks in tenants.items() if self.shards.owner(user_id) == index]
+                    if own:
+                        f = tempfile.NamedTemporaryFile(prefix=f"shard{index}_", suffix=".rdb", delete=False)
+                        outputs[index] = (f, None)  # iter_snapshot writes its own EOF
+                        for chunk in iter_snapshot(own):
+                            f.write(chunk)
+            elif reader is None:
+                raise SnapshotError("RDB file is empty")
+            else:
+                reader.close()
+            for index, (f, count) in outputs.items():
+                if count is not None:
+                    f.write(eof_record(count))
+                f.close()
+        except BaseException:
+            for f, _ in outputs.values():
+                f.close()
+                os.unlink(f.name)
+            raise
+        return {index: f.name for index, (f, _) in outputs.items()}
+
+
+async def file_chunks(path: str) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def upload_chunks(upload) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def tcp_socket(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    # IPPROTO_TCP spelled out: asyncio only sets TCP_NODELAY on connections
+    # accepted from a socket created with it, without it replies stall 40ms
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def serve_shard(index: int, count: int, host: str, port: int, socket_dir: str):
+    """Worker process: run the app for one shard on the shared port, its own port and its socket."""
+    os.environ[SHARD_ENV] = f"{index}/{count}"
+    os.environ[SOCKET_DIR_ENV] = socket_dir
+    os.environ[PORT_ENV] = str(port)
+    import uvicorn
+    from app import app  # reads the environment above at import
+
+    shards = ShardMap(index, count, socket_dir, port)
+    path = shards.socket_path(index)
+    if os.path.exists(path):
+        os.unlink(path)
+    uds = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    uds.bind(path)
+    sockets = [tcp_socket(host, port, reuse_port=True), uds]
+    if count > 1:
+        sockets.append(tcp_socket(host, shards.direct_port(index)))
+    uvicorn.Server(uvicorn.Config(app, log_level="warning")).run(sockets=sockets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the key-value server as N shard processes")
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--socket-dir", default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context("spawn")
+    workers = [ctx.Process(target=serve_shard, args=(i, args.shards, args.host, args.port, args.socket_dir),
+                           name=f"shard{i}") for i in range(args.shards)]
+    for worker in workers:
+        worker.start()
+    # stopping the launcher stops the shards, they would keep the port otherwise
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logger.info(f"{args.shards} shards serving on {args.host}:{args.port}")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,101 @@
+import itertools
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Sequence, Union
+
+# Same truncation as Redis' slowlog.c
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+
+class SlowLogEntry:
+    __slots__ = ("id", "timestamp", "duration", "args", "client", "client_name", "tenant", "payload")
+
+    def __init__(self, id: int, duration: int, args: List[str], client: str, client_name: str,
+                 tenant: Optional[str], payload: int):
+        self.id = id
+        self.timestamp = int(time.time())
+        self.duration = duration
+        self.args = args
+        self.client = client
+        self.client_name = client_name
+        self.tenant = tenant
+        self.payload = payload
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "timestamp": self.timestamp,
+            "duration_usec": self.duration,
+            "args": self.args,
+            "client": self.client,
+            "client_name": self.client_name,
+            "tenant": self.tenant,
+            "payload_bytes": self.payload,
+        }
+
+    def to_resp(self) -> list:
+        # the 6 fields of Redis' SLOWLOG GET, tenant and payload size appended
+        return [self.id, self.timestamp, self.duration, self.args, self.client, self.client_name,
+                self.tenant or "", self.payload]
+
+
+def _truncate(args: Sequence[Union[str, bytes]]) -> List[str]:
+    out = []
+    for i, arg in enumerate(args):
+        if i == SLOWLOG_ENTRY_MAX_ARGC - 1 and len(args) > SLOWLOG_ENTRY_MAX_ARGC:
+            out.append(f"... ({len(args) - i} more arguments)")
+            break
+        if isinstance(arg, (bytes, bytearray, memoryview)):
+            text = bytes(arg[:SLOWLOG_ENTRY_MAX_STRING]).decode(errors="replace")
+        else:
+            text = arg[:SLOWLOG_ENTRY_MAX_STRING]
+        if len(arg) > SLOWLOG_ENTRY_MAX_STRING:
+            text += f"... ({len(arg) - SLOWLOG_ENTRY_MAX_STRING} more bytes)"
+        out.append(text)
+    return out
+
+
+class SlowLog:
+    """Commands that took at least slowlog_log_slower_than microseconds, newest first.
+
+    Callers time the command anyway for the metrics, so a command under the
+    threshold costs one comparison in slow(); only slow ones build an entry.
+    The threshold is cached here, configure() re-reads it after CONFIG SET.
+    """
+
+    def __init__(self, config: Dict[str, str]):
+        self.config = config
+        self.entries: Deque[SlowLogEntry] = deque()
+        self.next_id = 0
+        self.slower_than = -1
+        self.configure()
+
+    def configure(self):
+        # negative disables the log, 0 logs every command
+        self.slower_than = int(self.config["slowlog_log_slower_than"])
+        max_len = int(self.config["slowlog_max_len"])
+        if self.entries.maxlen != max_len:
+            # newest first, a shorter log keeps the newest like Redis
+            self.entries = deque(itertools.islice(self.entries, max_len), maxlen=max_len)
+
+    def slow(self, usec: int) -> bool:
+        return 0 <= self.slower_than <= usec
+
+    def add(self, usec: int, args: Sequence[Union[str, bytes]], client: str = "", client_name: str = "",
+            tenant: Optional[str] = None, payload: int = 0):
+        self.entries.appendleft(SlowLogEntry(self.next_id, usec, _truncate(args), client, client_name,
+                                             tenant, payload))
+        self.next_id += 1
+
+    def get(self, count: Optional[int] = 10) -> List[SlowLogEntry]:
+        """The newest `count` entries, all of them if count is None or negative."""
+        if count is None or count < 0:
+            return list(self.entries)
+        return list(itertools.islice(self.entries, count))
+
+    def reset(self):
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
@@ -0,0 +1,351 @@
+"""Streaming snapshot format for RDB dumps.
+
+A snapshot is MAGIC + a u16 format version, followed by records:
+
+    type (u8) | payload length (u32) | payload | crc32 of type + payload (u32)
+
+Each tenant is a TENANT record followed by VALUE and FILE records. A FILE
+record is followed by FILE_CHUNK records carrying its bytes, so no record is
+larger than a chunk and neither side ever holds a whole dump in memory.
+The stream ends with an EOF record carrying the tenant count.
+"""
+import asyncio
+import io
+import json
+import os
+import pickle
+import struct
+import zlib
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from codec import F64, U16, U64, Cursor, DecodeError, decode_value, encode_value, pack_float, pack_str
+from keyspace import Entry, FileEntry, Keyspace, load_keyspace
+
+MAGIC = b"VMRDB"
+FORMAT_VERSION = 1
+
+REC_TENANT = 1
+REC_VALUE = 2
+REC_FILE = 3
+REC_FILE_CHUNK = 4
+REC_EOF = 0xFF
+
+CHUNK_SIZE = 64 * 1024
+# a whole list/hash/set/zset is one record, so this has to clear the largest quota
+MAX_RECORD = 256 * 1024 * 1024
+# a file is declared up front and then sent in chunks; no quota holds more
+MAX_FILE = 256 * 1024 * 1024
+
+_HEADER = struct.Struct(">BI")
+_CRC = struct.Struct(">I")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _record(rec_type: int, payload: bytes) -> bytes:
+    crc = zlib.crc32(payload, zlib.crc32(bytes((rec_type,))))
+    return _HEADER.pack(rec_type, len(payload)) + payload + _CRC.pack(crc)
+
+
+def iter_snapshot(tenants: Iterable[Tuple[str, Keyspace]]) -> Iterator[bytes]:
+    """Yield a snapshot of the given tenants in chunks of roughly CHUNK_SIZE.
+
+    Each tenant's key lists are copied (references only) when the writer
+    reaches it, so the caller may keep mutating the store between chunks.
+    """
+    out = bytearray(MAGIC + U16.pack(FORMAT_VERSION))
+    count = 0
+    for user_id, keyspace in tenants:
+        count += 1
+        meta = {k: v for k, v in keyspace.meta.items() if k != "storage_used"}
+        out += _record(REC_TENANT, pack_str(user_id) + pack_str(json.dumps(meta)))
+        for key, entry in list(keyspace.data.items()):
+            if entry.is_expired():
+                continue
+            encoding, data = encode_value(entry.value)
+            out += _record(REC_VALUE, pack_str(key) + pack_str(entry.type) + pack_float(entry.expiry)
+                           + bytes((encoding,)) + data)
+            if len(out) >= CHUNK_SIZE:
+                yield bytes(out)
+                out.clear()
+        for key, entry in list(keyspace.files.items()):
+            if entry.is_expired():
+                continue
+            try:
+                content = entry.content()
+            except KeyError:
+                continue  # blob freed while the dump was running
+            out += _record(REC_FILE, pack_str(key) + pack_str(entry.content_type) + pack_str(entry.filename)
+                           + pack_float(entry.expiry) + F64.pack(entry.mtime) + U64.pack(entry.size))
+            view = memoryview(content)
+            for offset in range(0, entry.size, CHUNK_SIZE):
+                out += _record(REC_FILE_CHUNK, view[offset:offset + CHUNK_SIZE])
+                if len(out) >= CHUNK_SIZE:
+                    yield bytes(out)
+                    out.clear()
+            view.release()
+        if len(out) >= CHUNK_SIZE:
+            yield bytes(out)
+            out.clear()
+    out += _record(REC_EOF, U64.pack(count))
+    yield bytes(out)
+
+
+async def stream_snapshot(tenants: Iterable[Tuple[str, Keyspace]]) -> AsyncIterator[bytes]:
+    """iter_snapshot for the event loop, yielding control after every chunk."""
+    for chunk in iter_snapshot(tenants):
+        yield chunk
+        await asyncio.sleep(0)
+
+
+async def write_snapshot(path: str, tenants: Iterable[Tuple[str, Keyspace]]) -> int:
+    """Write a snapshot to `path` atomically (temp file + rename), returns its size."""
+    tmp_path = f"{path}.tmp"
+    size = 0
+    with open(tmp_path, "wb") as f:
+        async for chunk in stream_snapshot(tenants):
+            f.write(chunk)
+            size += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return size
+
+
+class SnapshotLoader:
+    """Incremental parser: feed() bytes as they arrive, get finished tenants back.
+
+    Only the current record and the file being reassembled are buffered,
+    the latter growing as its chunks arrive rather than by its declared size.
+    Finished files go through `spill` (when given). Tenants other than `only`
+    (when given) are parsed and discarded.
+    """
+
+    def __init__(self, only: Optional[str] = None, spill: Optional[Callable] = None):
+        self.only = only
+        self.spill = spill
+        self.buffer = bytearray()
+        self.version: Optional[int] = None
+        self.done = False
+        self.tenant_count = 0
+        self._user_id: Optional[str] = None
+        self._keyspace: Optional[Keyspace] = None
+        self._file: Optional[Dict[str, Any]] = None
+
+    def feed(self, data: bytes) -> List[Tuple[str, Keyspace]]:
+        if self.done:
+            if data:
+                raise SnapshotError("Data after end of snapshot")
+            return []
+        self.buffer += data
+        finished: List[Tuple[str, Keyspace]] = []
+        if self.version is None:
+            if len(self.buffer) < len(MAGIC) + 2:
+                return finished
+            if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+                raise SnapshotError("Not a snapshot file")
+            (self.version,) = U16.unpack_from(self.buffer, len(MAGIC))
+            if self.version > FORMAT_VERSION:
+                raise SnapshotError(f"Snapshot format version {self.version} is newer than {FORMAT_VERSION}")
+            del self.buffer[:len(MAGIC) + 2]
+        pos = 0
+        while not self.done and len(self.buffer) - pos >= _HEADER.size:
+            rec_type, length = _HEADER.unpack_from(self.buffer, pos)
+            if length > MAX_RECORD:
+                raise SnapshotError(f"Record of {length} bytes exceeds the limit")
+            end = pos + _HEADER.size + length + _CRC.size
+            if len(self.buffer) < end:
+                break
+            payload = memoryview(self.buffer)[pos + _HEADER.size:end - _CRC.size]
+            (crc,) = _CRC.unpack_from(self.buffer, end - _CRC.size)
+            if zlib.crc32(payload, zlib.crc32(bytes((rec_type,)))) != crc:
+                payload.release()
+                raise SnapshotError("Checksum mismatch, snapshot is corrupt")
+            try:
+                self._apply(rec_type, payload, finished)
+            except DecodeError as e:
+                raise SnapshotError(str(e))
+            finally:
+                payload.release()
+            pos = end
+        del self.buffer[:pos]
+        return finished
+
+    def _finish_tenant(self, finished: List[Tuple[str, Keyspace]]):
+        if self._file is not None:
+            raise SnapshotError("Tenant ended in the middle of a file")
+        if self._keyspace is not None:
+            self._keyspace.recount()
+            finished.append((self._user_id, self._keyspace))
+        self._user_id = None
+        self._keyspace = None
+
+    def _apply(self, rec_type: int, payload: memoryview, finished: List[Tuple[str, Keyspace]]):
+        cur = Cursor(payload)
+        if rec_type == REC_TENANT:
+            self._finish_tenant(finished)
+            self.tenant_count += 1
+            self._user_id = cur.str()
+            meta = json.loads(cur.str() or "{}")
+            if self.only is None or self._user_id == self.only:
+                self._keyspace = Keyspace()
+                self._keyspace.meta.update(meta)
+        elif rec_type == REC_VALUE:
+            key, value_type, expiry = cur.str(), cur.str(), cur.float()
+            encoding = cur.u8()
+            if self._keyspace is not None:
+                self._keyspace.data[key] = Entry(decode_value(encoding, cur.rest()), value_type, expiry)
+        elif rec_type == REC_FILE:
+            if self._file is not None:
+                raise SnapshotError("File record before the previous file was complete")
+            self._file = {
+                "key": cur.str(), "content_type": cur.str(), "filename": cur.str(),
+                "expiry": cur.float(), "mtime": cur.f64(), "size": cur.u64(),
+            }
+            if self._file["size"] > MAX_FILE:
+                raise SnapshotError(f"File of {self._file['size']} bytes exceeds the limit")
+            self._file["data"] = bytearray() if self._keyspace is not None else None
+            self._file["received"] = 0
+            self._maybe_finish_file()
+        elif rec_type == REC_FILE_CHUNK:
+            if self._file is None:
+                raise SnapshotError("File chunk outside of a file")
+            start = self._file["received"]
+            end = start + len(payload)
+            if end > self._file["size"]:
+                raise SnapshotError("File longer than its declared size")
+            if self._file["data"] is not None:
+                self._file["data"] += payload
+            self._file["received"] = end
+            self._maybe_finish_file()
+        elif rec_type == REC_EOF:
+            self._finish_tenant(finished)
+            if cur.u64() != self.tenant_count:
+                raise SnapshotError("Tenant count mismatch at end of snapshot")
+            self.done = True
+        else:
+            raise SnapshotError(f"Unknown record type {rec_type}")
+
+    def _maybe_finish_file(self):
+        f = self._file
+        if f["received"] < f["size"]:
+            return
+        if self._keyspace is not None:
+            data = f["data"] if self.spill is None else self.spill(f["data"])
+            self._keyspace.files[f["key"]] = FileEntry(data, f["content_type"], f["filename"],
+                                                       f["expiry"], f["mtime"])
+        self._file = None
+
+    def close(self):
+        if not self.done:
+            raise SnapshotError("Snapshot ended before its EOF record")
+
+
+class RecordReader:
+    """Split a snapshot stream into raw records without decoding them.
+
+    feed() returns (type, record bytes) pairs, header and checksum included,
+    so records can be passed on as they are; the EOF record is returned too.
+    Used to merge the dumps of several shards and to split one between them.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.version: Optional[int] = None
+        self.done = False
+
+    def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
+        if self.done:
+            if data:
+                raise SnapshotError("Data after end of snapshot")
+            return []
+        self.buffer += data
+        records: List[Tuple[int, bytes]] = []
+        if self.version is None:
+            if len(self.buffer) < len(MAGIC) + 2:
+                return records
+            if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+                raise SnapshotError("Not a snapshot file")
+            (self.version,) = U16.unpack_from(self.buffer, len(MAGIC))
+            if self.version > FORMAT_VERSION:
+                raise SnapshotError(f"Snapshot format version {self.version} is newer than {FORMAT_VERSION}")
+            del self.buffer[:len(MAGIC) + 2]
+        pos = 0
+        while not self.done and len(self.buffer) - pos >= _HEADER.size:
+            rec_type, length = _HEADER.unpack_from(self.buffer, pos)
+            if length > MAX_RECORD:
+                raise SnapshotError(f"Record of {length} bytes exceeds the limit")
+            end = pos + _HEADER.size + length + _CRC.size
+            if len(self.buffer) < end:
+                break
+            records.append((rec_type, bytes(self.buffer[pos:end])))
+            self.done = rec_type == REC_EOF
+            pos = end
+        del self.buffer[:pos]
+        return records
+
+    def close(self):
+        if not self.done:
+            raise SnapshotError("Snapshot ended before its EOF record")
+
+
+def record_tenant(record: bytes) -> str:
+    """User id of a raw TENANT record."""
+    return Cursor(memoryview(record)[_HEADER.size:-_CRC.size]).str()
+
+
+def snapshot_header() -> bytes:
+    return MAGIC + U16.pack(FORMAT_VERSION)
+
+
+def eof_record(tenant_count: int) -> bytes:
+    return _record(REC_EOF, U64.pack(tenant_count))
+
+
+async def merge_snapshots(sources: Iterable[AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+    """One snapshot out of several, read one after the other. Tenants must not repeat."""
+    yield snapshot_header()
+    count = 0
+    for source in sources:
+        reader = RecordReader()
+        async for chunk in source:
+            out = bytearray()
+            for rec_type, record in reader.feed(chunk):
+                if rec_type == REC_TENANT:
+                    count += 1
+                if rec_type != REC_EOF:
+                    out += record
+            if out:
+                yield bytes(out)
+        reader.close()
+    yield eof_record(count)
+
+
+# Legacy pickled dumps: only the classes a dump legitimately contains may be
+# loaded, anything else (os.system & co) is refused
+_PICKLE_ALLOWED = {
+    ("keyspace", "Keyspace"), ("keyspace", "Entry"), ("keyspace", "FileEntry"),
+    ("datetime", "datetime"), ("builtins", "bytes"), ("builtins", "bytearray"),
+    ("builtins", "set"), ("builtins", "frozenset"), ("collections", "OrderedDict"),
+    ("_codecs", "encode"),
+}
+
+
+class _RestrictedUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if (module, name) in _PICKLE_ALLOWED:
+            return super().find_class(module, name)
+        raise SnapshotError(f"Refusing to unpickle {module}.{name}")
+
+
+def is_legacy_pickle(head: bytes) -> bool:
+    return head[:1] == b"\x80"
+
+
+def load_legacy_pickle(content: bytes) -> Dict[str, Keyspace]:
+    rdb_data = _RestrictedUnpickler(io.BytesIO(content)).load()
+    if not isinstance(rdb_data, dict):
+        raise SnapshotError("Legacy dump is not a mapping of users")
+    return {user_id: load_keyspace(data) for user_id, data in rdb_data.items()}
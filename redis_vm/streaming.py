@@ -0,0 +1,68 @@
+from email.utils import formatdate
+from typing import Iterator, Optional, Tuple
+
+# Chunk size for file downloads, each response holds at most one chunk copy
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single `bytes=` Range header into an inclusive (start, end).
+
+    Returns None when the whole file should be sent (no header, a unit we
+    don't know or several ranges, which RFC 9110 lets a server ignore).
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if first == "":
+            # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if start > end:
+        return None
+    return start, min(end, size - 1)
+
+
+def etag_for(size: int, mtime: float) -> str:
+    return f'"{size:x}-{int(mtime * 1_000_000):x}"'
+
+
+def http_date(timestamp: float) -> str:
+    return formatdate(timestamp, usegmt=True)
+
+
+def if_range_matches(header: Optional[str], etag: str, last_modified: str) -> bool:
+    # No If-Range means the Range applies unconditionally
+    if not header:
+        return True
+    header = header.strip()
+    return header == etag or header == last_modified
+
+
+def iter_chunks(buffer: bytes, start: int, end: int, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield buffer[start:end + 1] in fixed-size pieces through a memoryview."""
+    view = memoryview(buffer)
+    stop = end + 1
+    try:
+        for offset in range(start, stop, chunk_size):
+            yield bytes(view[offset:min(offset + chunk_size, stop)])
+    finally:
+        view.release()
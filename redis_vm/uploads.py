@@ -0,0 +1,103 @@
+from typing import AsyncIterator
+
+from fastapi import Request
+from starlette.datastructures import FormData, UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
+
+from keyspace import Keyspace
+
+# Multipart framing (boundaries, part headers, the key/expiry fields) that
+# rides along with the file in the request body
+MULTIPART_OVERHEAD = 16 * 1024
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+class QuotaExceeded(Exception):
+    def __init__(self, available: int):
+        super().__init__(f"Storage limit exceeded. Available: {available} bytes")
+        self.available = available
+
+
+class UploadReservation:
+    """Bytes an in-flight upload has claimed from its tenant's quota.
+
+    The claim lives in keyspace.reserved until the upload is stored or
+    dropped, so concurrent uploads from one tenant see each other's bytes
+    and can't both squeeze under the limit.
+    """
+
+    def __init__(self, keyspace: Keyspace, limit: int):
+        self.keyspace = keyspace
+        self.limit = limit
+        self.held = 0
+
+    def available(self) -> int:
+        return self.limit - self.keyspace.storage_used - self.keyspace.reserved
+
+    def reserve(self, nbytes: int):
+        """Grow the claim to `nbytes`, raising QuotaExceeded if it doesn't fit."""
+        extra = nbytes - self.held
+        if extra <= 0:
+            return
+        if extra > self.available():
+            raise QuotaExceeded(max(0, self.available() + self.held))
+        self.keyspace.reserved += extra
+        self.held = nbytes
+
+    def release(self):
+        self.keyspace.reserved -= self.held
+        self.held = 0
+
+
+async def _counted_stream(request: Request, reservation: UploadReservation, credit: int) -> AsyncIterator[bytes]:
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        # abort as soon as the body can no longer fit, not after it all arrived
+        reservation.reserve(received - MULTIPART_OVERHEAD - credit)
+        yield chunk
+
+
+async def parse_upload_form(request: Request, reservation: UploadReservation, credit: int = 0) -> FormData:
+    """Parse the multipart body, reserving its bytes as they arrive.
+
+    `credit` is the size of the file the upload overwrites, see read_upload().
+    """
+    if not request.headers.get("content-type", "").startswith("multipart/form-data"):
+        raise UploadError("Expected a multipart/form-data upload")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit():
+        reservation.reserve(int(declared) - MULTIPART_OVERHEAD - credit)
+    parser = MultiPartParser(request.headers, _counted_stream(request, reservation, credit))
+    try:
+        return await parser.parse()
+    except MultiPartException as e:
+        raise UploadError(str(e))
+
+
+async def read_upload(file: UploadFile, reservation: UploadReservation, credit: int = 0) -> bytearray:
+    """Copy an upload into one pre-sized buffer, re-checking the quota per chunk.
+
+    `credit` is what the upload frees when it lands, i.e. the size of the
+    file it overwrites.
+    """
+    size = file.size
+    buffer = bytearray(size) if size is not None else bytearray()
+    if size is not None:
+        reservation.reserve(size - credit)
+    pos = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        end = pos + len(chunk)
+        reservation.reserve(end - credit)
+        buffer[pos:end] = chunk
+        pos = end
+    if pos != len(buffer):
+        del buffer[pos:]
+    return buffer